@@ -0,0 +1,74 @@
+"""
+Benchmark for the product loading strategies.
+
+For products of growing size (batches x allocated lines per batch), runs a
+series of Allocate commands through the message bus with each loading
+strategy, and with selectin loading behind a ProductCache, and reports the
+SQL statements and the time per command. The statements include the
+UPDATE/INSERTs of the flush, which are the same for every strategy. Runs
+against a file-backed SQLite database.
+
+    PYTHONPATH=src python benchmarks/bench_aggregate_loading.py
+"""
+import tempfile
+import time
+from pathlib import Path
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import bootstrap
+from allocation.adapters import instrumentation, notifications, repository
+from allocation.adapters.orm import mapper_registry
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+
+SIZES = [(1, 10), (10, 10), (10, 100), (50, 100)]
+COMMANDS = 50
+
+
+class NoNotifications(notifications.AbstractNotifications):
+    def send(self, destination, message):
+        pass
+
+
+def make_bus(path, load, counter, product_cache=None):
+    engine = create_engine(f"sqlite:///{path}")
+    mapper_registry.metadata.create_all(engine)
+    return bootstrap.bootstrap(
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine), load=load, product_cache=product_cache),
+        notifications=NoNotifications(),
+        publish=lambda *args: None,
+        query_counter=counter,
+    )
+
+
+def run(bus, batches, lines):
+    for b in range(batches):
+        bus.handle(commands.CreateBatch(f"batch-{b}", "SKU", lines + COMMANDS, None))
+        bus.handle(commands.AllocateMany("SKU", [
+            commands.AllocationLine(f"order-{b}-{n}", 1) for n in range(lines)
+        ]))
+    start = time.perf_counter()
+    for n in range(COMMANDS):
+        bus.handle(commands.Allocate(f"order-{n}", "SKU", 1))
+    return (time.perf_counter() - start) / COMMANDS
+
+
+def main():
+    counter = instrumentation.QueryCounter().attach()
+    print(f"{'batches x lines':>16} {'strategy':>13} {'queries':>8} {'ms/command':>11}")
+    variants = [(name, load, lambda: None) for name, load in repository.LOADING_STRATEGIES.items()]
+    variants.append(("cached", repository.load_selectin, repository.ProductCache))
+    for batches, lines in SIZES:
+        for name, load, make_cache in variants:
+            with tempfile.TemporaryDirectory() as tmp:
+                bus = make_bus(Path(tmp) / "allocation.db", load, counter, make_cache())
+                counter.reset()
+                elapsed = run(bus, batches, lines)
+            allocate = counter.per_message()["Allocate"]
+            print(f"{f'{batches} x {lines}':>16} {name:>13} {allocate:>8.1f} {elapsed * 1e3:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""
+Memory benchmark for a batch's allocations.
+
+Allocates the same order lines to a batch backed by a set of OrderLines and
+to a compact batch, and reports the memory the batch holds afterwards as
+measured by tracemalloc. The order id strings are included in both cases.
+
+    PYTHONPATH=src python benchmarks/bench_allocation_memory.py
+"""
+import gc
+import time
+import tracemalloc
+
+from allocation.domain.model import Batch, OrderLine
+
+SIZES = [10_000, 100_000]
+
+
+def measure(lines, compact):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    batch = Batch("batch", "SKU", lines, eta=None, compact=compact)
+    for i in range(lines):
+        batch.allocate(OrderLine(f"order-{i}", "SKU", 1))
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return batch, current, elapsed
+
+
+def main():
+    print(f"{'lines':>8} {'store':>8} {'MiB':>8} {'bytes/line':>11} {'alloc (s)':>10}")
+    for size in SIZES:
+        for compact in (False, True):
+            batch, current, elapsed = measure(size, compact)
+            print(
+                f"{size:>8} {'compact' if compact else 'set':>8} {current / 2 ** 20:>8.1f}"
+                f" {current / size:>11.0f} {elapsed:>10.2f}"
+            )
+            del batch
+
+
+if __name__ == "__main__":
+    main()
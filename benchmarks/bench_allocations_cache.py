@@ -0,0 +1,111 @@
+"""
+Benchmark for the allocations view cache.
+
+Measures a read of GET /allocations/{orderid}'s view without the cache, and
+on a cache hit. Then runs a seeded mix of allocations, deallocations and
+batch shrinks through the bus, with READERS threads reading through the
+cache all along. After every write, each order's cached view is compared
+with the read model, and any difference is counted as a stale read.
+Runs against a file-backed SQLite database.
+
+    PYTHONPATH=src python benchmarks/bench_allocations_cache.py
+"""
+import random
+import tempfile
+import threading
+import timeit
+from pathlib import Path
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import bootstrap
+from allocation import views
+from allocation.adapters import notifications, orm
+from allocation.adapters.cache import LRUCache
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+
+ORDERS = 20
+WRITES = 200
+READERS = 2
+READS = 2_000
+
+
+class NoNotifications(notifications.AbstractNotifications):
+    def send(self, destination, message):
+        pass
+
+
+def hit_path(bus, cache):
+    bus.handle(commands.CreateBatch("batch", "SKU", 1_000, None))
+    bus.handle(commands.Allocate("order", "SKU", 1))
+    uncached = timeit.timeit(lambda: views.allocations("order", bus.uow), number=READS) / READS
+    cached = timeit.timeit(lambda: views.allocations("order", bus.uow, cache), number=READS) / READS
+    return uncached, cached
+
+
+def write(bus, rng, allocated):
+    orderid, sku = f"order-{rng.randrange(ORDERS)}", f"sku-{rng.randrange(3)}"
+    roll = rng.random()
+    if roll < 0.1:
+        bus.handle(commands.ChangeBatchQuantity(f"{sku}-now", rng.randint(0, 100)))
+    elif (orderid, sku) in allocated and roll < 0.5:
+        bus.handle(commands.DeAllocate(orderid, sku, allocated.pop((orderid, sku))))
+    elif (orderid, sku) not in allocated:
+        qty = rng.randint(1, 10)
+        bus.handle(commands.Allocate(orderid, sku, qty))
+        allocated[(orderid, sku)] = qty
+
+
+def staleness(bus, cache):
+    rng = random.Random(11)
+    for s in range(3):
+        bus.handle(commands.CreateBatch(f"sku-{s}-now", f"sku-{s}", 100, None))
+        bus.handle(commands.CreateBatch(f"sku-{s}-later", f"sku-{s}", 10_000, None))
+    stop = threading.Event()
+
+    def read():
+        reader_rng = random.Random()
+        while not stop.is_set():
+            views.allocations(f"order-{reader_rng.randrange(ORDERS)}", bus.uow, cache)
+
+    readers = [threading.Thread(target=read) for _ in range(READERS)]
+    for reader in readers:
+        reader.start()
+    allocated, stale = {}, 0
+    try:
+        for _ in range(WRITES):
+            write(bus, rng, allocated)
+            for n in range(ORDERS):
+                orderid = f"order-{n}"
+                stale += views.allocations(orderid, bus.uow, cache) != views.allocations(orderid, bus.uow)
+    finally:
+        stop.set()
+        for reader in readers:
+            reader.join()
+    return stale
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(
+            f"sqlite:///{Path(tmp) / 'allocation.db'}", connect_args={"timeout": 30, "check_same_thread": False}
+        )
+        orm.create_schema(engine)
+        cache = LRUCache(maxsize=1_000, ttl=60)
+        bus = bootstrap.bootstrap(
+            uow=unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine)),
+            notifications=NoNotifications(),
+            publish=lambda *args: None,
+            allocations_cache=cache,
+        )
+        uncached, cached = hit_path(bus, cache)
+        print(f"view read: {uncached * 1e6:.0f} us uncached, {cached * 1e6:.1f} us on a cache hit")
+        stale = staleness(bus, cache)
+        print(f"stale reads after {WRITES} writes x {ORDERS} orders: {stale}")
+        print(f"cache: {cache.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Benchmark for reading allocations while writes are going on.
+
+Fills a file-backed SQLite database with ORDERS allocated order lines, builds
+the allocations_view read model from them with RebuildAllocationsView, then
+has a reader look up random orders for SECONDS, first alone and then while
+WRITERS threads allocate through the bus. The lookup is run once with the
+three-way join the view used to run and once against the read model.
+
+    PYTHONPATH=src python benchmarks/bench_allocations_view.py
+"""
+import random
+import statistics
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+import bootstrap
+from allocation import views
+from allocation.adapters import notifications, orm
+from allocation.domain import commands, model
+from allocation.service_layer import unit_of_work
+
+ORDERS = 20_000
+SKUS = 100
+WRITERS = 4
+SECONDS = 5
+
+JOIN_QUERY = """
+    SELECT b.sku, b.reference
+       FROM allocations as a
+       JOIN order_lines AS o ON o.id = a.orderline_id
+       JOIN batches AS b ON b.id = a.batch_id
+       WHERE o.orderid = :orderid
+"""
+
+
+class NoNotifications(notifications.AbstractNotifications):
+    def send(self, destination, message):
+        pass
+
+
+def fill(uow):
+    for s in range(SKUS):
+        sku = f"sku-{s}"
+        with uow:
+            product = model.Product(sku, batches=[model.Batch(f"batch-{s}", sku, ORDERS * 10, None)])
+            product.allocate_many([
+                model.OrderLine(f"order-{n}", sku, 1) for n in range(s, ORDERS, SKUS)
+            ])
+            uow.products.add(product)
+            uow.commit()
+
+
+def read(session_factory, query, stop):
+    rng = random.Random(3)
+    latencies = []
+    while not stop.is_set():
+        orderid = f"order-{rng.randrange(ORDERS)}"
+        start = time.perf_counter()
+        session = session_factory()
+        try:
+            rows = session.execute(text(query), dict(orderid=orderid)).all()
+        finally:
+            session.close()
+        latencies.append(time.perf_counter() - start)
+        assert len(rows) == 1
+    return latencies
+
+
+def write(bus, n, stop):
+    i = 0
+    while not stop.is_set():
+        # each writer keeps to its own skus, SKUS being a multiple of WRITERS
+        bus.handle(commands.Allocate(f"writer-{n}-{i}", f"sku-{(n + WRITERS * i) % SKUS}", 1))
+        i += 1
+
+
+def run(bus, session_factory, query, writers):
+    stop = threading.Event()
+    writers = [threading.Thread(target=write, args=(bus, n, stop)) for n in range(writers)]
+    for writer in writers:
+        writer.start()
+    timer = threading.Timer(SECONDS, stop.set)
+    timer.start()
+    latencies = read(session_factory, query, stop)
+    for writer in writers:
+        writer.join()
+    return len(latencies) / SECONDS, statistics.median(latencies), statistics.quantiles(latencies, n=100)[98]
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(
+            f"sqlite:///{Path(tmp) / 'allocation.db'}", connect_args={"timeout": 30, "check_same_thread": False}
+        )
+        orm.create_schema(engine)
+        session_factory = sessionmaker(bind=engine)
+        bus = bootstrap.bootstrap(
+            uow=unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+            notifications=NoNotifications(),
+            publish=lambda *args: None,
+        )
+        fill(bus.uow)
+        bus.handle(commands.RebuildAllocationsView())
+
+        print(f"{'read':>12} {'writers':>8} {'reads/s':>8} {'p50 (ms)':>9} {'p99 (ms)':>9}")
+        for writers in (0, WRITERS):
+            for name, query in [("join", JOIN_QUERY), ("read model", views.ALLOCATIONS_QUERY)]:
+                reads, p50, p99 = run(bus, session_factory, query, writers)
+                print(f"{name:>12} {writers:>8} {reads:>8.0f} {p50 * 1e3:>9.2f} {p99 * 1e3:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
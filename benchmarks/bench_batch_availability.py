@@ -0,0 +1,38 @@
+"""
+Microbenchmark for Batch.available_quantity / can_allocate.
+
+Compares the running allocated-quantity counter against re-summing the
+allocations on every check, for batches of growing size.
+
+    PYTHONPATH=src python benchmarks/bench_batch_availability.py
+"""
+import timeit
+
+from allocation.domain.model import Batch, OrderLine
+
+SIZES = [10, 100, 1_000, 10_000, 100_000]
+CHECKS = 2_000
+
+
+def make_batch(lines):
+    batch = Batch("batch", "SKU", qty=lines * 2, eta=None)
+    for i in range(lines):
+        batch.allocate(OrderLine(f"order-{i}", "SKU", 1))
+    return batch
+
+
+def main():
+    probe = OrderLine("probe", "SKU", 1)
+    print(f"{'lines':>8} {'counter (us)':>14} {'re-sum (us)':>14}")
+    for size in SIZES:
+        batch = make_batch(size)
+        counter = timeit.timeit(lambda: batch.can_allocate(probe), number=CHECKS)
+        resum = timeit.timeit(
+            lambda: batch._purchased_quantity - sum(a.qty for a in batch._allocations) >= probe.qty,
+            number=max(CHECKS // size, 5),
+        ) / max(CHECKS // size, 5) * CHECKS
+        print(f"{size:>8} {counter / CHECKS * 1e6:>14.3f} {resum / CHECKS * 1e6:>14.3f}")
+
+
+if __name__ == "__main__":
+    main()
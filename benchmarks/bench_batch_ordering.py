@@ -0,0 +1,54 @@
+"""
+Benchmark for Product.allocate on products with many batches.
+
+Compares the persistent ETA-ordered batch index with sorting the batches on
+every allocation.
+
+    PYTHONPATH=src python benchmarks/bench_batch_ordering.py
+"""
+import random
+import time
+from datetime import date, timedelta
+
+from allocation.domain.model import Batch, OrderLine, Product
+
+SIZES = [1_000, 10_000, 50_000]
+ALLOCATIONS = 200
+
+
+def make_batches(n, rng):
+    return [
+        Batch(f"batch-{i}", "SKU", 1_000, rng.choice([None, date(2011, 1, 1) + timedelta(days=rng.randint(0, 365))]))
+        for i in range(n)
+    ]
+
+
+def allocate_with_index(batches):
+    product = Product("SKU", batches=[])
+    for batch in batches:
+        product.add_batch(batch)
+    start = time.perf_counter()
+    for i in range(ALLOCATIONS):
+        product.allocate(OrderLine(f"order-{i}", "SKU", 1))
+    return time.perf_counter() - start
+
+
+def allocate_with_sort(batches):
+    start = time.perf_counter()
+    for i in range(ALLOCATIONS):
+        line = OrderLine(f"order-{i}", "SKU", 1)
+        batch = next(b for b in sorted(batches) if b.can_allocate(line))
+        batch.allocate(line)
+    return time.perf_counter() - start
+
+
+def main():
+    print(f"{'batches':>8} {'index (us/alloc)':>18} {'sorted (us/alloc)':>18}")
+    for size in SIZES:
+        index = allocate_with_index(make_batches(size, random.Random(size)))
+        resort = allocate_with_sort(make_batches(size, random.Random(size)))
+        print(f"{size:>8} {index / ALLOCATIONS * 1e6:>18.1f} {resort / ALLOCATIONS * 1e6:>18.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Benchmark for allocating many order lines for one SKU.
+
+Sends the same number of lines through the message bus as individual
+Allocate commands and as AllocateMany commands of growing size, against a
+file-backed SQLite database.
+
+    PYTHONPATH=src python benchmarks/bench_bulk_allocation.py
+"""
+import tempfile
+import time
+from pathlib import Path
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import bootstrap
+from allocation.adapters import notifications
+from allocation.adapters.orm import mapper_registry
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+
+LINES = 2_000
+LINES_PER_TRANSACTION = [1, 10, 100, 1_000]
+
+
+class NoNotifications(notifications.AbstractNotifications):
+    def send(self, destination, message):
+        pass
+
+
+def make_bus(path):
+    engine = create_engine(f"sqlite:///{path}")
+    mapper_registry.metadata.create_all(engine)
+    return bootstrap.bootstrap(
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine)),
+        notifications=NoNotifications(),
+        publish=lambda *args: None,
+    )
+
+
+def run(bus, sku, per_transaction):
+    bus.handle(commands.CreateBatch(f"batch-{sku}", sku, LINES, None))
+    lines = [commands.AllocationLine(f"order-{i}", 1) for i in range(LINES)]
+    start = time.perf_counter()
+    if per_transaction == 1:
+        for line in lines:
+            bus.handle(commands.Allocate(line.orderid, sku, line.qty))
+    else:
+        for i in range(0, LINES, per_transaction):
+            bus.handle(commands.AllocateMany(sku, lines[i:i + per_transaction]))
+    return time.perf_counter() - start
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        bus = make_bus(Path(tmp) / "allocation.db")
+        print(f"{'lines/tx':>9} {'lines/sec':>12}")
+        for per_transaction in LINES_PER_TRANSACTION:
+            elapsed = run(bus, f"sku-{per_transaction}", per_transaction)
+            print(f"{per_transaction:>9} {LINES / elapsed:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Benchmark for loading stock batches in bulk.
+
+Writes ROWS batches over SKUS skus to a CSV file, then loads them into a
+file-backed SQLite database once with one CreateBatch command per row, as
+POST /add_batch does, and once with the bulk loader's CreateBatches chunks.
+Reports rows per second for both. The per-row load only gets the first
+PER_ROW rows, as it is far slower.
+
+    PYTHONPATH=src python benchmarks/bench_bulk_load.py
+"""
+import tempfile
+import time
+from pathlib import Path
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import bootstrap
+from allocation.adapters import notifications, orm
+from allocation.entrypoints import bulk_loader
+from allocation.service_layer import unit_of_work
+
+ROWS = 100_000
+PER_ROW = 2_000
+SKUS = 5_000
+
+
+class NoNotifications(notifications.AbstractNotifications):
+    def send(self, destination, message):
+        pass
+
+
+def make_bus(path):
+    engine = create_engine(f"sqlite:///{path}")
+    orm.create_schema(engine)
+    return bootstrap.bootstrap(
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine)),
+        notifications=NoNotifications(),
+        publish=lambda *args: None,
+    )
+
+
+def per_row(bus, source):
+    start = time.perf_counter()
+    for row in bulk_loader.read_rows(source):
+        bus.handle(bulk_loader.to_command(row))
+    return PER_ROW / (time.perf_counter() - start)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        source = Path(tmp) / "batches.csv"
+        with open(source, "w") as f:
+            f.write("ref,sku,qty,eta\n")
+            f.writelines(f"batch-{n},sku-{n % SKUS},100,2030-01-01\n" for n in range(ROWS))
+        head = Path(tmp) / "head.csv"
+        head.write_text("".join(source.read_text().splitlines(keepends=True)[:PER_ROW + 1]))
+
+        print(f"one CreateBatch per row: {per_row(make_bus(Path(tmp) / 'per_row.db'), head):>8.0f} rows/s")
+        for chunk_size in (1_000, bulk_loader.CHUNK_SIZE, 20_000):
+            report = bulk_loader.load(source, make_bus(Path(tmp) / f"bulk-{chunk_size}.db"), chunk_size)
+            print(f"CreateBatches of {chunk_size:>6}: {report.rows_per_second:>8.0f} rows/s")
+
+
+if __name__ == "__main__":
+    main()
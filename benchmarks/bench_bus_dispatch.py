@@ -0,0 +1,67 @@
+"""
+Microbenchmark for the message bus's own overhead per message.
+
+Handles MESSAGES commands through a MessageBus whose handlers and unit of
+work do nothing, so all that is measured is dispatch: finding the handler,
+calling it with its injected dependencies and its retry wrapper, and
+collecting new events. Runs a command on its own, and a command whose
+handler raises an event with two handlers.
+
+    PYTHONPATH=src python benchmarks/bench_bus_dispatch.py
+"""
+import time
+
+import bootstrap
+from allocation.domain import commands, events
+from allocation.service_layer import messagebus
+from allocation.service_layer.unit_of_work import UnitOfWorkProtocol
+
+MESSAGES = 200_000
+EVENT = events.Deallocated("order", "SKU", 1, "batch")
+
+
+class NoOpUnitOfWork(UnitOfWorkProtocol):
+    def __init__(self):
+        self.raised = []
+
+    def collect_new_events(self):
+        raised, self.raised = self.raised, []
+        return raised
+
+
+def no_op(message, uow, notifications):
+    pass
+
+
+def raise_event(command, uow):
+    uow.raised.append(EVENT)
+
+
+def run(command_handler, event_handlers):
+    uow = NoOpUnitOfWork()
+    dependencies = dict(uow=uow, notifications=None)
+    bus = messagebus.MessageBus(
+        uow,
+        bootstrap.inject_event_handlers(event_handlers, dependencies),
+        bootstrap.inject_command_handlers({commands.Allocate: command_handler}, dependencies),
+    )
+    command = commands.Allocate("order", "SKU", 1)
+    start = time.perf_counter()
+    for _ in range(MESSAGES):
+        bus.handle(command)
+    return time.perf_counter() - start
+
+
+def main():
+    print(f"{'case':>18} {'messages':>9} {'us/message':>11}")
+    for name, command_handler, event_handlers, per_command in [
+        ("command", lambda command, uow: None, {}, 1),
+        ("command + event", raise_event, {events.Deallocated: [no_op, no_op]}, 2),
+    ]:
+        elapsed = run(command_handler, event_handlers)
+        messages = MESSAGES * per_command
+        print(f"{name:>18} {messages:>9} {elapsed / messages * 1e6:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Benchmark for settling the Allocate commands a shrinking batch cascades.
+
+Fills a batch with LINES single-unit allocations, then shrinks it by each of
+SHRINKS through the message bus, with cascaded commands applied in the unit
+of work that raised them and, for comparison, with each Allocate handled in
+a unit of work of its own. Reports how long it took for everything to
+settle, the Allocate commands that went through the bus and the SQL
+statements run. Runs against a file-backed SQLite database.
+
+    PYTHONPATH=src python benchmarks/bench_cascade_settle.py
+"""
+import tempfile
+import time
+from datetime import date
+from pathlib import Path
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import bootstrap
+from allocation.adapters import instrumentation, notifications, orm
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+
+LINES = 10_000
+SHRINKS = [0.01, 0.05]
+
+
+class NoNotifications(notifications.AbstractNotifications):
+    def send(self, destination, message):
+        pass
+
+
+def run(path, shrink, cascade):
+    engine = create_engine(f"sqlite:///{path}")
+    orm.create_schema(engine)
+    counter = instrumentation.QueryCounter().attach(engine)
+    bus = bootstrap.bootstrap(
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine)),
+        notifications=NoNotifications(),
+        publish=lambda *args: None,
+        query_counter=counter,
+        cascade=cascade,
+    )
+    bus.handle(commands.CreateBatch("batch1", "SKU", LINES, None))
+    bus.handle(commands.CreateBatch("batch2", "SKU", LINES, date(2011, 1, 1)))
+    bus.handle(commands.AllocateMany("SKU", [commands.AllocationLine(f"order-{i}", 1) for i in range(LINES)]))
+    counter.reset()
+    try:
+        start = time.perf_counter()
+        bus.handle(commands.ChangeBatchQuantity("batch1", int(LINES * (1 - shrink))))
+        elapsed = time.perf_counter() - start
+        return elapsed, counter.messages["Allocate"], sum(counter.queries.values())
+    finally:
+        counter.detach()
+        engine.dispose()
+
+
+def main():
+    print(f"{'displaced':>9} {'cascade':>8} {'settle (s)':>11} {'commands':>9} {'queries':>8}")
+    for shrink in SHRINKS:
+        for cascade in (False, True):
+            with tempfile.TemporaryDirectory() as tmp:
+                elapsed, allocate_commands, queries = run(Path(tmp) / "allocation.db", shrink, cascade)
+            print(f"{int(LINES * shrink):>9} {str(cascade):>8} {elapsed:>11.2f} {allocate_commands:>9} {queries:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Benchmark for the optimistic and pessimistic product locking strategies.
+
+THREADS threads share one message bus and send Allocate commands whose SKUs
+follow a Zipf distribution, so a few SKUs get most of the traffic. Both
+strategies retry conflicts with the default RetryPolicy. Reports the
+throughput, the p50/p99 latency of a command (retries included), the
+conflicts and the commands that failed.
+
+By default this runs on a file-backed SQLite database. SQLite has no row
+locks and ignores FOR UPDATE, so the pessimistic run starts every
+transaction with BEGIN IMMEDIATE instead: the lock covers the whole database
+rather than a product row. Pass a database url to run against Postgres,
+where FOR UPDATE locks only the product row and each strategy runs at the
+isolation level the service gives it.
+
+    PYTHONPATH=src python benchmarks/bench_locking.py [postgresql://...]
+"""
+import logging
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+import bootstrap
+from allocation.adapters import instrumentation, notifications, orm
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+
+THREADS = 8
+COMMANDS = 50
+SKUS = 20
+ZIPF_EXPONENT = 1.2
+
+
+class NoNotifications(notifications.AbstractNotifications):
+    def send(self, destination, message):
+        pass
+
+
+def sqlite_engine(path, locking):
+    engine = create_engine(f"sqlite:///{path}", connect_args={"timeout": 30, "check_same_thread": False})
+    if locking == "pessimistic":
+        # take the write lock when the transaction starts, as FOR UPDATE would
+        @event.listens_for(engine, "connect")
+        def no_implicit_transactions(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(engine, "begin")
+        def begin_immediate(connection):
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+    return engine
+
+
+def run(engine, locking, run_id):
+    orm.create_schema(engine)
+    metrics = instrumentation.ConflictMetrics()
+    bus = bootstrap.bootstrap(
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine), locking=locking),
+        notifications=NoNotifications(),
+        publish=lambda *args: None,
+        conflict_metrics=metrics,
+    )
+    skus = [f"{run_id}-sku-{s}" for s in range(SKUS)]
+    for sku in skus:
+        bus.handle(commands.CreateBatch(f"{sku}-batch", sku, THREADS * COMMANDS, None))
+    weights = [1 / (rank + 1) ** ZIPF_EXPONENT for rank in range(SKUS)]
+    latencies = []
+
+    def work(n):
+        rng = random.Random(n)
+        for i, sku in enumerate(rng.choices(skus, weights, k=COMMANDS)):
+            start = time.perf_counter()
+            try:
+                bus.handle(commands.Allocate(f"{run_id}-order-{n}-{i}", sku, 1))
+            except unit_of_work.ConcurrencyConflict:
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    workers = [threading.Thread(target=work, args=(n,)) for n in range(THREADS)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start, latencies, metrics
+
+
+def main():
+    # a command that gives up logs its traceback
+    logging.disable(logging.ERROR)
+    url = sys.argv[1] if len(sys.argv) > 1 else None
+    print(f"{THREADS} threads x {COMMANDS} allocations over {SKUS} skus, zipf s={ZIPF_EXPONENT}")
+    print(f"{'locking':>12} {'commands/s':>11} {'p50 ms':>7} {'p99 ms':>7} {'conflicts':>10} {'failed':>7}")
+    for locking in ("optimistic", "pessimistic"):
+        run_id = f"{locking}-{time.time_ns()}"
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = (
+                create_engine(url, isolation_level=unit_of_work.ISOLATION_LEVELS[locking]) if url
+                else sqlite_engine(Path(tmp) / "allocation.db", locking)
+            )
+            elapsed, latencies, metrics = run(engine, locking, run_id)
+            engine.dispose()
+        p50, p99 = (q * 1e3 for q in statistics.quantiles(latencies, n=100)[49::49])
+        print(
+            f"{locking:>12} {len(latencies) / elapsed:>11.0f} {p50:>7.1f} {p99:>7.1f}"
+            f" {metrics.conflicts['Allocate']:>10} {metrics.gave_up['Allocate']:>7}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Benchmark for long message cascades on the message bus.
+
+Shrinks a batch that holds N single-unit allocations to zero. This displaces
+every line and queues N Deallocated events and N Allocate commands, followed
+by N Allocated events, all within one MessageBus.handle call. The cascade
+that would apply the Allocate commands before the shrink commits is off, so
+that they go through the bus queue. The time per message should stay flat
+as N grows. Uses an in-memory repository and no-op event handlers so that
+only the bus and the domain are measured; the messages reported are the
+ones the bus handed to a handler.
+
+    PYTHONPATH=src python benchmarks/bench_message_cascade.py
+"""
+import time
+
+import bootstrap
+from allocation.adapters import notifications
+from allocation.adapters.repository import AbstractRepository
+from allocation.domain import commands, events
+from allocation.service_layer.unit_of_work import UnitOfWorkProtocol
+
+CASCADES = [1_000, 10_000, 50_000, 100_000]
+
+
+class InMemoryRepository(AbstractRepository):
+    def __init__(self):
+        super().__init__()
+        self._products = {}
+
+    def _add(self, product):
+        self._products[product.sku] = product
+
+    def _get(self, sku):
+        return self._products.get(sku)
+
+    def _get_by_batchref(self, ref):
+        return next((p for p in self._products.values() for b in p.batches if b.reference == ref), None)
+
+
+class InMemoryUnitOfWork(UnitOfWorkProtocol):
+    def __init__(self):
+        self.products = InMemoryRepository()
+
+    def rollback(self):
+        pass
+
+
+class NoNotifications(notifications.AbstractNotifications):
+    def send(self, destination, message):
+        pass
+
+
+def counting(handler, handled):
+    def handle(message):
+        handled.append(message)
+        return handler(message)
+    return handle
+
+
+def run(lines):
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=InMemoryUnitOfWork(),
+        notifications=NoNotifications(),
+        publish=lambda *args: None,
+        cascade=False,
+    )
+    bus.handle(commands.CreateBatch("batch1", "SKU", lines, None))
+    bus.handle(commands.CreateBatch("batch2", "SKU", lines, None))
+    bus.handle(commands.AllocateMany("SKU", [commands.AllocationLine(f"order-{i}", 1) for i in range(lines)]))
+    handled = []
+    bus.event_handlers = {
+        event_type: [counting(lambda event: None, handled)] for event_type in (events.Allocated, events.Deallocated)
+    }
+    bus.command_handler = {
+        command_type: counting(bus.command_handler[command_type], handled)
+        for command_type in (commands.ChangeBatchQuantity, commands.Allocate)
+    }
+    start = time.perf_counter()
+    bus.handle(commands.ChangeBatchQuantity("batch1", 0))
+    return time.perf_counter() - start, len(handled)
+
+
+def main():
+    print(f"{'cascade':>8} {'messages':>9} {'total (s)':>10} {'us/message':>11}")
+    for lines in CASCADES:
+        elapsed, messages = run(lines)
+        print(f"{lines:>8} {messages:>9} {elapsed:>10.2f} {elapsed / messages * 1e6:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
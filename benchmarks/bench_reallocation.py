@@ -0,0 +1,90 @@
+"""
+Benchmark for shrinking a heavily allocated batch.
+
+For every reallocation policy, with and without the message bus cascade,
+fills a batch with order lines of random size, shrinks it by a few percent
+through the message bus and reports how many lines were displaced, how many
+Allocate commands went back onto the bus and how long it took for everything
+to settle. Runs against a file-backed
+SQLite database.
+
+    PYTHONPATH=src python benchmarks/bench_reallocation.py
+"""
+import random
+import tempfile
+import time
+from datetime import date
+from pathlib import Path
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker, clear_mappers
+
+import bootstrap
+from allocation.adapters import notifications
+from allocation.adapters.orm import mapper_registry
+from allocation.domain import commands, model
+from allocation.service_layer import unit_of_work
+
+LINES = 2_000
+SHRINK = 0.05
+
+POLICIES = {
+    "arbitrary": model.ReallocationPolicy(),
+    "fifo": model.ReallocationPolicy(displace=model.displace_oldest_first),
+    "fewest_lines": model.ReallocationPolicy(displace=model.displace_fewest_lines),
+    "closest_fit": model.ReallocationPolicy(displace=model.displace_closest_fit),
+}
+
+
+class NoNotifications(notifications.AbstractNotifications):
+    def send(self, destination, message):
+        pass
+
+
+def make_bus(path, reallocation, cascade):
+    engine = create_engine(f"sqlite:///{path}")
+    mapper_registry.metadata.create_all(engine)
+    return bootstrap.bootstrap(
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine)),
+        notifications=NoNotifications(),
+        publish=lambda *args: None,
+        reallocation=reallocation,
+        cascade=cascade,
+    )
+
+
+def run(bus):
+    rng = random.Random(7)
+    qtys = [rng.randint(1, 10) for _ in range(LINES)]
+    bus.handle(commands.CreateBatch("batch1", "SKU", sum(qtys), None))
+    bus.handle(commands.CreateBatch("batch2", "SKU", sum(qtys), date(2011, 1, 1)))
+    bus.handle(commands.AllocateMany("SKU", [
+        commands.AllocationLine(f"order-{i}", qty) for i, qty in enumerate(qtys)
+    ]))
+
+    handle_allocate = bus.command_handler[commands.Allocate]
+    allocate_commands = []
+    bus.command_handler[commands.Allocate] = lambda c: (allocate_commands.append(c), handle_allocate(c))[1]
+    start = time.perf_counter()
+    bus.handle(commands.ChangeBatchQuantity("batch1", int(sum(qtys) * (1 - SHRINK))))
+    elapsed = time.perf_counter() - start
+
+    with bus.uow:
+        [batch1, _] = bus.uow.products.get("SKU").batches
+        displaced = LINES - len(batch1._allocations)
+    return displaced, len(allocate_commands), elapsed
+
+
+def main():
+    print(f"{'policy':>12} {'cascade':>8} {'displaced':>10} {'commands':>9} {'settle (s)':>11}")
+    for name, policy in POLICIES.items():
+        for cascade in (False, True):
+            with tempfile.TemporaryDirectory() as tmp:
+                bus = make_bus(Path(tmp) / "allocation.db", policy, cascade)
+                displaced, allocate_commands, elapsed = run(bus)
+                clear_mappers()
+            print(f"{name:>12} {str(cascade):>8} {displaced:>10} {allocate_commands:>9} {elapsed:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
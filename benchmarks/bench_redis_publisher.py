@@ -0,0 +1,72 @@
+"""
+Benchmark for publishing events to Redis.
+
+Publishes EVENTS Allocated events to an in-process server that speaks the
+Redis protocol (tests/fake_redis.py), once with one PUBLISH round trip per
+event and then through BufferedPublisher at several batch sizes, flushing
+at the end as the message bus does. Also times the event serializer with
+json.dumps and, if it is installed, orjson. Against a real Redis over a
+network the round trips saved are longer, so buffering gains more.
+
+    PYTHONPATH=src python benchmarks/bench_redis_publisher.py
+"""
+import json
+import sys
+import time
+import timeit
+from dataclasses import asdict
+from pathlib import Path
+
+import redis
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from allocation.adapters import redis_eventpublisher  # noqa: E402
+from allocation.domain import events  # noqa: E402
+from tests.fake_redis import FakeRedisServer  # noqa: E402
+
+EVENTS = 20_000
+BATCH_SIZES = [1, 10, 100, 1_000]
+
+
+def unbuffered(client, batch):
+    for event in batch:
+        client.publish("line_allocated", redis_eventpublisher.serialize(event))
+
+
+def buffered(client, batch, max_events):
+    publisher = redis_eventpublisher.BufferedPublisher(client, max_events=max_events, max_delay=60)
+    for event in batch:
+        publisher("line_allocated", event)
+    publisher.flush()
+
+
+def rate(run):
+    start = time.perf_counter()
+    run()
+    return EVENTS / (time.perf_counter() - start)
+
+
+def main():
+    batch = [events.Allocated(f"order-{n}", "SKU", 1, "batch") for n in range(EVENTS)]
+    server = FakeRedisServer().start()
+    try:
+        client = redis.Redis(**server.connection_kwargs())
+        print(f"{'one PUBLISH per event':>24}: {rate(lambda: unbuffered(client, batch)):>8.0f} events/s")
+        for max_events in BATCH_SIZES:
+            print(f"{f'buffered, max_events={max_events}':>24}:"
+                  f" {rate(lambda: buffered(client, batch, max_events)):>8.0f} events/s")
+    finally:
+        server.close()
+
+    event = batch[0]
+    serializers = [("json", lambda: json.dumps(asdict(event)).encode())]
+    orjson = redis_eventpublisher._orjson()
+    if orjson is not None:
+        serializers.append(("orjson", lambda: orjson.dumps(event)))
+    for name, serializer in serializers:
+        print(f"{name:>24}: {timeit.timeit(serializer, number=EVENTS) / EVENTS * 1e6:>8.2f} us/event")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Throughput benchmark for the sharded message bus.
+
+Allocates order lines across many SKUs through ShardedMessageBus with a
+growing number of shards. A single shard handles everything serially, like
+the plain MessageBus. The database is a file-backed SQLite database in WAL
+mode. Each statement sleeps for DB_LATENCY first, to stand in for the
+round-trip to a networked Postgres. SQLite still allows only one writer at
+a time, so throughput flattens once its write lock is saturated. Postgres
+only serialises writers that touch the same product row.
+
+    PYTHONPATH=src python benchmarks/bench_sharded_bus.py
+"""
+import tempfile
+import time
+from concurrent.futures import wait
+from pathlib import Path
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+import bootstrap
+from allocation.adapters import notifications, orm
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+
+DB_LATENCY = 0.002
+SKUS = 32
+LINES_PER_SKU = 25
+SHARDS = [1, 2, 4, 8, 16]
+
+
+class NoNotifications(notifications.AbstractNotifications):
+    def send(self, destination, message):
+        pass
+
+
+def make_session_factory(path):
+    engine = create_engine(f"sqlite:///{path}", connect_args={"timeout": 60, "check_same_thread": False})
+
+    @event.listens_for(engine, "connect")
+    def set_wal(dbapi_connection, _):
+        dbapi_connection.execute("PRAGMA journal_mode=WAL")
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def simulate_latency(*_):
+        time.sleep(DB_LATENCY)
+
+    orm.mapper_registry.metadata.create_all(engine)
+    return sessionmaker(bind=engine)
+
+
+def run(shards, session_factory):
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+        notifications=NoNotifications(),
+        publish=lambda *args: None,
+        shards=shards,
+        uow_factory=lambda: unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+    )
+    skus = [f"sku-{shards}-{i}" for i in range(SKUS)]
+    for sku in skus:
+        bus.handle(commands.CreateBatch(f"batch-{sku}", sku, LINES_PER_SKU, None))
+    start = time.perf_counter()
+    futures = [
+        bus.submit(commands.Allocate(f"order-{n}", sku, 1))
+        for n in range(LINES_PER_SKU) for sku in skus
+    ]
+    wait(futures)
+    elapsed = time.perf_counter() - start
+    for future in futures:
+        future.result()
+    bus.close()
+    return SKUS * LINES_PER_SKU / elapsed
+
+
+def main():
+    orm.start_mappers()
+    with tempfile.TemporaryDirectory() as tmp:
+        session_factory = make_session_factory(Path(tmp) / "allocation.db")
+        print(f"{'shards':>7} {'commands/sec':>13}")
+        for shards in SHARDS:
+            print(f"{shards:>7} {run(shards, session_factory):>13.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Benchmark for the startup time of the entrypoints.
+
+Imports each entrypoint module in a fresh interpreter RUNS times and reports
+the median wall time of the whole process and, from python -X importtime,
+the median time spent importing the module itself. Neither needs Postgres
+or Redis to be up, as importing an entrypoint must not connect to them.
+
+    PYTHONPATH=src python benchmarks/bench_startup.py
+"""
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ENTRYPOINTS = [
+    "allocation.entrypoints.api",
+    "allocation.entrypoints.redis_eventconsumer",
+    "allocation.entrypoints.outbox_relay",
+    "allocation.entrypoints.bulk_loader",
+]
+RUNS = 7
+SRC = Path(__file__).resolve().parents[1] / "src"
+
+
+def import_time_us(stderr: str, module: str) -> int:
+    # lines read "import time: self [us] | cumulative | imported package"
+    for line in stderr.splitlines():
+        _, _, fields = line.partition("import time:")
+        parts = [part.strip() for part in fields.split("|")]
+        if len(parts) == 3 and parts[2] == module:
+            return int(parts[1])
+    raise ValueError(f"{module} was not imported")
+
+
+def run(module):
+    env = dict(os.environ, PYTHONPATH=str(SRC))
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        env=env, capture_output=True, text=True, check=True,
+    )
+    return time.perf_counter() - start, import_time_us(result.stderr, module)
+
+
+def main():
+    print(f"{'entrypoint':>42} {'process (ms)':>13} {'import (ms)':>12}")
+    for module in ENTRYPOINTS:
+        wall, imported = zip(*(run(module) for _ in range(RUNS)))
+        print(f"{module:>42} {statistics.median(wall) * 1e3:>13.0f} {statistics.median(imported) / 1e3:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
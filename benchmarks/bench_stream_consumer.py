@@ -0,0 +1,110 @@
+"""
+Benchmark for the change_batch_quantity stream consumer.
+
+Adds MESSAGES ChangeBatchQuantity messages for REFS batch references (two
+per product, each with an order allocated) to a stream on an in-process
+server that speaks the Redis protocol (tests/fake_redis.py), then drains
+it with StreamConsumer into a file-backed SQLite database, for several
+worker counts, with and without coalescing. A supplier feed sends a burst
+of changes per batch, some of which briefly drop below what is allocated.
+Reports messages per second, the messages collapsed and transactions saved
+as the consumer counts them, and the reallocation work done: the lines
+displaced and the SQL statements run. SQLite commits
+one transaction at a time, so more workers only pay off on Postgres.
+
+    PYTHONPATH=src python benchmarks/bench_stream_consumer.py
+"""
+import json
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import redis
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import bootstrap  # noqa: E402
+from allocation.adapters import instrumentation, notifications, orm  # noqa: E402
+from allocation.domain import commands, events  # noqa: E402
+from allocation.entrypoints import redis_eventconsumer  # noqa: E402
+from allocation.service_layer import handlers, unit_of_work  # noqa: E402
+from tests.fake_redis import FakeRedisServer  # noqa: E402
+
+MESSAGES = 2_000
+REFS = 200
+BURST = 5
+WORKERS = [1, 4]
+
+
+class NoNotifications(notifications.AbstractNotifications):
+    def send(self, destination, message):
+        pass
+
+
+def run(path, workers, coalesce):
+    engine = create_engine(f"sqlite:///{path}", connect_args={"timeout": 30, "check_same_thread": False})
+    orm.create_schema(engine)
+    counter = instrumentation.QueryCounter().attach(engine)
+    bus = bootstrap.bootstrap(
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine)),
+        notifications=NoNotifications(),
+        publish=lambda *args: None,
+        query_counter=counter,
+    )
+    bus.handle(commands.CreateBatches([
+        commands.CreateBatch(f"batch-{n}", f"sku-{n // 2}", 1_000, None) for n in range(REFS)
+    ]))
+    for sku in range(REFS // 2):
+        bus.handle(commands.Allocate(f"order-{sku}", f"sku-{sku}", 100))
+    counter.reset()
+    server = FakeRedisServer().start()
+    client = redis.Redis(**server.connection_kwargs())
+    rng = random.Random(7)
+    pipeline = client.pipeline(transaction=False)
+    for _ in range(MESSAGES // BURST):
+        ref = f"batch-{rng.randrange(REFS)}"
+        for qty in [rng.randint(0, 1_000) for _ in range(BURST - 1)] + [1_000]:
+            pipeline.xadd(redis_eventconsumer.STREAM, {"data": json.dumps(dict(batchref=ref, qty=qty))})
+    pipeline.execute()
+    consumer = redis_eventconsumer.StreamConsumer(
+        client, bus, workers=workers, batch_size=BURST * 20, block_ms=10, coalesce=coalesce,
+    )
+    consumer.create_group()
+    try:
+        start = time.perf_counter()
+        while consumer.acked < MESSAGES:
+            consumer.process(consumer.read_window() if coalesce else consumer.read())
+        rate = MESSAGES / (time.perf_counter() - start)
+        queries = sum(counter.queries.values())
+        # every displaced line raises one Deallocated, which each of its handlers counts
+        displaced = counter.messages["Deallocated"] // len(handlers.EVENT_HANDLERS[events.Deallocated])
+        stats = consumer.stats()
+        return rate, stats["collapsed"], stats["transactions_saved"], displaced, queries
+    finally:
+        consumer.close()
+        counter.detach()
+        server.close()
+        engine.dispose()
+
+
+def main():
+    print(
+        f"{'workers':>7} {'coalesce':>8} {'messages/s':>11} {'collapsed':>10} {'saved':>6} {'displaced':>10}"
+        f" {'queries':>8}"
+    )
+    for workers in WORKERS:
+        for coalesce in (False, True):
+            with tempfile.TemporaryDirectory() as tmp:
+                rate, collapsed, saved, displaced, queries = run(Path(tmp) / "allocation.db", workers, coalesce)
+            print(
+                f"{workers:>7} {str(coalesce):>8} {rate:>11.0f} {collapsed:>10} {saved:>6} {displaced:>10}"
+                f" {queries:>8}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Load test comparing the sync and the asyncio API.
+
+Drives POST /allocate through both FastAPI apps in-process with httpx,
+against a file-backed SQLite database (aiosqlite for the async app). Both
+apps publish Allocated events to a stand-in that waits REDIS_LATENCY per
+event, to mimic a Redis round-trip. The sync app runs once for each
+thread limit in SYNC_THREADS, all threads sharing one bus.
+
+Requests for the same SKU can overlap once a slow request lets later
+ones overtake it; the losers of the version_number check come back as
+500s and are counted as errors. SQLite only lets one writer in at a
+time, so this measures the bus and the driver rather than the database;
+point both apps at Postgres for numbers that mean something in prod.
+
+    PYTHONPATH=src python benchmarks/loadtest_api.py
+"""
+import asyncio
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import anyio.to_thread
+import httpx
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+import bootstrap
+from allocation.adapters import notifications, orm
+from allocation.entrypoints import api, async_api
+from allocation.service_layer import unit_of_work
+
+REDIS_LATENCY = 0.005
+SYNC_THREADS = (1, 40)
+REQUESTS = 1_000
+CONCURRENCY = 50
+SKUS = 200
+
+
+class NoNotifications(notifications.AbstractNotifications):
+    def send(self, destination, message):
+        pass
+
+
+def slow_publish(channel, event):
+    time.sleep(REDIS_LATENCY)
+
+
+async def slow_publish_async(channel, event):
+    await asyncio.sleep(REDIS_LATENCY)
+
+
+async def drive(app, sku_prefix):
+    latencies, errors = [], 0
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    async with httpx.AsyncClient(transport=transport, base_url="http://loadtest") as client:
+        for i in range(SKUS):
+            await client.post("/add_batch", json={"ref": f"{sku_prefix}-batch-{i}", "sku": f"{sku_prefix}-{i}", "qty": REQUESTS, "eta": None})
+
+        async def allocate(n):
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                r = await client.post("/allocate", json={"orderid": f"order-{n}", "sku": f"{sku_prefix}-{n % SKUS}", "qty": 1})
+                latencies.append(time.perf_counter() - start)
+                errors += r.status_code != 201
+
+        start = time.perf_counter()
+        await asyncio.gather(*(allocate(n) for n in range(REQUESTS)))
+        elapsed = time.perf_counter() - start
+    p99 = statistics.quantiles(latencies, n=100)[98]
+    return REQUESTS / elapsed, p99, errors
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "allocation.db"
+        orm.mapper_registry.metadata.create_all(create_engine(f"sqlite:///{path}"))
+        api.bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(
+                bind=create_engine(f"sqlite:///{path}", connect_args={"timeout": 30, "check_same_thread": False})
+            )),
+            notifications=NoNotifications(),
+            publish=slow_publish,
+        )
+        async_api.bus = bootstrap.bootstrap_async(
+            start_orm=False,
+            uow=unit_of_work.AsyncSqlAlchemyUnitOfWork(sessionmaker(
+                bind=create_async_engine(f"sqlite+aiosqlite:///{path}", connect_args={"timeout": 30}),
+                class_=AsyncSession,
+                expire_on_commit=False,
+            )),
+            notifications=NoNotifications(),
+            publish=slow_publish_async,
+        )
+        print(f"{'app':>8} {'req/s':>8} {'p99 (ms)':>9} {'errors':>7}")
+        for threads in SYNC_THREADS:
+            anyio.to_thread.current_default_thread_limiter().total_tokens = threads
+            rps, p99, errors = await drive(api.app, f"sync{threads}")
+            print(f"{f'sync/{threads}':>8} {rps:>8.0f} {p99 * 1e3:>9.1f} {errors:>7}")
+        rps, p99, errors = await drive(async_api.app, "async")
+        print(f"{'async':>8} {rps:>8.0f} {p99 * 1e3:>9.1f} {errors:>7}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,99 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Set, Any
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    A bounded, thread-safe cache whose entries also expire after ttl seconds.
+
+    get_or_load only stores what it loaded if the key was not invalidated in
+    the meantime, so a read that raced a write cannot put the old value back
+    after the write's invalidation.
+    """
+
+    def __init__(self, maxsize: int = 10_000, ttl: float = 30.0, clock: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = self.misses = self.evictions = self.expirations = self.invalidations = 0
+        self._entries = OrderedDict()  # type: OrderedDict[Hashable, tuple[float, Any]]
+        self._loads = {}  # type: Dict[Hashable, Set[object]]
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key: Hashable, load: Callable[[], Any]):
+        with self._lock:
+            value = self._get(key)
+            if value is not _MISSING:
+                return value
+            ticket = object()
+            self._loads.setdefault(key, set()).add(ticket)
+        try:
+            value = load()
+        except BaseException:
+            with self._lock:
+                self._forget_load(key, ticket)
+            raise
+        with self._lock:
+            if self._forget_load(key, ticket):
+                self._put(key, value)
+        return value
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._loads.pop(key, None)
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._loads.clear()
+            self.invalidations += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(
+                size=len(self._entries), hits=self.hits, misses=self.misses, evictions=self.evictions,
+                expirations=self.expirations, invalidations=self.invalidations,
+            )
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return _MISSING
+        expires, value = entry
+        if expires <= self.clock():
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return _MISSING
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def _put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self._entries[key] = (self.clock() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _forget_load(self, key, ticket) -> bool:
+        # False if the key was invalidated while it was being loaded
+        tickets = self._loads.get(key)
+        if tickets is None or ticket not in tickets:
+            return False
+        tickets.discard(ticket)
+        if not tickets:
+            del self._loads[key]
+        return True
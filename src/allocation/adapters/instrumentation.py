@@ -0,0 +1,90 @@
+import contextvars
+import functools
+import threading
+from collections import Counter
+from typing import Callable, Dict
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryCounter:
+    """
+    Counts the SQL statements run while a message is being handled, by
+    message type. Statements are attributed through a context variable, so
+    concurrent requests do not count each other's queries.
+    """
+
+    def __init__(self):
+        self.queries = Counter()  # type: Counter[str]
+        self.messages = Counter()  # type: Counter[str]
+        self._lock = threading.Lock()
+        self._current = contextvars.ContextVar(f"query-counter-{id(self)}", default=None)
+        self._target = None
+
+    def attach(self, target=Engine):
+        # listening on the Engine class counts statements from every engine
+        self._target = target
+        event.listen(target, "before_cursor_execute", self._count)
+        return self
+
+    def detach(self):
+        event.remove(self._target, "before_cursor_execute", self._count)
+        self._target = None
+
+    def counting(self, name: str, handler: Callable) -> Callable:
+        @functools.wraps(handler)
+        def counted(message):
+            count = [0]
+            token = self._current.set(count)
+            try:
+                return handler(message)
+            finally:
+                self._current.reset(token)
+                with self._lock:
+                    self.queries[name] += count[0]
+                    self.messages[name] += 1
+
+        return counted
+
+    def per_message(self) -> Dict[str, float]:
+        with self._lock:
+            return {name: self.queries[name] / n for name, n in self.messages.items()}
+
+    def reset(self):
+        with self._lock:
+            self.queries.clear()
+            self.messages.clear()
+
+    def _count(self, conn, cursor, statement, parameters, context, executemany):
+        count = self._current.get()
+        if count is not None:
+            count[0] += 1
+
+
+class ConflictMetrics:
+    """
+    Counts, per command type, how often a command was handled, how many
+    attempts that took and how many of those hit a concurrency conflict.
+    """
+
+    def __init__(self):
+        self.commands = Counter()  # type: Counter[str]
+        self.attempts = Counter()  # type: Counter[str]
+        self.conflicts = Counter()  # type: Counter[str]
+        self.gave_up = Counter()  # type: Counter[str]
+        self._lock = threading.Lock()
+
+    def record(self, name: str, attempts: int, conflicts: int, gave_up: bool):
+        with self._lock:
+            self.commands[name] += 1
+            self.attempts[name] += attempts
+            self.conflicts[name] += conflicts
+            self.gave_up[name] += gave_up
+
+    def retries(self, name: str) -> int:
+        return self.attempts[name] - self.commands[name]
+
+    def conflict_rate(self, name: str) -> float:
+        with self._lock:
+            return self.conflicts[name] / self.attempts[name] if self.attempts[name] else 0.0
@@ -1,6 +1,10 @@
-from sqlalchemy import MetaData, Table, Column, Integer, String, Date, ForeignKey, event
-from sqlalchemy.orm import relationship, registry
+import itertools
 
+from sqlalchemy import MetaData, Table, Column, Integer, String, Date, DateTime, Text, ForeignKey, Index, event, inspect
+from sqlalchemy.orm import relationship, registry, Session
+from sqlalchemy.orm.util import identity_key
+
+from allocation.adapters import read_model
 from allocation.domain import model
 
 mapper_registry = registry()
@@ -12,7 +16,8 @@ order_lines = Table(
     Column("id", Integer, primary_key=True, autoincrement=True),
     Column("sku", String(255)),
     Column("qty", Integer, nullable=False),
-    Column("orderid", String(255))
+    Column("orderid", String(255)),
+    Index("ix_order_lines_orderid", "orderid"),
 )
 
 products = Table(
@@ -29,7 +34,9 @@ batches = Table(
     Column("reference", String(255)),
     Column("sku", ForeignKey("products.sku")),
     Column("_purchased_quantity", Integer, nullable=False),
-    Column("eta", Date, nullable=True)
+    Column("eta", Date, nullable=True),
+    Index("ux_batches_reference", "reference", unique=True),
+    Index("ix_batches_sku", "sku"),
 )
 
 allocations = Table(
@@ -37,11 +44,55 @@ allocations = Table(
     mapper_registry.metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
     Column("orderline_id", ForeignKey("order_lines.id")),
-    Column("batch_id", ForeignKey("batches.id"))
+    Column("batch_id", ForeignKey("batches.id")),
+    Index("ux_allocations_orderline_batch", "orderline_id", "batch_id", unique=True),
+    Index("ix_allocations_batch_id", "batch_id"),
 )
 
+# the read model behind views.allocations, written by the units of work in
+# the transaction that allocates or deallocates, see read_model.record
+allocations_view = Table(
+    "allocations_view",
+    mapper_registry.metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("orderid", String(255), nullable=False),
+    Column("sku", String(255), nullable=False),
+    Column("qty", Integer, nullable=False),
+    Column("batchref", String(255), nullable=False),
+    Index("ix_allocations_view_orderid", "orderid"),
+)
+
+# events waiting to be published, written in the same transaction as the
+# change that raised them and drained by the outbox relay
+outbox = Table(
+    "outbox",
+    mapper_registry.metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("channel", String(255), nullable=False),
+    Column("payload", Text, nullable=False),
+    Column("created_at", DateTime, nullable=False),
+)
+
+
+def create_schema(engine):
+    # create_all skips tables that already exist, indexes included, so any
+    # index added since a table was created is made on its own; constraints
+    # are declared as unique indexes for the same reason
+    new_view = not inspect(engine).has_table(allocations_view.name)
+    mapper_registry.metadata.create_all(engine)
+    for table in mapper_registry.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+    if new_view:
+        # a database from before the read model starts it with the allocations it has
+        with engine.begin() as connection:
+            connection.execute(read_model.REBUILD_ALLOCATIONS)
+
 
 def start_mappers():
+    if mapper_registry.mappers:
+        # already mapped, e.g. when the sync and the async API share a process
+        return
     lines_mapper = mapper_registry.map_imperatively(
         model.OrderLine, order_lines
     )
@@ -49,8 +100,10 @@ def start_mappers():
         model.Batch,
         batches,
         properties={
+            # loaded in allocation order, see model.AllocatedLines
             "_allocations": relationship(
-                lines_mapper, secondary=allocations, collection_class=set
+                lines_mapper, secondary=allocations, collection_class=model.AllocatedLines,
+                order_by=allocations.c.id,
             )
         }
     )
@@ -69,6 +122,35 @@ def start_mappers():
 @event.listens_for(model.Product, "load")
 def receive_load(product, _):
     product.events = []
+    product._batch_order = None
+    product._line_index = None
+
+
+@event.listens_for(model.Batch, "load")
+def receive_batch_load(batch, _):
+    batch._allocated_quantity = None
+
 
+@event.listens_for(model.Batch, "expire")
+def receive_batch_expire(batch, _):
+    # expired allocations are reloaded from the database, so the running
+    # counter has to be rebuilt from them too
+    if batch is not None:
+        batch._allocated_quantity = None
 
 
+@event.listens_for(Session, "before_flush")
+def bump_product_versions(session, flush_context, instances):
+    # the version number guards the whole aggregate, but the ORM only bumps it
+    # when the products row itself changes, and not for a new batch, a
+    # deallocation or a changed quantity
+    skus = {
+        obj.sku for obj in itertools.chain(session.new, session.dirty)
+        if isinstance(obj, model.Batch) and session.is_modified(obj)
+    }
+    for sku in skus:
+        product = session.identity_map.get(identity_key(model.Product, sku))
+        if product is None or product in session.new:
+            continue
+        if not inspect(product).attrs.version_number.history.has_changes():
+            product.version_number += 1
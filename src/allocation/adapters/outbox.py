@@ -0,0 +1,85 @@
+import logging
+import threading
+from datetime import datetime
+from typing import Callable, Dict, Iterable, Type
+
+import redis
+from sqlalchemy import select, insert, delete, func
+from sqlalchemy.orm import Session
+
+from allocation.adapters import orm, redis_eventpublisher
+from allocation.domain import events
+
+logger = logging.getLogger(__name__)
+
+# the events that leave the service, and the channel each is published on
+CHANNELS: Dict[Type[events.Event], str] = {
+    events.Allocated: "line_allocated",
+}
+
+
+def record(session: Session, new_events: Iterable[events.Event], clock: Callable[[], datetime] = datetime.utcnow):
+    rows = [
+        dict(channel=CHANNELS[type(event)], payload=redis_eventpublisher.serialize(event).decode(), created_at=clock())
+        for event in new_events if type(event) in CHANNELS
+    ]
+    if rows:
+        session.execute(insert(orm.outbox), rows)
+
+
+class OutboxRelay:
+    """
+    Publishes the events units of work put in the outbox table, oldest first
+    and batch_size at a time through one Redis pipeline. A batch is deleted
+    only once Redis took all of it, so a relay that dies in between publishes
+    it again: delivery is at least once.
+    """
+
+    def __init__(
+            self, session_factory: Callable[[], Session], client: redis.Redis | None = None,
+            batch_size: int = 500, clock: Callable[[], datetime] = datetime.utcnow,
+    ):
+        self.session_factory = session_factory
+        self.client = client or redis_eventpublisher.default_client()
+        self.batch_size = batch_size
+        self.clock = clock
+        self.relayed = self.batches = 0
+        self.lag = self.max_lag = 0.0
+        self._lock = threading.Lock()
+
+    def relay_once(self) -> int:
+        session = self.session_factory()
+        try:
+            # with several relays, each one takes rows the others have not locked
+            rows = session.execute(
+                select(orm.outbox).order_by(orm.outbox.c.id).limit(self.batch_size).with_for_update(skip_locked=True)
+            ).all()
+            if not rows:
+                return 0
+            pipeline = self.client.pipeline(transaction=False)
+            for row in rows:
+                pipeline.publish(row.channel, row.payload)
+            pipeline.execute()
+            session.execute(delete(orm.outbox).where(orm.outbox.c.id.in_([row.id for row in rows])))
+            session.commit()
+        finally:
+            session.close()
+        # the oldest row has waited longest
+        lag = (self.clock() - rows[0].created_at).total_seconds()
+        with self._lock:
+            self.relayed += len(rows)
+            self.batches += 1
+            self.lag = lag
+            self.max_lag = max(self.max_lag, lag)
+        return len(rows)
+
+    def backlog(self) -> int:
+        session = self.session_factory()
+        try:
+            return session.execute(select(func.count()).select_from(orm.outbox)).scalar_one()
+        finally:
+            session.close()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(relayed=self.relayed, batches=self.batches, lag=self.lag, max_lag=self.max_lag)
@@ -0,0 +1,49 @@
+import itertools
+from typing import Iterable
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from allocation.domain import events
+
+ADD_ALLOCATION = text("""
+    INSERT INTO allocations_view (orderid, sku, qty, batchref)
+    VALUES (:orderid, :sku, :qty, :batchref)
+""")
+
+# (orderid, qty) identifies a line within its product, so this removes one row
+REMOVE_ALLOCATION = text("""
+    DELETE FROM allocations_view
+    WHERE orderid = :orderid AND sku = :sku AND qty = :qty AND batchref = :batchref
+""")
+
+CLEAR_ALLOCATIONS = text("DELETE FROM allocations_view")
+
+REBUILD_ALLOCATIONS = text("""
+    INSERT INTO allocations_view (orderid, sku, qty, batchref)
+    SELECT o.orderid, o.sku, o.qty, b.reference
+       FROM allocations as a
+       JOIN order_lines AS o ON o.id = a.orderline_id
+       JOIN batches AS b ON b.id = a.batch_id
+""")
+
+STATEMENTS = {
+    events.Allocated: ADD_ALLOCATION,
+    events.Deallocated: REMOVE_ALLOCATION,
+}
+
+
+def record(session: Session, new_events: Iterable[events.Event]):
+    # in the order they were raised, as a displaced line is deallocated before
+    # it is allocated again; runs of the same statement go in one executemany
+    rows = [
+        (STATEMENTS[type(event)], dict(orderid=event.orderid, sku=event.sku, qty=event.qty, batchref=event.batchref))
+        for event in new_events if type(event) in STATEMENTS
+    ]
+    for statement, run in itertools.groupby(rows, key=lambda row: row[0]):
+        session.execute(statement, [params for _, params in run])
+
+
+def rebuild(session: Session):
+    session.execute(CLEAR_ALLOCATIONS)
+    session.execute(REBUILD_ALLOCATIONS)
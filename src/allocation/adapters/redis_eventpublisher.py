@@ -1,15 +1,123 @@
+import functools
 import json
 import logging
+import threading
+import time
 from dataclasses import asdict
+from typing import Callable, List, Tuple
 
 import redis
 
 from allocation import config
 from allocation.domain import events
 
-r = redis.Redis(**config.get_redis_host_and_port())
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def default_client() -> redis.Redis:
+    # created on first use, like the database engine, so that importing the
+    # publisher neither sets up a pool nor shares one across forked workers
+    return redis.Redis(connection_pool=redis.ConnectionPool(
+        **config.get_redis_host_and_port(), **config.get_redis_pool_settings()
+    ))
+
+
+@functools.lru_cache(maxsize=None)
+def _orjson():
+    # imported on first publish, which most entrypoints never get to
+    try:
+        import orjson
+    except ImportError:  # pragma: no cover
+        return None
+    return orjson
+
+
+def serialize(event: events.Event) -> bytes:
+    orjson = _orjson()
+    if orjson is not None:
+        # orjson reads the dataclass fields itself, without asdict's deep copy
+        return orjson.dumps(event)
+    return json.dumps(asdict(event)).encode()
 
 
 def publish(channel, event: events.Event):
     logging.debug(f'publishing: channel={channel}, event={event}')
-    r.publish(channel, json.dumps(asdict(event)))
+    default_client().publish(channel, serialize(event))
+
+
+class BufferedPublisher:
+    """
+    A publish function that keeps events back and sends them through one
+    pipeline once max_events are waiting or the oldest has waited max_delay
+    seconds. The message bus flushes it at the end of every handle, so no
+    event waits for the next one. Events whose flush failed stay buffered,
+    ahead of any buffered since, and go out with the next flush.
+    """
+
+    def __init__(
+            self, client: redis.Redis | None = None, max_events: int = 100, max_delay: float = 0.05,
+            clock: Callable[[], float] = time.monotonic,
+    ):
+        self.client = client
+        self.max_events = max_events
+        self.max_delay = max_delay
+        self.clock = clock
+        self.published = self.flushes = 0
+        self._buffer = []  # type: List[Tuple[str, bytes]]
+        self._oldest = 0.0
+        self._lock = threading.Lock()
+
+    def __call__(self, channel: str, event: events.Event):
+        message = serialize(event)
+        with self._lock:
+            if not self._buffer:
+                self._oldest = self.clock()
+            self._buffer.append((channel, message))
+            full = len(self._buffer) >= self.max_events or self.clock() - self._oldest >= self.max_delay
+        if full:
+            try:
+                self.flush()
+            except redis.RedisError:
+                # not raised to the bus, which would retry the handler and
+                # buffer this event a second time
+                logger.exception("Failed to publish buffered events, they will go with the next flush")
+
+    def flush(self):
+        with self._lock:
+            buffered, self._buffer = self._buffer, []
+            oldest = self._oldest
+        if not buffered:
+            return
+        try:
+            pipeline = (self.client or default_client()).pipeline(transaction=False)
+            for channel, message in buffered:
+                pipeline.publish(channel, message)
+            pipeline.execute()
+        except Exception:
+            with self._lock:
+                self._buffer = buffered + self._buffer
+                self._oldest = oldest
+            raise
+        with self._lock:
+            self.published += len(buffered)
+            self.flushes += 1
+
+
+_async_client = None
+
+
+def _async_redis():
+    # the asyncio client binds its connections to the running loop, so it
+    # is only created once there is one
+    global _async_client
+    if _async_client is None:
+        import redis.asyncio
+
+        _async_client = redis.asyncio.Redis(**config.get_redis_host_and_port(), **config.get_redis_pool_settings())
+    return _async_client
+
+
+async def publish_async(channel, event: events.Event):
+    logging.debug(f'publishing: channel={channel}, event={event}')
+    await _async_redis().publish(channel, serialize(event))
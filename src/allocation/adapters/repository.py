@@ -1,10 +1,61 @@
 import abc
-from typing import Set
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Set, Callable, Dict, Iterable, List
 
-from sqlalchemy.orm import Session
+from sqlalchemy import select, insert, update
+from sqlalchemy.orm import Session, selectinload, contains_eager
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.sql import Select
 
 from allocation.adapters import orm
-from allocation.domain import model
+from allocation.domain import commands, model
+
+if TYPE_CHECKING:
+    # only the async service needs sqlalchemy's asyncio extension, which is slow to import
+    from sqlalchemy.ext.asyncio import AsyncSession
+
+
+# strategies for loading a product's batches and their allocations; each one
+# takes the select for the product and returns it with its loader options
+def load_lazily(statement: Select) -> Select:
+    # every batch's allocations are fetched when first touched: 1 + N queries
+    return statement
+
+
+def load_selectin(statement: Select) -> Select:
+    # one query for the products, one for their batches, one for all allocations
+    return statement.options(selectinload(model.Product.batches).selectinload(model.Batch._allocations))
+
+
+def load_in_one_query(statement: Select) -> Select:
+    # the joins are spelled out and their rows fed straight into the
+    # collections; joinedload would nest (allocations JOIN order_lines) inside
+    # the outer join, which sqlite materializes by scanning all allocations
+    return statement.outerjoin(
+        orm.batches, orm.batches.c.sku == orm.products.c.sku
+    ).outerjoin(
+        orm.allocations, orm.allocations.c.batch_id == orm.batches.c.id
+    ).outerjoin(
+        orm.order_lines, orm.order_lines.c.id == orm.allocations.c.orderline_id
+    ).options(
+        contains_eager(model.Product.batches).contains_eager(model.Batch._allocations)
+    ).order_by(
+        # the relationship's order_by does not apply to rows fed in this way
+        orm.allocations.c.id
+    )
+
+
+LOADING_STRATEGIES = {
+    "lazy": load_lazily,
+    "selectin": load_selectin,
+    "single_query": load_in_one_query,
+}
+
+# optimistic: concurrent writers are caught by the version number at commit;
+# pessimistic: the product row is locked (SELECT ... FOR UPDATE) when it is
+# read, so writers to the same product wait for each other instead
+LOCKING_STRATEGIES = ("optimistic", "pessimistic")
 
 
 class AbstractRepository(abc.ABC):
@@ -27,6 +78,13 @@ class AbstractRepository(abc.ABC):
             self.seen.add(product)
         return product
 
+    def add_batches(self, batches: List[commands.CreateBatch]) -> int:
+        """
+        Adds batches in bulk, creating the products they need, and returns
+        how many were added: a batch whose reference is known is skipped.
+        """
+        raise NotImplementedError
+
     def _add(self, product: model.Product):
         raise NotImplementedError
 
@@ -37,22 +95,200 @@ class AbstractRepository(abc.ABC):
         raise NotImplementedError
 
 
+class ProductCache:
+    """
+    Keeps detached products between units of work, keyed by sku.
+
+    A product is checked out, i.e. taken out of the cache, for the unit of
+    work that uses it and only checked back in once that has committed, so
+    no two sessions ever share one. It is handed out only if its version
+    number still matches the database's.
+    """
+
+    def __init__(self, maxsize: int = 1_000):
+        self.maxsize = maxsize
+        self.hits = self.misses = self.stale = self.evictions = 0
+        self._products = OrderedDict()  # type: OrderedDict[str, model.Product]
+        self._lock = threading.Lock()
+
+    def check_out(self, sku: str, version_number: int) -> model.Product | None:
+        with self._lock:
+            product = self._products.pop(sku, None)
+            if product is None:
+                self.misses += 1
+            elif product.version_number != version_number:
+                self.stale += 1
+                product = None
+            else:
+                self.hits += 1
+            return product
+
+    def check_in(self, products: Iterable[model.Product]):
+        with self._lock:
+            for product in products:
+                self._products[product.sku] = product
+                self._products.move_to_end(product.sku)
+            while len(self._products) > self.maxsize:
+                self._products.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(
+                size=len(self._products), hits=self.hits, misses=self.misses,
+                stale=self.stale, evictions=self.evictions,
+            )
+
+    def __len__(self):
+        return len(self._products)
+
+
 class SqlProductRepository(AbstractRepository):
-    def __init__(self, session: Session):
+    IN_SLICE = 500
+
+    def __init__(
+            self, session: Session, load: Callable[[Select], Select] = load_selectin,
+            cache: ProductCache | None = None, lock: bool = False,
+    ):
         super().__init__()
         self.session = session
+        self.load = load
+        self.cache = cache
+        self.lock = lock
 
     def _add(self, product):
         self.session.add(product)
 
+    def add_batches(self, batches):
+        # straight into the tables, with one executemany per table, instead
+        # of loading every product the batches belong to or even mapping them
+        known_refs = self._existing(orm.batches.c.reference, [batch.ref for batch in batches])
+        new = {}
+        for batch in batches:
+            if batch.ref not in known_refs:
+                new.setdefault(batch.ref, batch)
+        if not new:
+            return 0
+        new_batches = sorted(new.values(), key=lambda batch: batch.sku)
+        skus = list(dict.fromkeys(batch.sku for batch in new_batches))
+        known_skus = self._existing(orm.products.c.sku, skus)
+        if len(known_skus) < len(skus):
+            self.session.execute(
+                insert(orm.products), [dict(sku=sku, version_number=1) for sku in skus if sku not in known_skus]
+            )
+        if known_skus:
+            # cached and concurrently loaded products must see their new batches
+            self.session.execute(
+                update(orm.products).where(orm.products.c.sku.in_(known_skus))
+                .values(version_number=orm.products.c.version_number + 1)
+            )
+        self.session.execute(insert(orm.batches), [
+            dict(reference=batch.ref, sku=batch.sku, _purchased_quantity=batch.qty, eta=batch.eta)
+            for batch in new_batches
+        ])
+        return len(new_batches)
+
+    def _existing(self, column, values) -> Set[str]:
+        # in slices, to stay below the databases' limits on bound parameters
+        found = set()
+        for start in range(0, len(values), self.IN_SLICE):
+            found.update(self.session.execute(
+                select(column).where(column.in_(values[start:start + self.IN_SLICE]))
+            ).scalars())
+        return found
+
     def _get(self, sku):
-        return self.session.query(model.Product).filter_by(sku=sku).first()
+        return self._get_where(orm.products.c.sku == sku)
 
     def _get_by_batchref(self, ref):
-        return self.session.query(model.Product).join(model.Batch).filter(
-            orm.batches.c.reference == ref
-        ).first()
+        # a subquery rather than a join, so that eager loaders still get all
+        # of the product's batches and not just the one asked for
+        sku = select(orm.batches.c.sku).where(orm.batches.c.reference == ref).scalar_subquery()
+        return self._get_where(orm.products.c.sku == sku)
+
+    def _get_where(self, where):
+        if self.cache is not None:
+            # one row of the products table instead of the whole aggregate
+            row = self.session.execute(
+                self._locked(select(orm.products.c.sku, orm.products.c.version_number).where(where))
+            ).first()
+            if row is None:
+                return None
+            in_session = self.session.identity_map.get(identity_key(model.Product, row.sku))
+            if in_session is not None:
+                return in_session
+            product = self.cache.check_out(row.sku, row.version_number)
+            if product is not None:
+                self.session.add(product)
+                return product
+        return self._first(select(model.Product).where(where))
+
+    def _first(self, statement: Select):
+        return self.session.execute(self._locked(self.load(statement))).unique().scalars().first()
+
+    def _locked(self, statement: Select) -> Select:
+        # only the product row: postgres cannot lock the nullable side of the
+        # outer joins, and the product's version number guards its batches
+        return statement.with_for_update(of=orm.products) if self.lock else statement
+
+
+class AbstractAsyncRepository(abc.ABC):
+    def __init__(self):
+        self.seen = set()  # type: Set[model.Product]
+
+    def add(self, product: model.Product):
+        self._add(product)
+        self.seen.add(product)
+
+    async def get(self, sku) -> model.Product:
+        product = await self._get(sku)
+        if product:
+            self.seen.add(product)
+        return product
+
+    async def get_by_batchref(self, ref) -> model.Product | None:
+        product = await self._get_by_batchref(ref)
+        if product:
+            self.seen.add(product)
+        return product
+
+    def _add(self, product: model.Product):
+        raise NotImplementedError
+
+    async def _get(self, sku) -> model.Product:
+        raise NotImplementedError
+
+    async def _get_by_batchref(self, ref) -> model.Product | None:
+        raise NotImplementedError
+
+
+class AsyncSqlProductRepository(AbstractAsyncRepository):
+    def __init__(self, session: "AsyncSession"):
+        super().__init__()
+        self.session = session
+
+    @staticmethod
+    def _whole_aggregate():
+        # lazy loading would need IO outside of an await, so the batches and
+        # their allocations are loaded together with the product
+        return selectinload(model.Product.batches).selectinload(model.Batch._allocations)
+
+    def _add(self, product):
+        self.session.add(product)
+
+    async def _get(self, sku):
+        result = await self.session.execute(
+            select(model.Product).filter_by(sku=sku).options(self._whole_aggregate())
+        )
+        return result.scalars().first()
 
+    async def _get_by_batchref(self, ref):
+        result = await self.session.execute(
+            select(model.Product).join(model.Batch).filter(
+                orm.batches.c.reference == ref
+            ).options(self._whole_aggregate())
+        )
+        return result.scalars().first()
 
 
 # class TrackingRepository(ProductRepositoryProtocol):
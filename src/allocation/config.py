@@ -9,6 +9,33 @@ def get_postgres_uri():
     return f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
 
 
+def get_postgres_pool_settings():
+    # the default pool allows 40 connections, one for each of the 40 threads
+    # uvicorn gives to sync endpoints, so requests never wait for a connection
+    return dict(
+        pool_size=int(os.environ.get("DB_POOL_SIZE", 20)),
+        max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", 20)),
+        pool_timeout=float(os.environ.get("DB_POOL_TIMEOUT", 30)),
+        pool_recycle=int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+        pool_pre_ping=True,
+    )
+
+
+def get_async_postgres_uri():
+    return get_postgres_uri().replace("postgresql://", "postgresql+asyncpg://", 1)
+
+
+def get_allocations_cache_settings():
+    return dict(
+        maxsize=int(os.environ.get("ALLOCATIONS_CACHE_SIZE", 10_000)),
+        ttl=float(os.environ.get("ALLOCATIONS_CACHE_TTL", 30)),
+    )
+
+
+def get_product_locking():
+    return os.environ.get("PRODUCT_LOCKING", "optimistic")
+
+
 def get_api_url():
     host = os.environ.get("API_HOST", "localhost")
     port = 5000 if host == "localhost" else 80
@@ -19,3 +46,12 @@ def get_redis_host_and_port():
     host = os.environ.get("REDIS_HOST", "localhost")
     port = 6379
     return dict(host=host, port=port)
+
+
+def get_redis_pool_settings():
+    return dict(
+        max_connections=int(os.environ.get("REDIS_MAX_CONNECTIONS", 50)),
+        socket_timeout=float(os.environ.get("REDIS_SOCKET_TIMEOUT", 5)),
+        socket_connect_timeout=float(os.environ.get("REDIS_CONNECT_TIMEOUT", 5)),
+        health_check_interval=int(os.environ.get("REDIS_HEALTH_CHECK_INTERVAL", 30)),
+    )
@@ -1,5 +1,6 @@
 from pydantic.dataclasses import dataclass
 from datetime import date
+from typing import List
 
 
 class Command:
@@ -14,6 +15,11 @@ class CreateBatch(Command):
     eta: date | None
 
 
+@dataclass
+class CreateBatches(Command):
+    batches: List[CreateBatch]
+
+
 @dataclass
 class Allocate(Command):
     orderid: str
@@ -21,6 +27,18 @@ class Allocate(Command):
     qty: int
 
 
+@dataclass
+class AllocationLine:
+    orderid: str
+    qty: int
+
+
+@dataclass
+class AllocateMany(Command):
+    sku: str
+    lines: List[AllocationLine]
+
+
 @dataclass
 class DeAllocate(Command):
     orderid: str
@@ -32,3 +50,13 @@ class DeAllocate(Command):
 class ChangeBatchQuantity(Command):
     ref: str
     qty: int
+
+
+@dataclass
+class ChangeBatchQuantities(Command):
+    changes: List[ChangeBatchQuantity]
+
+
+@dataclass
+class RebuildAllocationsView(Command):
+    pass
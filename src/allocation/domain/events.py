@@ -17,3 +17,11 @@ class Allocated(Event):
     sku: str
     qty: int
     batchref: str
+
+
+@dataclass
+class Deallocated(Event):
+    orderid: str
+    sku: str
+    qty: int
+    batchref: str
@@ -1,6 +1,11 @@
+import bisect
+import functools
+import operator
+import sys
+from array import array
 from dataclasses import dataclass
 from datetime import date
-from typing import Optional, List
+from typing import Optional, List, Dict, Iterable, Iterator, Tuple, Callable
 
 from allocation.domain import events, commands
 
@@ -9,31 +14,170 @@ class NotAllocated(Exception):
     pass
 
 
+class InconsistentAllocation(Exception):
+    pass
+
+
 @dataclass(unsafe_hash=True)
 class OrderLine:
     orderid: str
     sku: str
     qty: int
 
+    def __post_init__(self):
+        # lines of the same order and sku share one string object, which keeps
+        # them small and makes equality checks an identity comparison
+        self.orderid = sys.intern(self.orderid)
+        self.sku = sys.intern(self.sku)
+
+
+class CompactAllocations:
+    """
+    Set-like store for the order lines of a single batch.
+
+    Lines are kept column-wise, as a list of interned order ids and an array of
+    quantities, instead of as one OrderLine object per allocation. OrderLines are
+    only materialised when they are handed out by pop() or iteration. The rare
+    second line for an order id that is already stored goes to a plain set.
+    """
+    __slots__ = ("sku", "_orderids", "_qtys", "_rows", "_overflow")
+
+    def __init__(self, sku: str, lines: Iterable[OrderLine] = ()):
+        self.sku = sys.intern(sku)
+        self._orderids: List[str] = []
+        self._qtys = array("q")
+        self._rows: Dict[str, int] = {}
+        self._overflow: set = set()
+        for line in lines:
+            self.add(line)
+
+    def add(self, line: OrderLine):
+        if line in self:
+            return
+        if line.orderid in self._rows:
+            self._overflow.add(line)
+            return
+        self._rows[line.orderid] = len(self._orderids)
+        self._orderids.append(line.orderid)
+        self._qtys.append(line.qty)
+
+    def discard(self, line: OrderLine):
+        row = self._rows.get(line.orderid)
+        if row is not None and self._qtys[row] == line.qty and line.sku == self.sku:
+            self._remove_row(row)
+        else:
+            self._overflow.discard(line)
+
+    def pop(self) -> OrderLine:
+        if self._overflow:
+            return self._overflow.pop()
+        if not self._orderids:
+            raise KeyError("pop from an empty set")
+        line = OrderLine(self._orderids[-1], self.sku, self._qtys[-1])
+        self._remove_row(len(self._orderids) - 1)
+        return line
+
+    def _remove_row(self, row: int):
+        # swap the last row into the gap so removal stays O(1)
+        del self._rows[self._orderids[row]]
+        last = len(self._orderids) - 1
+        if row != last:
+            self._orderids[row] = self._orderids[last]
+            self._qtys[row] = self._qtys[last]
+            self._rows[self._orderids[row]] = row
+        self._orderids.pop()
+        self._qtys.pop()
+
+    def __contains__(self, line: OrderLine) -> bool:
+        row = self._rows.get(line.orderid)
+        if row is not None and self._qtys[row] == line.qty and line.sku == self.sku:
+            return True
+        return bool(self._overflow) and line in self._overflow
+
+    def __iter__(self) -> Iterator[OrderLine]:
+        for orderid, qty in zip(self._orderids, self._qtys):
+            yield OrderLine(orderid, self.sku, qty)
+        yield from self._overflow
+
+    def __len__(self) -> int:
+        return len(self._orderids) + len(self._overflow)
+
+
+class AllocatedLines:
+    """
+    The order lines allocated to a batch: a set that iterates in the order
+    the lines were allocated in. The ORM loads it ordered by allocations.id,
+    so the order survives a reload, which the fifo displacement relies on.
+    """
+    __emulates__ = set
+
+    def __init__(self, lines: Iterable[OrderLine] = ()):
+        self._lines = dict.fromkeys(lines)  # type: Dict[OrderLine, None]
 
+    def add(self, line: OrderLine):
+        self._lines[line] = None
+
+    def discard(self, line: OrderLine):
+        self._lines.pop(line, None)
+
+    def remove(self, line: OrderLine):
+        del self._lines[line]
+
+    def pop(self) -> OrderLine:
+        # the latest allocation, as good a line to give up as any
+        return self._lines.popitem()[0]
+
+    def clear(self):
+        self._lines.clear()
+
+    def __contains__(self, line: OrderLine) -> bool:
+        return line in self._lines
+
+    def __iter__(self) -> Iterator[OrderLine]:
+        return iter(self._lines)
+
+    def __len__(self) -> int:
+        return len(self._lines)
+
+    def __eq__(self, other):
+        if isinstance(other, AllocatedLines):
+            return self._lines.keys() == other._lines.keys()
+        if isinstance(other, (set, frozenset)):
+            return self._lines.keys() == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"AllocatedLines({list(self._lines)!r})"
+
+
+@functools.total_ordering
 class Batch:
     def __init__(
-            self, reference: str, sku: str, qty: int, eta: Optional[date]) -> None:
+            self, reference: str, sku: str, qty: int, eta: Optional[date], compact: bool = False) -> None:
         self.eta = eta
         self._purchased_quantity = qty
         self.sku = sku
         self.reference = reference
-        self._allocations = set()
+        self._allocations = CompactAllocations(sku) if compact else AllocatedLines()
+        self._allocated_quantity = 0
 
     def allocate(self, line):
-        if self.can_allocate(line):
+        if self.can_allocate(line) and line not in self._allocations:
+            self._allocated_quantity = self.allocated_quantity + line.qty
             self._allocations.add(line)
 
     def deallocate(self, line):
-        self._allocations.discard(line)
+        if line in self._allocations:
+            self._allocated_quantity = self.allocated_quantity - line.qty
+            self._allocations.discard(line)
 
     def deallocate_one(self) -> OrderLine:
-        return self._allocations.pop()
+        allocated = self.allocated_quantity
+        line = self._allocations.pop()
+        self._allocated_quantity = allocated - line.qty
+        return line
 
     def can_allocate(self, line: OrderLine):
         return self.sku == line.sku and self.available_quantity >= line.qty
@@ -47,7 +191,19 @@ class Batch:
 
     @property
     def allocated_quantity(self):
-        return sum(a.qty for a in self._allocations)
+        # the ORM bypasses __init__, so after a load the counter is rebuilt
+        # from the allocations once and then kept up to date incrementally
+        if self._allocated_quantity is None:
+            self._allocated_quantity = sum(a.qty for a in self._allocations)
+        return self._allocated_quantity
+
+    def check_allocated_quantity(self):
+        expected = sum(a.qty for a in self._allocations)
+        if self.allocated_quantity != expected:
+            raise InconsistentAllocation(
+                f"Batch {self.reference} tracks {self.allocated_quantity} allocated, "
+                f"but its allocations add up to {expected}"
+            )
 
     def __eq__(self, other):
         if not isinstance(other, Batch):
@@ -57,57 +213,196 @@ class Batch:
     def __hash__(self):
         return hash(self.reference)
 
-    def __gt__(self, other):
-        if self.eta is None:
-            return False
-        if other.eta is None:
-            return True
-        return self.eta > other.eta
+    @property
+    def allocation_key(self):
+        # in-stock batches first, then shipments by ETA, ties broken by reference
+        return self.eta is not None, self.eta or date.min, self.reference
 
-    def __le__(self, other):
-        if self.eta is None:
-            return True
-        if other.eta is None:
-            return False
-        return self.eta < other.eta
+    def __lt__(self, other):
+        if not isinstance(other, Batch):
+            return NotImplemented
+        return self.allocation_key < other.allocation_key
 
     def __repr__(self):
         return f"<Batch {self.reference}>"
 
 
+_allocation_key = operator.attrgetter("allocation_key")
+_qty = operator.attrgetter("qty")
+
+DisplacementStrategy = Callable[[List[OrderLine], int], List[OrderLine]]
+
+
+def displace_oldest_first(lines: List[OrderLine], shortfall: int) -> List[OrderLine]:
+    displaced = []
+    for line in lines:
+        if shortfall <= 0:
+            break
+        displaced.append(line)
+        shortfall -= line.qty
+    return displaced
+
+
+def displace_fewest_lines(lines: List[OrderLine], shortfall: int) -> List[OrderLine]:
+    # the k largest lines free the most stock any k lines can
+    return displace_oldest_first(sorted(lines, key=_qty, reverse=True), shortfall)
+
+
+def displace_closest_fit(lines: List[OrderLine], shortfall: int) -> List[OrderLine]:
+    # take the smallest line that covers the shortfall on its own, or the
+    # largest line if none does, and repeat for whatever is left
+    remaining = sorted(lines, key=_qty)
+    displaced = []
+    while shortfall > 0 and remaining:
+        i = bisect.bisect_left(remaining, shortfall, key=_qty)
+        line = remaining.pop(i if i < len(remaining) else -1)
+        displaced.append(line)
+        shortfall -= line.qty
+    return displaced
+
+
+DISPLACEMENT_STRATEGIES: Dict[str, DisplacementStrategy | None] = {
+    "arbitrary": None,
+    "fifo": displace_oldest_first,
+    "fewest_lines": displace_fewest_lines,
+    "closest_fit": displace_closest_fit,
+}
+
+
+@dataclass(frozen=True)
+class ReallocationPolicy:
+    # None keeps popping arbitrary lines off the batch until it fits
+    displace: DisplacementStrategy | None = None
+
+
+def _line_key(line: OrderLine) -> Tuple[str, int]:
+    return line.orderid, line.qty
+
+
 class Product:
     def __init__(self, sku: str, batches: List[Batch], version_number=0):
         self.sku = sku
         self.batches = batches
         self.version_number = version_number
         self.events: List[events.Event | commands.Command] = []
+        self._batch_order: List[Batch] | None = None
+        self._line_index: Dict[Tuple[str, int], Batch] | None = None
+
+    @property
+    def ordered_batches(self) -> List[Batch]:
+        # rebuilt lazily after an ORM load, or if batches were appended directly
+        if self._batch_order is None or len(self._batch_order) != len(self.batches):
+            self._batch_order = sorted(self.batches, key=_allocation_key)
+        return self._batch_order
+
+    def add_batch(self, batch: Batch):
+        self.batches.append(batch)
+        if self._batch_order is not None:
+            bisect.insort(self._batch_order, batch, key=_allocation_key)
+
+    def change_batch_eta(self, ref: str, eta: Optional[date]):
+        batch = next(b for b in self.batches if b.reference == ref)
+        ordered = self.ordered_batches
+        del ordered[bisect.bisect_left(ordered, batch.allocation_key, key=_allocation_key)]
+        batch.eta = eta
+        bisect.insort(ordered, batch, key=_allocation_key)
+
+    @property
+    def allocated_lines(self) -> Dict[Tuple[str, int], Batch]:
+        # keyed by (orderid, qty) rather than by OrderLine, so that the index
+        # does not keep a line object alive for every allocation; rebuilt
+        # lazily after an ORM load
+        if self._line_index is None:
+            self._line_index = self._index_lines()
+        return self._line_index
+
+    def _index_lines(self) -> Dict[Tuple[str, int], Batch]:
+        return {
+            _line_key(line): batch for batch in self.batches for line in batch._allocations
+        }
+
+    def is_allocated(self, line: OrderLine) -> bool:
+        return line.sku == self.sku and _line_key(line) in self.allocated_lines
 
     def allocate(self, line: OrderLine) -> str | None:
-        try:
-            batch = next(batch for batch in sorted(self.batches) if batch.can_allocate(line))
-            batch.allocate(line)
+        batch_ref = self._allocate(line, self.ordered_batches, 0)
+        if batch_ref is not None:
             self.version_number += 1
-            self.events.append(events.Allocated(
-                orderid=line.orderid, sku=line.sku, qty=line.qty, batchref=batch.reference
-            ))
-            return batch.reference
-        except StopIteration:
-            self.events.append(events.OutOfStock(line.sku))
-            return None
+        return batch_ref
+
+    def allocate_many(self, lines: List[OrderLine]) -> List[str | None]:
+        ordered = self.ordered_batches
+        first_with_stock = 0
+        batch_refs = []
+        for line in lines:
+            # batches are only ever filled up in here, so once the leading
+            # batches are exhausted they can be skipped for every later line
+            while first_with_stock < len(ordered) and ordered[first_with_stock].available_quantity <= 0:
+                first_with_stock += 1
+            batch_refs.append(self._allocate(line, ordered, first_with_stock))
+        if any(ref is not None for ref in batch_refs):
+            self.version_number += 1
+        return batch_refs
+
+    def _allocate(self, line: OrderLine, ordered: List[Batch], start: int) -> str | None:
+        for i in range(start, len(ordered)):
+            batch = ordered[i]
+            if batch.can_allocate(line):
+                batch.allocate(line)
+                self.allocated_lines[_line_key(line)] = batch
+                self.events.append(events.Allocated(
+                    orderid=line.orderid, sku=line.sku, qty=line.qty, batchref=batch.reference
+                ))
+                return batch.reference
+        self.events.append(events.OutOfStock(line.sku))
+        return None
 
     def deallocate(self, line: OrderLine) -> str:
-        try:
-            batch = next(batch for batch in self.batches if batch.is_allocated_to(line))
-            batch.deallocate(line)
-            return batch.reference
-        except StopIteration:
+        if not self.is_allocated(line):
             raise NotAllocated(f"Not allocated to any batch")
+        batch = self.allocated_lines.pop(_line_key(line))
+        batch.deallocate(line)
+        self.events.append(events.Deallocated(
+            orderid=line.orderid, sku=line.sku, qty=line.qty, batchref=batch.reference
+        ))
+        return batch.reference
+
+    def check_consistency(self):
+        for batch in self.batches:
+            batch.check_allocated_quantity()
+        if self.ordered_batches != sorted(self.batches, key=_allocation_key):
+            raise InconsistentAllocation(f"Batch order of {self.sku} is out of date")
+        if self.allocated_lines != self._index_lines():
+            raise InconsistentAllocation(f"Order line index of {self.sku} is out of date")
 
-    def change_batch_quantity(self, ref: str, qty: int):
+    def change_batch_quantity(
+            self, ref: str, qty: int, reallocation: ReallocationPolicy = ReallocationPolicy()
+    ):
         batch = next(b for b in self.batches if b.reference == ref)
         batch._purchased_quantity = qty
-        while batch.available_quantity < 0:
-            line = batch.deallocate_one()
+        if batch.available_quantity >= 0:
+            return
+        if reallocation.displace is None:
+            displaced = []
+            while batch.available_quantity < 0:
+                displaced.append(batch.deallocate_one())
+        else:
+            # a batch's lines are indexed in the order they were allocated in,
+            # also after a reload (see AllocatedLines); the strategies rely on it
+            candidates = [
+                OrderLine(orderid, self.sku, line_qty)
+                for (orderid, line_qty), b in self.allocated_lines.items() if b is batch
+            ]
+            displaced = reallocation.displace(candidates, -batch.available_quantity)
+            for line in displaced:
+                batch.deallocate(line)
+        for line in displaced:
+            self.allocated_lines.pop(_line_key(line), None)
+            self.events.append(events.Deallocated(
+                orderid=line.orderid, sku=line.sku, qty=line.qty, batchref=batch.reference
+            ))
+        # with bootstrap's default cascade these are reallocated before the change commits
+        for line in displaced:
             self.events.append(
                 commands.Allocate(line.orderid, line.sku, line.qty)
             )
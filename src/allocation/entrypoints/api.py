@@ -1,17 +1,15 @@
-from dataclasses import replace
-from datetime import datetime
-
-import uvicorn
 from fastapi import FastAPI, status, HTTPException
-from flask import request, jsonify
 
-from allocation.domain.commands import CreateBatch, Allocate, DeAllocate
+from allocation.domain.commands import CreateBatch, Allocate, AllocateMany, DeAllocate
 import bootstrap
 from allocation import views, config
+from allocation.adapters.cache import LRUCache
 from allocation.service_layer.handlers import InvalidSku
+from allocation.service_layer.unit_of_work import ConcurrencyConflict, SqlAlchemyUnitOfWork
 
 app = FastAPI()
-bus = bootstrap.bootstrap()
+allocations_cache = LRUCache(**config.get_allocations_cache_settings())
+bus = bootstrap.bootstrap(uow=SqlAlchemyUnitOfWork(outbox=True), allocations_cache=allocations_cache)
 
 
 @app.post("/add_batch", status_code=status.HTTP_201_CREATED)
@@ -25,6 +23,18 @@ def batch_allocate_endpoint(allocate: Allocate):
         bus.handle(allocate)
     except InvalidSku as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except ConcurrencyConflict as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+
+
+@app.post("/allocate/bulk", status_code=status.HTTP_201_CREATED)
+def batch_allocate_many_endpoint(allocate_many: AllocateMany):
+    try:
+        bus.handle(allocate_many)
+    except InvalidSku as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except ConcurrencyConflict as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
 
 
 @app.post("/deallocate", status_code=status.HTTP_204_NO_CONTENT)
@@ -33,15 +43,20 @@ def batch_deallocate_endpoint(deallocate: DeAllocate):
         bus.handle(deallocate)
     except InvalidSku as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except ConcurrencyConflict as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
 
 
 @app.get("/allocations/{orderid}")
 def allocations_view_endpoint(orderid: str):
-    result = views.allocations(orderid, bus.uow)
+    result = views.allocations(orderid, bus.uow, allocations_cache)
     if not result:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="orderid not found")
     return result
 
 
 if __name__ == "__main__":
+    # a server that imports this module has its own already
+    import uvicorn
+
     uvicorn.run(app, host="0.0.0.0", port=5000)
@@ -0,0 +1,53 @@
+from fastapi import FastAPI, status, HTTPException
+
+import bootstrap
+from allocation import views
+from allocation.domain.commands import CreateBatch, Allocate, AllocateMany, DeAllocate
+from allocation.service_layer.handlers import InvalidSku
+
+app = FastAPI()
+bus = bootstrap.bootstrap_async()
+
+
+@app.post("/add_batch", status_code=status.HTTP_201_CREATED)
+async def batch_add_endpoint(create_batch: CreateBatch):
+    await bus.handle(create_batch)
+
+
+@app.post("/allocate", status_code=status.HTTP_201_CREATED)
+async def batch_allocate_endpoint(allocate: Allocate):
+    try:
+        await bus.handle(allocate)
+    except InvalidSku as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+
+@app.post("/allocate/bulk", status_code=status.HTTP_201_CREATED)
+async def batch_allocate_many_endpoint(allocate_many: AllocateMany):
+    try:
+        await bus.handle(allocate_many)
+    except InvalidSku as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+
+@app.post("/deallocate", status_code=status.HTTP_204_NO_CONTENT)
+async def batch_deallocate_endpoint(deallocate: DeAllocate):
+    try:
+        await bus.handle(deallocate)
+    except InvalidSku as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+
+@app.get("/allocations/{orderid}")
+async def allocations_view_endpoint(orderid: str):
+    result = await views.allocations_async(orderid, bus.uow)
+    if not result:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="orderid not found")
+    return result
+
+
+if __name__ == "__main__":
+    # a server that imports this module has its own already
+    import uvicorn
+
+    uvicorn.run(app, host="0.0.0.0", port=5000)
@@ -0,0 +1,101 @@
+import argparse
+import csv
+import itertools
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator, Dict, Iterable, List
+
+import bootstrap
+from allocation.domain import commands
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 5_000
+
+
+@dataclass
+class LoadReport:
+    rows: int
+    resumed_from: int
+    seconds: float
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+def read_rows(path: Path) -> Iterator[Dict[str, str]]:
+    # a csv file with a header of ref,sku,qty,eta or json lines with those keys
+    with open(path, newline="") as f:
+        if path.suffix == ".csv":
+            yield from csv.DictReader(f)
+        else:
+            yield from (json.loads(line) for line in f if line.strip())
+
+
+def to_command(row: Dict[str, str]) -> commands.CreateBatch:
+    return commands.CreateBatch(ref=row["ref"], sku=row["sku"], qty=row["qty"], eta=row.get("eta") or None)
+
+
+def chunked(rows: Iterable, size: int) -> Iterator[List]:
+    rows = iter(rows)
+    while chunk := list(itertools.islice(rows, size)):
+        yield chunk
+
+
+def read_checkpoint(checkpoint: Path, source: Path) -> int:
+    if not checkpoint.exists():
+        return 0
+    saved = json.loads(checkpoint.read_text())
+    if saved["source"] != str(source.resolve()):
+        raise ValueError(f"{checkpoint} is a checkpoint for {saved['source']}, not {source}")
+    return saved["rows"]
+
+
+def write_checkpoint(checkpoint: Path, source: Path, rows: int):
+    # written next to the old one and renamed over it, so a crash leaves
+    # either checkpoint intact
+    partial = checkpoint.with_name(checkpoint.name + ".tmp")
+    partial.write_text(json.dumps(dict(source=str(source.resolve()), rows=rows)))
+    os.replace(partial, checkpoint)
+
+
+def load(path: Path, bus, chunk_size: int = CHUNK_SIZE, checkpoint: Path | None = None) -> LoadReport:
+    """
+    Sends the file's batches to the bus as CreateBatches commands of
+    chunk_size rows, each one its own transaction. With a checkpoint, the
+    rows of every committed chunk are recorded, and a load that failed
+    carries on after the last of them when it is run again.
+    """
+    done = read_checkpoint(checkpoint, path) if checkpoint else 0
+    resumed_from, start = done, time.perf_counter()
+    for chunk in chunked(itertools.islice(read_rows(path), done, None), chunk_size):
+        bus.handle(commands.CreateBatches([to_command(row) for row in chunk]))
+        done += len(chunk)
+        if checkpoint:
+            write_checkpoint(checkpoint, path, done)
+        elapsed = time.perf_counter() - start
+        logger.info("%s rows loaded, %.0f rows/s", done, (done - resumed_from) / elapsed)
+    if checkpoint:
+        checkpoint.unlink(missing_ok=True)
+    return LoadReport(done - resumed_from, resumed_from, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load stock batches from a .csv or .jsonl file")
+    parser.add_argument("path", type=Path)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--checkpoint", type=Path, help="resume from and record progress in this file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    report = load(args.path, bootstrap.bootstrap(), args.chunk_size, args.checkpoint)
+    print(f"loaded {report.rows} rows in {report.seconds:.1f}s, {report.rows_per_second:.0f} rows/s"
+          + (f" (resumed after row {report.resumed_from})" if report.resumed_from else ""))
+
+
+if __name__ == "__main__":
+    main()
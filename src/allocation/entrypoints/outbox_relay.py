@@ -0,0 +1,27 @@
+import logging
+import time
+
+from allocation.adapters import outbox
+from allocation.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.1
+REPORT_INTERVAL = 60
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    relay = outbox.OutboxRelay(unit_of_work.default_session_factory())
+    reported = time.monotonic()
+    while True:
+        # a full batch means there is probably more waiting
+        if relay.relay_once() < relay.batch_size:
+            time.sleep(POLL_INTERVAL)
+        if time.monotonic() - reported > REPORT_INTERVAL:
+            logger.info("outbox relay %s, backlog %s", relay.stats(), relay.backlog())
+            reported = time.monotonic()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,251 @@
 import json
 import logging
+import os
+import socket
+import threading
+import time
+import zlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
 
 import redis
 
 import bootstrap
-from allocation import config
-from allocation.adapters import orm
+from allocation import views
+from allocation.adapters import redis_eventpublisher
 from allocation.domain import commands
+from allocation.service_layer import unit_of_work
 
-r = redis.Redis(**config.get_redis_host_and_port())
+logger = logging.getLogger(__name__)
 
+STREAM = "change_batch_quantity"
+GROUP = "allocation"
 
-def handle_change_batch_quantity(m, bus):
-    logging.debug(f'handling {m}')
-    data = json.loads(m['data'])
-    cmd = commands.ChangeBatchQuantity(
-        ref=data['batchref'],
-        qty=data['qty']
-    )
-    bus.handle(cmd)
+Entry = Tuple[bytes, Dict[bytes, bytes]]
+# the commands a worker handles, with the ids of the entries each one covers
+Work = List[Tuple[List[bytes], commands.Command]]
 
 
-def main():
-    bus = bootstrap.bootstrap()
-    pubsub = r.pubsub(ignore_subscribe_messages=True)
-    pubsub.subscribe('change_batch_quantity')
+def to_command(fields: Dict[bytes, bytes]) -> commands.ChangeBatchQuantity:
+    data = json.loads(fields[b"data"])
+    return commands.ChangeBatchQuantity(ref=data["batchref"], qty=data["qty"])
+
+
+def _entry_key(entry_id: bytes) -> Tuple[int, int]:
+    ms, _, seq = entry_id.partition(b"-")
+    return int(ms), int(seq or 0)
+
+
+class StreamConsumer:
+    """
+    Reads ChangeBatchQuantity messages from a Redis stream as one consumer of
+    a consumer group, batch_size at a time, and handles them on workers
+    threads. Messages for one batch reference always go to the same worker,
+    in order. A message is acknowledged once its command has committed;
+    one that failed, or whose consumer died, stays pending and is claimed
+    again after claim_idle_ms.
+
+    Newer changes to the batch may have been applied by then. So the id of
+    the last entry applied for each batch reference is kept in the
+    <stream>:applied hash, and an entry no newer than that is acknowledged
+    as superseded instead of being applied. The check comes before a change
+    and the record after it, so only a reclaim that races with a newer
+    change to the same batch can still slip through.
+
+    With coalesce, only the last change to each batch within a window of up
+    to window_size messages or window_ms is applied, and the changes to one
+    product's batches in a single transaction; transactions_saved counts the
+    transactions, each reloading a product, that this avoids.
+    """
+
+    def __init__(
+            self, client: redis.Redis, bus, stream: str = STREAM, group: str = GROUP, consumer: str | None = None,
+            workers: int = 4, batch_size: int = 100, block_ms: int = 1_000, claim_idle_ms: int = 30_000,
+            coalesce: bool = True, window_size: int = 1_000, window_ms: int = 50,
+    ):
+        self.client = client
+        self.bus = bus
+        self.stream = stream
+        self.group = group
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.workers = workers
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self.coalesce = coalesce
+        self.window_size = window_size
+        self.window_ms = window_ms
+        self.applied_key = f"{stream}:applied"
+        self.consumed = self.acked = self.failed = self.reclaimed = self.malformed = self.collapsed = 0
+        self.superseded = self.transactions_saved = 0
+        self.lag = 0.0
+        self._started = time.monotonic()
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="stream-worker")
+
+    def create_group(self):
+        # from the start of the stream, so nothing sent before the first
+        # consumer came up is missed
+        try:
+            self.client.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def read(self, block_ms: int | None = None) -> List[Entry]:
+        response = self.client.xreadgroup(
+            self.group, self.consumer, {self.stream: ">"}, count=self.batch_size,
+            block=self.block_ms if block_ms is None else block_ms,
+        )
+        return response[0][1] if response else []
+
+    def read_window(self) -> List[Entry]:
+        # waits for a first message as read does, then gathers more until the
+        # window is full or has been open for window_ms
+        entries = self.read()
+        closes = time.monotonic() + self.window_ms / 1000
+        while entries and len(entries) < self.window_size and (remaining := closes - time.monotonic()) > 0:
+            more = self.read(block_ms=max(1, int(remaining * 1000)))
+            if not more:
+                break
+            entries += more
+        return entries
+
+    def reclaim(self) -> List[Entry]:
+        _, entries, *_ = self.client.xautoclaim(
+            self.stream, self.group, self.consumer, self.claim_idle_ms, count=self.batch_size,
+        )
+        self.reclaimed += len(entries)
+        return entries
+
+    def process(self, entries: List[Entry]) -> int:
+        changes, malformed = [], []
+        for entry_id, fields in entries:
+            try:
+                changes.append(([entry_id], to_command(fields)))
+            except (KeyError, ValueError):
+                # acknowledged all the same, as no retry would make it readable
+                logger.exception("Dropping malformed message %s %s", entry_id, fields)
+                malformed.append(entry_id)
+        changes, superseded = self._drop_superseded(changes)
+        refs = {entry_ids[0]: change.ref for entry_ids, change in changes}
+        partitions = self._coalesced(changes) if self.coalesce else self._by_ref(changes)
+        done = [entry_id for handled in self._pool.map(self._handle, partitions) for entry_id in handled]
+        self._record_applied(done, refs)
+        self.malformed += len(malformed)
+        self.superseded += len(superseded)
+        done += malformed + superseded
+        if done:
+            self.client.xack(self.stream, self.group, *done)
+        self.consumed += len(entries)
+        self.acked += len(done)
+        self.failed += len(entries) - len(done)
+        if entries:
+            # entry ids start with the time in ms they were added at
+            self.lag = time.time() - int(entries[-1][0].split(b"-")[0]) / 1000
+        return len(done)
 
-    for m in pubsub.listen():
-        handle_change_batch_quantity(m, bus)
+    def _drop_superseded(self, changes: Work) -> Tuple[Work, List[bytes]]:
+        refs = list({change.ref for _, change in changes})
+        if not refs:
+            return changes, []
+        applied = dict(zip(refs, self.client.hmget(self.applied_key, refs)))
+        fresh, superseded = [], []
+        for entry_ids, change in changes:
+            last = applied[change.ref]
+            if last is not None and _entry_key(entry_ids[0]) <= _entry_key(last):
+                superseded.append(entry_ids[0])
+            else:
+                fresh.append((entry_ids, change))
+        return fresh, superseded
+
+    def _record_applied(self, done: List[bytes], refs: Dict[bytes, str]):
+        latest = {}
+        for entry_id in done:
+            ref = refs[entry_id]
+            if ref not in latest or _entry_key(entry_id) > _entry_key(latest[ref]):
+                latest[ref] = entry_id
+        if latest:
+            self.client.hset(self.applied_key, mapping=latest)
+
+    def _by_ref(self, changes: Work) -> List[Work]:
+        partitions = defaultdict(list)
+        for entry_ids, change in changes:
+            partitions[self._partition(change.ref)].append((entry_ids, change))
+        return list(partitions.values())
+
+    def _coalesced(self, changes: Work) -> List[Work]:
+        last = {}
+        for entry_ids, change in changes:
+            earlier_ids = last.pop(change.ref, ([], None))[0]
+            last[change.ref] = (earlier_ids + entry_ids, change)
+        self.collapsed += len(changes) - len(last)
+        skus = views.batch_skus(list(last), self.bus.uow) if last else {}
+        by_sku, unknown = defaultdict(list), []
+        for ref, (entry_ids, change) in last.items():
+            if ref in skus:
+                by_sku[skus[ref]].append((entry_ids, change))
+            else:
+                unknown.append((entry_ids, change))
+        partitions = defaultdict(list)
+        for sku, product_changes in by_sku.items():
+            entry_ids = [entry_id for ids, _ in product_changes for entry_id in ids]
+            command = commands.ChangeBatchQuantities([change for _, change in product_changes])
+            partitions[self._partition(sku)].append((entry_ids, command))
+        # left to fail on their own, as they would have without coalescing
+        for entry_ids, change in unknown:
+            partitions[self._partition(change.ref)].append((entry_ids, change))
+        self.transactions_saved += len(changes) - len(by_sku) - len(unknown)
+        return list(partitions.values())
+
+    def _partition(self, key: str) -> int:
+        return zlib.crc32(key.encode()) % self.workers
+
+    def _handle(self, partition: Work) -> List[bytes]:
+        handled = []
+        for entry_ids, command in partition:
+            try:
+                self.bus.handle(command)
+            except Exception:
+                # the rest of the partition waits too, so that none of this
+                # read's later changes to the reference goes first
+                logger.exception("Failed to handle %s, it will be claimed again", command)
+                break
+            handled += entry_ids
+        return handled
+
+    def run(self, stop: threading.Event, report_interval: float = 60):
+        reclaimed_at = reported_at = time.monotonic()
+        while not stop.is_set():
+            if time.monotonic() - reclaimed_at >= self.claim_idle_ms / 1000:
+                self.process(self.reclaim())
+                reclaimed_at = time.monotonic()
+            self.process(self.read_window() if self.coalesce else self.read())
+            if time.monotonic() - reported_at >= report_interval:
+                logger.info("stream consumer %s, pending %s", self.stats(), self.pending())
+                reported_at = time.monotonic()
+
+    def pending(self) -> int:
+        return self.client.xpending(self.stream, self.group)["pending"]
+
+    def stats(self) -> Dict[str, float]:
+        return dict(
+            consumed=self.consumed, acked=self.acked, failed=self.failed, reclaimed=self.reclaimed,
+            malformed=self.malformed, collapsed=self.collapsed, transactions_saved=self.transactions_saved,
+            superseded=self.superseded,
+            lag=self.lag, throughput=self.acked / (time.monotonic() - self._started),
+        )
+
+    def close(self):
+        self._pool.shutdown()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    bus = bootstrap.bootstrap(uow=unit_of_work.SqlAlchemyUnitOfWork(outbox=True))
+    consumer = StreamConsumer(redis_eventpublisher.default_client(), bus)
+    consumer.create_group()
+    consumer.run(threading.Event())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,96 @@
+import asyncio
+from typing import Callable, Dict, Type, List
+
+from allocation.adapters import notifications, read_model
+from allocation.domain import model, events, commands
+from allocation.domain.model import OrderLine
+from allocation.service_layer.handlers import InvalidSku
+from allocation.service_layer.unit_of_work import AsyncUnitOfWorkProtocol
+
+
+async def add_batch(command: commands.CreateBatch, uow: AsyncUnitOfWorkProtocol):
+    async with uow:
+        product = await uow.products.get(command.sku)
+        if product is None:
+            product = model.Product(command.sku, batches=[])
+            uow.products.add(product)
+        product.add_batch(model.Batch(command.ref, command.sku, command.qty, command.eta))
+        await uow.commit()
+
+
+async def allocate(command: commands.Allocate, uow: AsyncUnitOfWorkProtocol) -> str:
+    async with uow:
+        product = await uow.products.get(command.sku)
+        if product is None:
+            raise InvalidSku(f"Invalid sku {command.sku}")
+        batch_ref = product.allocate(line=OrderLine(command.orderid, command.sku, command.qty))
+        await uow.commit()
+    return batch_ref
+
+
+async def allocate_many(command: commands.AllocateMany, uow: AsyncUnitOfWorkProtocol) -> List[str | None]:
+    async with uow:
+        product = await uow.products.get(command.sku)
+        if product is None:
+            raise InvalidSku(f"Invalid sku {command.sku}")
+        batch_refs = product.allocate_many([
+            OrderLine(line.orderid, command.sku, line.qty) for line in command.lines
+        ])
+        await uow.commit()
+    return batch_refs
+
+
+async def deallocate(command: commands.DeAllocate, uow: AsyncUnitOfWorkProtocol) -> str:
+    async with uow:
+        product = await uow.products.get(command.sku)
+        if product is None:
+            raise InvalidSku(f"Invalid sku {command.sku}")
+        batch_ref = product.deallocate(OrderLine(command.orderid, command.sku, command.qty))
+        await uow.commit()
+    return batch_ref
+
+
+async def send_out_of_stock_notification(
+        event: events.OutOfStock, notifications: notifications.AbstractNotifications,
+):
+    # notifications are sent with a blocking client
+    await asyncio.to_thread(
+        notifications.send,
+        'stock@made.com',
+        f'Out of stock for {event.sku}',
+    )
+
+
+async def change_batch_quantity(
+        event: commands.ChangeBatchQuantity, uow: AsyncUnitOfWorkProtocol,
+        reallocation: model.ReallocationPolicy = model.ReallocationPolicy(),
+):
+    async with uow:
+        product = await uow.products.get_by_batchref(event.ref)
+        product.change_batch_quantity(ref=event.ref, qty=event.qty, reallocation=reallocation)
+        await uow.commit()
+
+
+async def publish_allocated_event(event: events.Allocated, publish: Callable):
+    await publish('line_allocated', event)
+
+
+async def rebuild_allocations_view(command: commands.RebuildAllocationsView, uow: AsyncUnitOfWorkProtocol):
+    async with uow:
+        await uow.session.run_sync(read_model.rebuild)
+        await uow.commit()
+
+
+COMMAND_HANDLERS: Dict[Type[commands.Command], Callable] = {
+    commands.CreateBatch: add_batch,
+    commands.Allocate: allocate,
+    commands.AllocateMany: allocate_many,
+    commands.DeAllocate: deallocate,
+    commands.ChangeBatchQuantity: change_batch_quantity,
+    commands.RebuildAllocationsView: rebuild_allocations_view,
+}
+EVENT_HANDLERS: Dict[Type[events.Event], List[Callable]] = {
+    events.OutOfStock: [send_out_of_stock_notification],
+    events.Allocated: [publish_allocated_event],
+    events.Deallocated: [],
+}
@@ -0,0 +1,69 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Dict, Type, List, Callable
+
+from tenacity import AsyncRetrying, stop_after_attempt, wait_exponential, RetryError
+
+from allocation.domain import events, commands
+from allocation.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+Message = commands.Command | events.Event
+
+
+class AsyncMessageBus:
+    def __init__(self,
+                 uow: unit_of_work.AsyncUnitOfWorkProtocol,
+                 event_handlers=Dict[Type[events.Event], List[Callable]],
+                 command_handler=Dict[Type[commands.Command], Callable]):
+        self.command_handler = command_handler
+        self.event_handlers = event_handlers
+        self.uow = uow
+
+    async def handle(self, message: Message) -> None:
+        # the queue is local, as several requests may be handled at once
+        queue = deque([message])
+        while queue:
+            message = queue.popleft()
+            match message:
+                case events.Event():
+                    queue.extend(await self.handle_event(message))
+                case commands.Command():
+                    queue.extend(await self.handle_command(message))
+
+    async def handle_event(self, event: events.Event) -> List[Message]:
+        # every handler runs in its own task, and collects the events it raised
+        # itself, since each task opens its own unit of work
+        new_messages = await asyncio.gather(*(
+            self._handle_event_with(handler, event) for handler in self.event_handlers[type(event)]
+        ))
+        return [message for messages in new_messages for message in messages]
+
+    async def _handle_event_with(self, handler: Callable, event: events.Event) -> List[Message]:
+        try:
+            try:
+                async for attempt in AsyncRetrying(
+                        stop=stop_after_attempt(3),
+                        wait=wait_exponential()
+                ):
+                    with attempt:
+                        logger.debug('handling event %s with handler %s', event, handler)
+                        await handler(event)
+                        return list(self.uow.collect_new_events())
+            except RetryError as retry_failure:
+                logger.error('Failed to handle event %s times, giving up!',
+                             retry_failure.last_attempt.attempt_number)
+        except Exception:
+            logger.exception('Exception handling event %s', event)
+        return []
+
+    async def handle_command(self, command: commands.Command) -> List[Message]:
+        logger.debug("handling command %s", command)
+        try:
+            handler = self.command_handler[type(command)]
+            await handler(command)
+            return list(self.uow.collect_new_events())
+        except Exception:
+            logger.exception("Exception handling command %s", command)
+            raise
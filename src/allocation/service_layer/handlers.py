@@ -2,7 +2,8 @@ from typing import Callable, Dict, Type, List
 
 import allocation.domain
 import allocation.domain.commands
-from allocation.adapters import redis_eventpublisher, notifications
+from allocation.adapters import notifications, read_model
+from allocation.adapters.cache import LRUCache
 from allocation.domain import model, events, commands
 from allocation.domain.model import OrderLine
 from allocation.service_layer.unit_of_work import UnitOfWorkProtocol
@@ -25,10 +26,17 @@ def add_batch(
         if product is None:
             product = model.Product(command.sku, batches=[])
             uow.products.add(product)
-        product.batches.append(model.Batch(command.ref, command.sku, command.qty, command.eta))
+        product.add_batch(model.Batch(command.ref, command.sku, command.qty, command.eta))
         uow.commit()
 
 
+def add_batches(command: allocation.domain.commands.CreateBatches, uow: UnitOfWorkProtocol) -> int:
+    with uow:
+        added = uow.products.add_batches(command.batches)
+        uow.commit()
+    return added
+
+
 def allocate(command: allocation.domain.commands.Allocate, uow: UnitOfWorkProtocol) -> str:
     with uow:
         product = uow.products.get(command.sku)
@@ -39,6 +47,20 @@ def allocate(command: allocation.domain.commands.Allocate, uow: UnitOfWorkProtoc
     return batch_ref
 
 
+def allocate_many(
+        command: allocation.domain.commands.AllocateMany, uow: UnitOfWorkProtocol
+) -> List[str | None]:
+    with uow:
+        product = uow.products.get(command.sku)
+        if product is None:
+            raise InvalidSku(f"Invalid sku {command.sku}")
+        batch_refs = product.allocate_many([
+            OrderLine(line.orderid, command.sku, line.qty) for line in command.lines
+        ])
+        uow.commit()
+    return batch_refs
+
+
 def deallocate(command: allocation.domain.commands.DeAllocate, uow: UnitOfWorkProtocol) -> str:
     with uow:
         product = uow.products.get(command.sku)
@@ -57,24 +79,74 @@ def send_out_of_stock_notification(event: events.OutOfStock, notifications: noti
 
 
 def change_batch_quantity(
-       event: allocation.domain.commands.ChangeBatchQuantity, uow: UnitOfWorkProtocol
+       event: allocation.domain.commands.ChangeBatchQuantity, uow: UnitOfWorkProtocol,
+       reallocation: model.ReallocationPolicy = model.ReallocationPolicy(),
 ):
     with uow:
         product = uow.products.get_by_batchref(event.ref)
-        product.change_batch_quantity(ref=event.ref, qty=event.qty)
+        product.change_batch_quantity(ref=event.ref, qty=event.qty, reallocation=reallocation)
+        uow.commit()
+
+
+def change_batch_quantities(
+        command: allocation.domain.commands.ChangeBatchQuantities, uow: UnitOfWorkProtocol,
+        reallocation: model.ReallocationPolicy = model.ReallocationPolicy(),
+):
+    # all in one transaction; batches of the same product share one aggregate
+    with uow:
+        for change in command.changes:
+            product = uow.products.get_by_batchref(change.ref)
+            product.change_batch_quantity(ref=change.ref, qty=change.qty, reallocation=reallocation)
         uow.commit()
 
 
-def publish_allocated_event(event: events.Allocated):
-    redis_eventpublisher.publish('line_allocated', event)
+def allocate_in_loaded_product(command: allocation.domain.commands.Allocate, products: Dict[str, model.Product]) -> bool:
+    product = products.get(command.sku)
+    if product is None:
+        return False
+    product.allocate(OrderLine(command.orderid, command.sku, command.qty))
+    return True
+
+
+def publish_allocated_event(event: events.Allocated, publish: Callable):
+    publish('line_allocated', event)
+
+
+def invalidate_cached_allocations(event: events.Allocated | events.Deallocated, allocations_cache: LRUCache | None):
+    # the read model was updated in the transaction that raised the event,
+    # so a reload sees the change
+    if allocations_cache is not None:
+        allocations_cache.invalidate(event.orderid)
+
+
+def rebuild_allocations_view(
+        command: commands.RebuildAllocationsView, uow: UnitOfWorkProtocol,
+        allocations_cache: LRUCache | None = None,
+):
+    with uow:
+        read_model.rebuild(uow.session)
+        uow.commit()
+    if allocations_cache is not None:
+        allocations_cache.clear()
 
 
 COMMAND_HANDLERS: Dict[Type[commands.Command], Callable] = {
     allocation.domain.commands.CreateBatch: add_batch,
+    allocation.domain.commands.CreateBatches: add_batches,
     allocation.domain.commands.Allocate: allocate,
-    allocation.domain.commands.ChangeBatchQuantity: change_batch_quantity
+    allocation.domain.commands.AllocateMany: allocate_many,
+    allocation.domain.commands.DeAllocate: deallocate,
+    allocation.domain.commands.ChangeBatchQuantity: change_batch_quantity,
+    allocation.domain.commands.ChangeBatchQuantities: change_batch_quantities,
+    allocation.domain.commands.RebuildAllocationsView: rebuild_allocations_view,
+}
+# commands an aggregate raises that can be applied to an aggregate the same
+# unit of work has loaded, returning whether they were
+CASCADE_HANDLERS: Dict[Type[commands.Command], Callable[..., bool]] = {
+    allocation.domain.commands.Allocate: allocate_in_loaded_product,
 }
 EVENT_HANDLERS: Dict[Type[events.Event], List[Callable]] = {
     events.OutOfStock: [send_out_of_stock_notification],
-    events.Allocated: [publish_allocated_event]
+    events.Allocated: [publish_allocated_event, invalidate_cached_allocations],
+    events.Deallocated: [invalidate_cached_allocations],
 }
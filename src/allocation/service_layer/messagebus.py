@@ -1,8 +1,15 @@
 import logging
+import random
+import time
+from collections import deque
+from dataclasses import dataclass
 from typing import Dict, Type, List, Callable
 
-from tenacity import Retrying, stop_after_attempt, wait_exponential, RetryError
+from tenacity import (
+    Retrying, stop_after_attempt, wait_exponential, wait_random_exponential, retry_if_exception_type, RetryError,
+)
 
+from allocation.adapters.instrumentation import ConflictMetrics
 from allocation.domain import events, commands
 from allocation.service_layer import unit_of_work
 from allocation.service_layer.handlers import COMMAND_HANDLERS, EVENT_HANDLERS
@@ -11,55 +18,182 @@ logger = logging.getLogger(__name__)
 Message = commands.Command | events.Event
 
 
+@dataclass(frozen=True)
+class RetryPolicy:
+    """
+    How often a command is re-run after a concurrency conflict, waiting a
+    random time of up to initial_wait * 2 ** n seconds (capped at max_wait)
+    before the n-th retry, so that conflicting requests drift apart.
+    """
+    attempts: int = 5
+    initial_wait: float = 0.01
+    max_wait: float = 0.5
+
+
+DEFAULT_RETRY = RetryPolicy()
+NO_RETRY = RetryPolicy(attempts=1)
+
+EVENT_HANDLER_ATTEMPTS = 3
+# seconds before the second attempt, doubling for every one after
+EVENT_RETRY_WAIT = 1
+
+
+def _ignore(message: Message) -> List[Message]:
+    return []
+
+
 class MessageBus:
     def __init__(self,
                  uow: unit_of_work.UnitOfWorkProtocol,
                  event_handlers=Dict[Type[events.Event], List[Callable]],
-                 command_handler=Dict[Type[commands.Command], Callable]):
-        self.queue = None
+                 command_handler=Dict[Type[commands.Command], Callable],
+                 command_retries: Dict[Type[commands.Command], RetryPolicy] | None = None,
+                 conflict_metrics: ConflictMetrics | None = None,
+                 after_handle: List[Callable[[], None]] | None = None,
+                 cascade_handlers: Dict[Type[commands.Command], Callable[..., bool]] | None = None):
         self.command_handler = command_handler
         self.event_handlers = event_handlers
         self.uow = uow
+        self.command_retries = command_retries or {}
+        self.conflict_metrics = conflict_metrics
+        self.after_handle = after_handle or []
+        self.cascade_handlers = cascade_handlers or {}
+        # message type -> handle_event or handle_command
+        self._routes = {}  # type: Dict[type, Callable[[Message], List[Message]]]
+        # message type -> the class in its MRO that handlers are registered for
+        self._registered = {}  # type: Dict[type, type]
 
     def handle(self, message: Message) -> None:
-        self.queue = [message]
-        while self.queue:
-            message = self.queue.pop(0)
-            match message:
-                case events.Event():
-                    self.handle_event(message)
-                case commands.Command():
-                    self.handle_command(message)
-
-    def handle_event(self, event: events.Event,
-                     ):
-        for handler in self.event_handlers[type(event)]:
-            try:
+        # the queue is local, as the API calls one bus from many threads
+        queue = deque([message])
+        routes = self._routes
+        try:
+            while queue:
+                message = queue.popleft()
+                route = routes.get(type(message)) or self._route(type(message))
+                queue.extend(route(message))
+        finally:
+            for callback in self.after_handle:
                 try:
-                    for attempt in Retrying(
-                            stop=stop_after_attempt(3),
-                            wait=wait_exponential()
-                    ):
-                        with attempt:
-                            logger.debug('handling event %s with handler %s', event, handler)
-                            handler(event)
-                            self.queue.extend(self.uow.collect_new_events())
-                except RetryError as retry_failure:
-                    logger.error('Failed to handle event %s times, giving up!',
-                                 retry_failure.last_attempt.attempt_number)
+                    callback()
+                except Exception:
+                    # what was committed stays committed, as when an event handler fails
+                    logger.exception("Exception in %s after handling %s", callback, message)
+
+    def _route(self, message_type: type) -> Callable[[Message], List[Message]]:
+        if issubclass(message_type, events.Event):
+            route = self.handle_event
+        elif issubclass(message_type, commands.Command):
+            route = self.handle_command
+        else:
+            route = _ignore
+        self._routes[message_type] = route
+        return route
+
+    def _lookup(self, handlers: Dict[type, Callable], message_type: type):
+        handler = handlers.get(message_type)
+        if handler is not None:
+            return handler
+        # a subclass goes to the handlers of its nearest registered base;
+        # a type nothing is registered for still raises a KeyError
+        registered = self._registered.get(message_type)
+        if registered is None:
+            registered = next((t for t in message_type.__mro__ if t in handlers), message_type)
+            self._registered[message_type] = registered
+        return handlers[registered]
+
+    def handle_event(self, event: events.Event) -> List[Message]:
+        try:
+            event_handlers = self._lookup(self.event_handlers, type(event))
+        except KeyError:
+            # as for a handler that fails, the rest of the queue is still handled
+            logger.exception("No handlers for event %s", event)
+            return []
+        new_messages = []
+        for handler in event_handlers:
+            logger.debug('handling event %s with handler %s', event, handler)
+            try:
+                handler(event)
             except Exception:
-                logger.exception('Exception handling event %s', event)
-                continue
+                if not self._retry_event(handler, event):
+                    continue
+            new_messages.extend(self.uow.collect_new_events())
+        return new_messages
+
+    def _retry_event(self, handler: Callable, event: events.Event) -> bool:
+        # only a handler that failed pays for setting up its retries, which
+        # take over from the second attempt
+        time.sleep(EVENT_RETRY_WAIT)
+        try:
+            for attempt in Retrying(
+                    stop=stop_after_attempt(EVENT_HANDLER_ATTEMPTS - 1),
+                    wait=wait_exponential(multiplier=2 * EVENT_RETRY_WAIT),
+            ):
+                with attempt:
+                    handler(event)
+        except RetryError:
+            logger.exception('Failed to handle event %s %s times, giving up!', event, EVENT_HANDLER_ATTEMPTS)
+            return False
+        return True
 
     def handle_command(
             self,
             command: commands.Command,
-    ):
+    ) -> List[Message]:
         logger.debug("handling command %s", command)
+        attempts = 1
         try:
-            handler = self.command_handler[type(command)]
-            handler(command)
-            self.queue.extend(self.uow.collect_new_events())
+            handler = self._lookup(self.command_handler, type(command))
+            try:
+                # the handler opens a new unit of work, so every attempt
+                # starts from what is in the database now
+                handler(command)
+            except unit_of_work.ConcurrencyConflict:
+                policy = self.command_retries.get(type(command), DEFAULT_RETRY)
+                if policy.attempts == 1:
+                    raise
+                # as for events, the retries are only set up once needed,
+                # with the wait that was due after the first attempt
+                time.sleep(random.uniform(0, min(policy.initial_wait, policy.max_wait)))
+                for attempt in Retrying(
+                        stop=stop_after_attempt(policy.attempts - 1),
+                        wait=wait_random_exponential(multiplier=2 * policy.initial_wait, max=policy.max_wait),
+                        retry=retry_if_exception_type(unit_of_work.ConcurrencyConflict),
+                        reraise=True,
+                ):
+                    with attempt:
+                        attempts += 1
+                        handler(command)
+        except unit_of_work.ConcurrencyConflict:
+            self._record_conflicts(command, attempts, attempts, gave_up=True)
+            logger.exception("Gave up on command %s after %s conflicting attempts", command, attempts)
+            raise
         except Exception:
             logger.exception("Exception handling command %s", command)
             raise
+        self._record_conflicts(command, attempts, attempts - 1, gave_up=False)
+        return list(self.uow.collect_new_events())
+
+    def apply_cascaded(self, uow: unit_of_work.UnitOfWorkProtocol):
+        """
+        Installed as the unit of work's before_commit hook. Commands raised
+        by the products it has loaded, such as the Allocate commands for the
+        lines a shrinking batch displaced, are applied here to the products
+        they target, when those are loaded too, so that they commit in the
+        same transaction. The rest are left for the bus to queue as usual.
+        """
+        if not self.cascade_handlers:
+            return
+        products = {product.sku: product for product in uow.products.seen}
+        for product in products.values():
+            # the events the applied commands raise are appended as they go,
+            # so they stay in order with the ones raised before
+            raised, product.events = product.events, []
+            for message in raised:
+                handler = self.cascade_handlers.get(type(message))
+                if handler is None or not handler(message, products):
+                    product.events.append(message)
+
+    def _record_conflicts(self, command: commands.Command, attempts: int, conflicts: int, gave_up: bool):
+        if self.conflict_metrics is not None:
+            self.conflict_metrics.record(type(command).__name__, attempts, conflicts, gave_up)
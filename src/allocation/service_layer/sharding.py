@@ -0,0 +1,80 @@
+import queue
+import threading
+import zlib
+from concurrent.futures import Future
+from typing import List, Callable
+
+from allocation import views
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+from allocation.service_layer.messagebus import MessageBus, Message
+
+_STOP = object()
+
+
+def partition_key(message: Message, sku_for_ref: Callable[[str], str | None]) -> str:
+    # commands that only know a batch reference go to the shard of the batch's
+    # product, so they are handled serially with everything else for its sku
+    sku = getattr(message, "sku", None)
+    if sku:
+        return sku
+    ref = getattr(message, "ref", None)
+    if ref is None and isinstance(message, commands.ChangeBatchQuantities) and message.changes:
+        # the stream consumer only groups changes to one product's batches
+        ref = message.changes[0].ref
+    if ref is None:
+        return ""
+    # a batch that does not exist fails on whichever shard handles it
+    return sku_for_ref(ref) or ref
+
+
+class ShardedMessageBus:
+    def __init__(self,
+                 buses: List[MessageBus],
+                 uow: unit_of_work.UnitOfWorkProtocol,
+                 key: Callable[[Message, Callable[[str], str | None]], str] = partition_key,
+                 sku_for_ref: Callable[[str], str | None] | None = None):
+        self.buses = buses
+        self.uow = uow
+        self.key = key
+        self.sku_for_ref = sku_for_ref or self._sku_for_ref
+        self._queues = [queue.SimpleQueue() for _ in buses]
+        self._workers = [
+            threading.Thread(target=self._work, args=(bus, q), name=f"allocation-shard-{i}", daemon=True)
+            for i, (bus, q) in enumerate(zip(buses, self._queues))
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def shard_for(self, message: Message) -> int:
+        return zlib.crc32(self.key(message, self.sku_for_ref).encode()) % len(self.buses)
+
+    def _sku_for_ref(self, ref: str) -> str | None:
+        return views.batch_skus([ref], self.uow).get(ref)
+
+    def submit(self, message: Message) -> Future:
+        future = Future()
+        self._queues[self.shard_for(message)].put((message, future))
+        return future
+
+    def handle(self, message: Message) -> None:
+        self.submit(message).result()
+
+    def close(self):
+        for q in self._queues:
+            q.put(_STOP)
+        for worker in self._workers:
+            worker.join()
+
+    @staticmethod
+    def _work(bus: MessageBus, messages: queue.SimpleQueue):
+        while (item := messages.get()) is not _STOP:
+            message, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                bus.handle(message)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(None)
@@ -1,19 +1,73 @@
-from typing import Protocol
+import contextvars
+import functools
+import itertools
+from typing import TYPE_CHECKING, Callable, Protocol
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.orm.exc import StaleDataError
 
 from allocation import config
-from allocation.adapters import repository
+from allocation.adapters import outbox, read_model, repository
 
-DEFAULT_SESSION_FACTORY = sessionmaker(bind=create_engine(
-    config.get_postgres_uri(),
-    isolation_level="REPEATABLE READ"
-))
+if TYPE_CHECKING:
+    from sqlalchemy.ext.asyncio import AsyncSession
+
+
+# the isolation level each of repository.LOCKING_STRATEGIES runs at. Under
+# repeatable read, postgres aborts a transaction that waited on a row lock
+# once the holder updates the row, so pessimistic writers would still fail
+# and retry; under read committed they read the row the holder committed.
+# The version number still guards writers that do not lock.
+ISOLATION_LEVELS = {"optimistic": "REPEATABLE READ", "pessimistic": "READ COMMITTED"}
+
+
+@functools.lru_cache(maxsize=None)
+def default_engine() -> Engine:
+    # created on first use rather than at import, so that tools which never
+    # reach the database do not pay for an engine, and every worker a
+    # pre-fork server starts gets a pool of its own
+    return create_engine(
+        config.get_postgres_uri(),
+        isolation_level=ISOLATION_LEVELS["optimistic"],
+        **config.get_postgres_pool_settings(),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def default_session_factory(locking: str = "optimistic") -> sessionmaker:
+    engine = default_engine()
+    if ISOLATION_LEVELS[locking] != ISOLATION_LEVELS["optimistic"]:
+        # shares the engine's pool, setting the level on every connection it checks out
+        engine = engine.execution_options(isolation_level=ISOLATION_LEVELS[locking])
+    return sessionmaker(bind=engine)
+
+
+class ConcurrencyConflict(Exception):
+    pass
+
+
+SERIALIZATION_FAILURE = "40001"
+
+
+def _conflict_from(error: Exception) -> ConcurrencyConflict | None:
+    # a version number that moved underneath us, or postgres refusing to
+    # serialize a write under repeatable read
+    if isinstance(error, StaleDataError):
+        return ConcurrencyConflict(str(error))
+    if isinstance(error, DBAPIError) and getattr(error.orig, "pgcode", None) == SERIALIZATION_FAILURE:
+        return ConcurrencyConflict(str(error.orig))
+    return None
 
 
 class UnitOfWorkProtocol(Protocol):
     products: repository.AbstractRepository
+    # whether commit writes the events in outbox.CHANNELS to the outbox
+    outbox = False
+    # called with the unit of work just before it commits, see MessageBus.apply_cascaded
+    before_commit: Callable[["UnitOfWorkProtocol"], None] | None = None
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.rollback()
@@ -23,10 +77,14 @@ class UnitOfWorkProtocol(Protocol):
 
     def collect_new_events(self):
         for product in self.products.seen:
-            while product.events:
-                yield product.events.pop(0)
+            if product.events:
+                # hand over the whole list at once rather than popping from its front
+                new_events, product.events = product.events, []
+                yield from new_events
 
     def commit(self):
+        if self.before_commit is not None:
+            self.before_commit(self)
         self._commit()
 
     def rollback(self):
@@ -36,25 +94,194 @@ class UnitOfWorkProtocol(Protocol):
         ...
 
 
+class _Scope:
+    __slots__ = ("session", "products", "committed", "events")
+
+    def __init__(self, session, products):
+        self.session = session
+        self.products = products
+        self.committed = False
+        self.events = []
+
+
 class SqlAlchemyUnitOfWork(UnitOfWorkProtocol):
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY):
+    """
+    The session and repository live in a context variable rather than on the
+    instance, so the API's worker threads can share one unit of work (and
+    one bus) while every request gets its own session from the pool.
+
+    With a product_cache, the products a successful unit of work used are
+    checked back into the cache once its session is closed.
+
+    locking is one of repository.LOCKING_STRATEGIES, by default the one the
+    deployment configures. With outbox, the events to publish are written to
+    the outbox table in the same transaction as the change that raised them,
+    as the rows of the allocations read model always are.
+    """
+
+    def __init__(
+            self, session_factory=None, load=repository.load_selectin,
+            product_cache: repository.ProductCache | None = None, locking: str | None = None,
+            outbox: bool = False,
+    ):
+        locking = locking or config.get_product_locking()
+        if locking not in repository.LOCKING_STRATEGIES:
+            raise ValueError(f"Unknown locking strategy {locking!r}")
         self.session_factory = session_factory
+        self.load = load
+        self.product_cache = product_cache
+        self.locking = locking
+        self.outbox = outbox
+        self._current = contextvars.ContextVar(f"uow-{id(self)}", default=None)
         super().__init__()
 
+    @property
+    def session(self) -> Session | None:
+        scope = self._current.get()
+        return scope and scope.session
+
+    @property
+    def products(self) -> repository.AbstractRepository | None:
+        scope = self._current.get()
+        return scope and scope.products
+
     def __exit__(self, exc_type, exc_val, exc_tb):
         super().__exit__(exc_type, exc_val, exc_tb)
         self.session.close()
+        scope = self._current.get()
+        if self.product_cache is not None and exc_type is None and scope.committed:
+            self._check_in(scope)
 
     def __enter__(self):
-        self.session = self.session_factory()
-        self.products = repository.SqlProductRepository(
-            self.session
+        if self.session_factory is None:
+            self.session_factory = default_session_factory(self.locking)
+        session = self.session_factory()
+        if self.product_cache is not None:
+            # cached products are only useful if commit leaves them loaded
+            session.expire_on_commit = False
+        products = repository.SqlProductRepository(
+            session, self.load, self.product_cache, lock=self.locking == "pessimistic",
         )
-
+        self._current.set(_Scope(session, products))
         return super().__enter__()
 
+    def _check_in(self, scope: _Scope):
+        # the events are taken off the products first, as once they are back
+        # in the cache another request may check them out and raise its own
+        products = [product for product in scope.products.seen if not inspect(product).expired_attributes]
+        for product in products:
+            scope.events.extend(product.events)
+            product.events = []
+        scope.products.seen.clear()
+        self.product_cache.check_in(products)
+
+    def collect_new_events(self):
+        scope = self._current.get()
+        if scope is None:
+            return iter(())
+        handed_over, scope.events = scope.events, []
+        return itertools.chain(handed_over, super().collect_new_events())
+
     def _commit(self):
-        self.session.commit()
+        new_events = [event for product in self.products.seen for event in product.events]
+        read_model.record(self.session, new_events)
+        if self.outbox:
+            outbox.record(self.session, new_events)
+        try:
+            self.session.commit()
+        except (StaleDataError, DBAPIError) as e:
+            conflict = _conflict_from(e)
+            if conflict is None:
+                raise
+            raise conflict from e
+        self._current.get().committed = True
 
     def rollback(self):
         self.session.rollback()
+
+
+@functools.lru_cache(maxsize=None)
+def default_async_session_factory():
+    # created on first use, so that importing this module does not need asyncpg
+    from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+    return sessionmaker(
+        bind=create_async_engine(
+            config.get_async_postgres_uri(),
+            isolation_level="REPEATABLE READ",
+            **config.get_postgres_pool_settings(),
+        ),
+        class_=AsyncSession,
+        expire_on_commit=False,
+    )
+
+
+class AsyncUnitOfWorkProtocol(Protocol):
+    products: repository.AbstractAsyncRepository
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.rollback()
+
+    async def __aenter__(self):
+        return self
+
+    collect_new_events = UnitOfWorkProtocol.collect_new_events
+
+    async def commit(self):
+        await self._commit()
+
+    async def rollback(self):
+        ...
+
+    async def _commit(self):
+        ...
+
+
+class AsyncSqlAlchemyUnitOfWork(AsyncUnitOfWorkProtocol):
+    """
+    Keeps its session and repository in a context variable, so one instance
+    can be shared by every request on the event loop: each task sees the
+    session it opened itself.
+    """
+
+    def __init__(self, session_factory=None):
+        self.session_factory = session_factory
+        self._current = contextvars.ContextVar(f"async-uow-{id(self)}", default=(None, None))
+
+    @property
+    def session(self) -> "AsyncSession":
+        return self._current.get()[0]
+
+    @property
+    def products(self) -> repository.AbstractAsyncRepository:
+        return self._current.get()[1]
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await super().__aexit__(exc_type, exc_val, exc_tb)
+        await self.session.close()
+
+    async def __aenter__(self):
+        if self.session_factory is None:
+            self.session_factory = default_async_session_factory()
+        session = self.session_factory()
+        self._current.set((session, repository.AsyncSqlProductRepository(session)))
+        return await super().__aenter__()
+
+    def collect_new_events(self):
+        if self.products is None:
+            return iter(())
+        return super().collect_new_events()
+
+    async def _commit(self):
+        new_events = [event for product in self.products.seen for event in product.events]
+        await self.session.run_sync(read_model.record, new_events)
+        try:
+            await self.session.commit()
+        except (StaleDataError, DBAPIError) as e:
+            conflict = _conflict_from(e)
+            if conflict is None:
+                raise
+            raise conflict from e
+
+    async def rollback(self):
+        await self.session.rollback()
@@ -1,16 +1,42 @@
+from typing import Dict, List
+
+from sqlalchemy import text, bindparam
+
+from allocation.adapters.cache import LRUCache
 from allocation.service_layer import unit_of_work
 
+ALLOCATIONS_QUERY = """
+    SELECT sku, batchref FROM allocations_view WHERE orderid = :orderid
+"""
+
+BATCH_SKUS_QUERY = text(
+    "SELECT reference, sku FROM batches WHERE reference IN :refs"
+).bindparams(bindparam("refs", expanding=True))
+
+
+def allocations(orderid: str, uow: unit_of_work.SqlAlchemyUnitOfWork, cache: LRUCache | None = None):
+    def load():
+        with uow:
+            return tuple(uow.session.execute(
+                text(ALLOCATIONS_QUERY),
+                dict(
+                    orderid=orderid
+                )))
 
-def allocations(orderid: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
+    # the rows are cached as tuples, so callers can't change what's in the cache
+    results = load() if cache is None else cache.get_or_load(orderid, load)
+    return [{'sku': sku, 'batchref': batchref} for sku, batchref in results]
+
+
+def batch_skus(refs: List[str], uow: unit_of_work.SqlAlchemyUnitOfWork) -> Dict[str, str]:
     with uow:
-        results = list(uow.session.execute(
-            f"""
-            SELECT b.sku, b.reference
-               FROM allocations as a
-               JOIN order_lines AS o ON o.id = a.orderline_id
-               JOIN batches AS b ON b.id = a.batch_id
-               WHERE o.orderid = :orderid
-            """,
+        return dict(uow.session.execute(BATCH_SKUS_QUERY, dict(refs=refs)).all())
+
+
+async def allocations_async(orderid: str, uow: unit_of_work.AsyncSqlAlchemyUnitOfWork):
+    async with uow:
+        results = list(await uow.session.execute(
+            text(ALLOCATIONS_QUERY),
             dict(
                 orderid=orderid
             )))
@@ -1,10 +1,13 @@
+import functools
 import inspect
-from typing import Callable
+from typing import Callable, Dict, Type
 
 import allocation.service_layer.handlers
-from allocation.adapters import redis_eventpublisher, orm
+from allocation.adapters import redis_eventpublisher, orm, instrumentation
+from allocation.adapters.cache import LRUCache
 from allocation.adapters.notifications import AbstractNotifications, EmailNotifications
-from allocation.service_layer import unit_of_work, messagebus
+from allocation.domain import commands, model
+from allocation.service_layer import unit_of_work, messagebus, sharding
 
 
 def inject_dependencies(handler, dependencies):
@@ -13,33 +16,148 @@ def inject_dependencies(handler, dependencies):
         name: dependency
         for name, dependency in dependencies.items() if name in params
     }
-    return lambda message: handler(message, ** deps)
+    # the lambda this replaces built a new dict from **deps on every call. A
+    # partial copies its stored keywords only when a call adds keywords of
+    # its own; the bus calls handlers with the message alone, so it passes
+    # the stored dict on
+    return functools.partial(handler, **deps)
 
 
 def bootstrap(
         start_orm=True,
-        uow: unit_of_work.UnitOfWorkProtocol = unit_of_work.SqlAlchemyUnitOfWork(),
-        notifications: AbstractNotifications = EmailNotifications(),
-        publish: Callable = redis_eventpublisher.publish,
+        uow: unit_of_work.UnitOfWorkProtocol | None = None,
+        notifications: AbstractNotifications | None = None,
+        publish: Callable | None = None,
+        reallocation: model.ReallocationPolicy = model.ReallocationPolicy(),
+        shards: int = 0,
+        uow_factory: Callable[[], unit_of_work.UnitOfWorkProtocol] = unit_of_work.SqlAlchemyUnitOfWork,
+        query_counter: instrumentation.QueryCounter | None = None,
+        allocations_cache: LRUCache | None = None,
+        command_retries: Dict[Type[commands.Command], messagebus.RetryPolicy] | None = None,
+        conflict_metrics: instrumentation.ConflictMetrics | None = None,
+        cascade: bool = True,
 ):
+    # with cascade, the default, lines a batch change displaces are reallocated
+    # in the transaction that changed it; without, by their own Allocate commands
+    #
+    # the defaults are built on every call, rather than once when this
+    # module is imported, so importing it connects to nothing
+    if uow is None:
+        uow = unit_of_work.SqlAlchemyUnitOfWork()
+    if notifications is None:
+        notifications = EmailNotifications()
+    if publish is None:
+        publish = redis_eventpublisher.BufferedPublisher()
     if start_orm:
         orm.start_mappers()
+    if shards:
+        # every shard gets its own unit of work and handles its skus serially
+        return sharding.ShardedMessageBus(
+            [
+                build_messagebus(
+                    uow_factory(), notifications, publish, reallocation, query_counter, allocations_cache,
+                    command_retries, conflict_metrics, cascade,
+                )
+                for _ in range(shards)
+            ],
+            uow=uow,
+        )
+    return build_messagebus(
+        uow, notifications, publish, reallocation, query_counter, allocations_cache, command_retries, conflict_metrics,
+        cascade,
+    )
+
+
+def build_messagebus(
+        uow: unit_of_work.UnitOfWorkProtocol,
+        notifications: AbstractNotifications,
+        publish: Callable,
+        reallocation: model.ReallocationPolicy,
+        query_counter: instrumentation.QueryCounter | None = None,
+        allocations_cache: LRUCache | None = None,
+        command_retries: Dict[Type[commands.Command], messagebus.RetryPolicy] | None = None,
+        conflict_metrics: instrumentation.ConflictMetrics | None = None,
+        cascade: bool = True,
+) -> messagebus.MessageBus:
     dependencies = dict(
         uow=uow,
         publish=publish,
-        notifications=notifications
+        notifications=notifications,
+        reallocation=reallocation,
+        allocations_cache=allocations_cache,
     )
-    injected_event_handlers = {
-        event_type: [inject_dependencies(handler, dependencies) for handler in event_handlers]
-        for event_type, event_handlers in allocation.service_layer.handlers.EVENT_HANDLERS.items()
-    }
-    injected_command_handlers = {
-        command_type: inject_dependencies(command_handler, dependencies)
-        for command_type, command_handler in allocation.service_layer.handlers.COMMAND_HANDLERS.items()
-    }
+    event_handlers = allocation.service_layer.handlers.EVENT_HANDLERS
+    if uow.outbox:
+        # the outbox relay publishes these instead
+        event_handlers = {
+            event_type: [h for h in handlers if h is not allocation.service_layer.handlers.publish_allocated_event]
+            for event_type, handlers in event_handlers.items()
+        }
+    event_handlers = inject_event_handlers(event_handlers, dependencies)
+    command_handlers = inject_command_handlers(allocation.service_layer.handlers.COMMAND_HANDLERS, dependencies)
+    if query_counter:
+        event_handlers = {
+            event_type: [query_counter.counting(event_type.__name__, handler) for handler in handlers]
+            for event_type, handlers in event_handlers.items()
+        }
+        command_handlers = {
+            command_type: query_counter.counting(command_type.__name__, handler)
+            for command_type, handler in command_handlers.items()
+        }
+    bus = messagebus.MessageBus(
+        uow=uow,
+        event_handlers=event_handlers,
+        command_handler=command_handlers,
+        command_retries=command_retries,
+        conflict_metrics=conflict_metrics,
+        # a buffering publisher sends what a message raised once it is handled
+        after_handle=[publish.flush] if hasattr(publish, "flush") else [],
+        cascade_handlers=allocation.service_layer.handlers.CASCADE_HANDLERS if cascade else None,
+    )
+    # cascaded commands for products already loaded commit with the change that raised them
+    uow.before_commit = bus.apply_cascaded if cascade else None
+    return bus
+
+
+def bootstrap_async(
+        start_orm=True,
+        uow: unit_of_work.AsyncUnitOfWorkProtocol | None = None,
+        notifications: AbstractNotifications | None = None,
+        publish: Callable = redis_eventpublisher.publish_async,
+        reallocation: model.ReallocationPolicy = model.ReallocationPolicy(),
+):
+    # only the async service needs its handlers and bus
+    import allocation.service_layer.async_handlers
+    from allocation.service_layer import async_messagebus
 
-    return messagebus.MessageBus(
+    if uow is None:
+        uow = unit_of_work.AsyncSqlAlchemyUnitOfWork()
+    if notifications is None:
+        notifications = EmailNotifications()
+    if start_orm:
+        orm.start_mappers()
+    dependencies = dict(
+        uow=uow,
+        publish=publish,
+        notifications=notifications,
+        reallocation=reallocation,
+    )
+    return async_messagebus.AsyncMessageBus(
         uow=uow,
-        event_handlers=injected_event_handlers,
-        command_handler=injected_command_handlers
+        event_handlers=inject_event_handlers(allocation.service_layer.async_handlers.EVENT_HANDLERS, dependencies),
+        command_handler=inject_command_handlers(allocation.service_layer.async_handlers.COMMAND_HANDLERS, dependencies),
     )
+
+
+def inject_event_handlers(event_handlers, dependencies):
+    return {
+        event_type: [inject_dependencies(handler, dependencies) for handler in handlers]
+        for event_type, handlers in event_handlers.items()
+    }
+
+
+def inject_command_handlers(command_handlers, dependencies):
+    return {
+        command_type: inject_dependencies(command_handler, dependencies)
+        for command_type, command_handler in command_handlers.items()
+    }
@@ -8,19 +8,22 @@ import pytest
 import redis
 import requests
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker, clear_mappers
+from sqlalchemy.pool import NullPool
 from tenacity import retry, stop_after_delay
 
 import bootstrap
 from allocation import config
-from allocation.adapters.orm import start_mappers, mapper_registry
+from allocation.adapters.orm import start_mappers, create_schema
 from allocation.service_layer import unit_of_work
+from tests.fake_redis import FakeRedisServer
 
 
 @pytest.fixture
 def in_memory_db():
     engine = create_engine("sqlite:///:memory:")
-    mapper_registry.metadata.create_all(engine)
+    create_schema(engine)
     return engine
 
 
@@ -36,6 +39,39 @@ def session(sqlite_session_factory):
     return sqlite_session_factory()
 
 
+@pytest.fixture
+def sqlite_file_db(tmp_path):
+    path = tmp_path / "allocation.db"
+    create_schema(create_engine(f"sqlite:///{path}"))
+    return path
+
+
+@pytest.fixture
+def sqlite_file_session_factory(sqlite_file_db):
+    # unlike the in-memory db, every connection sees the same data, so
+    # several threads can work on it at once
+    engine = create_engine(f"sqlite:///{sqlite_file_db}", connect_args={"timeout": 30, "check_same_thread": False})
+    start_mappers()
+    yield sessionmaker(bind=engine)
+    clear_mappers()
+
+
+@pytest.fixture
+def async_sqlite_session_factory(sqlite_file_db):
+    # every test runs its own event loop, so connections must not be pooled
+    engine = create_async_engine(f"sqlite+aiosqlite:///{sqlite_file_db}", poolclass=NullPool)
+    start_mappers()
+    yield sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    clear_mappers()
+
+
+@pytest.fixture
+def fake_redis():
+    server = FakeRedisServer().start()
+    yield server
+    server.close()
+
+
 @retry(stop=stop_after_delay(10))
 def wait_for_postgres_to_come_up(engine):
     return engine.connect()
@@ -50,7 +86,7 @@ def wait_for_webapp_to_come_up():
 def postgres_db():
     engine = create_engine(config.get_postgres_uri())
     wait_for_postgres_to_come_up(engine)
-    mapper_registry.metadata.create_all(engine)
+    create_schema(engine)
     return engine
 
 
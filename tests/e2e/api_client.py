@@ -31,3 +31,17 @@ def get_allocation(orderid):
         f"{url}/allocations/{orderid}",
     )
     return r
+
+
+def post_to_allocate_many(sku, lines, expect_success=True):
+    url = config.get_api_url()
+    r = requests.post(
+        f"{url}/allocate/bulk",
+        json={
+            "sku": sku,
+            "lines": [{"orderid": orderid, "qty": qty} for orderid, qty in lines],
+        },
+    )
+    if expect_success:
+        assert r.status_code == 201
+    return r
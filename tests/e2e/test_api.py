@@ -49,3 +49,15 @@ def test_unhappy_path_returns_400_and_error_message():
     assert r.status_code == 404
 
 
+@pytest.mark.usefixtures('restart_api')
+@pytest.mark.usefixtures('postgres_db')
+def test_bulk_allocation_allocates_every_line():
+    order1, order2 = random_orderid(1), random_orderid(2)
+    sku, batch = random_sku(), random_batchref()
+    api_client.post_to_add_batch(batch, sku, 100, None)
+
+    r = api_client.post_to_allocate_many(sku, [(order1, 10), (order2, 20)])
+    assert r.status_code == 201
+    for orderid in (order1, order2):
+        r = api_client.get_allocation(orderid)
+        assert r.json() == [{'sku': sku, 'batchref': batch}]
@@ -0,0 +1,245 @@
+"""
+An in-process stand-in for a Redis server, for the tests and benchmarks.
+
+It speaks the Redis protocol on a local port, so the real redis client (and
+its pipelines) talk to it, and it implements just the commands the service
+uses.
+"""
+import socketserver
+import threading
+import time
+from collections import defaultdict, OrderedDict
+from typing import Dict, List, Tuple
+
+
+class _Error(Exception):
+    pass
+
+
+class _Group:
+    def __init__(self, last: Tuple[int, int]):
+        self.last = last
+        # entry id -> [consumer, last delivered in ms, deliveries]
+        self.pending = OrderedDict()  # type: OrderedDict[Tuple[int, int], list]
+
+
+def _parse_id(raw: bytes) -> Tuple[int, int]:
+    ms, _, seq = raw.decode().partition("-")
+    return int(ms), int(seq or 0)
+
+
+def _format_id(entry_id: Tuple[int, int]) -> bytes:
+    return b"%d-%d" % entry_id
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+class FakeRedisServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.published = []  # type: List[Tuple[str, bytes]]
+        self.commands = defaultdict(int)  # type: Dict[str, int]
+        self.streams = defaultdict(list)  # type: Dict[bytes, List[Tuple[Tuple[int, int], List[bytes]]]]
+        self.groups = defaultdict(dict)  # type: Dict[bytes, Dict[bytes, _Group]]
+        self.hashes = defaultdict(dict)  # type: Dict[bytes, Dict[bytes, bytes]]
+        self._lock = threading.Condition()
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            # replies to a pipeline go out one by one, which nagle would hold back
+            disable_nagle_algorithm = True
+
+            def handle(self):
+                queued = None
+                while (command := fake._read_command(self.rfile)) is not None:
+                    name = command[0].decode().upper()
+                    if name == "MULTI":
+                        queued, reply = [], "OK"
+                    elif name == "EXEC":
+                        reply = [fake._run(queued_command) for queued_command in queued or []]
+                        queued = None
+                    elif queued is not None:
+                        queued.append(command)
+                        reply = "QUEUED"
+                    else:
+                        reply = fake._run(command)
+                    self.wfile.write(fake._encode(reply))
+
+        self._server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.host, self.port = self._server.server_address
+        self._thread = threading.Thread(target=self._server.serve_forever, args=(0.05,), daemon=True)
+
+    def start(self) -> "FakeRedisServer":
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def connection_kwargs(self) -> Dict:
+        return dict(host=self.host, port=self.port)
+
+    def _run(self, command: List[bytes]):
+        name, args = command[0].decode().upper(), command[1:]
+        if name in ("XGROUP", "XINFO") and args:
+            name, args = f"{name} {args[0].decode().upper()}", args[1:]
+        handler = getattr(self, f"_{name.lower().replace(' ', '_')}", None)
+        if handler is None:
+            return _Error(f"ERR unknown command '{name}'")
+        with self._lock:
+            self.commands[name] += 1
+            try:
+                return handler(*args)
+            except _Error as e:
+                return e
+
+    def _ping(self, *args):
+        return "PONG"
+
+    def _publish(self, channel, message):
+        self.published.append((channel.decode(), message))
+        return 0
+
+    def _hset(self, key, *pairs):
+        fields = self.hashes[key]
+        added = 0
+        for field, value in zip(pairs[::2], pairs[1::2]):
+            added += field not in fields
+            fields[field] = value
+        return added
+
+    def _hmget(self, key, *fields):
+        values = self.hashes.get(key, {})
+        return [values.get(field) for field in fields]
+
+    def _xadd(self, key, *args):
+        entry_id, fields = args[0], list(args[1:])
+        entries = self.streams[key]
+        last = entries[-1][0] if entries else (0, 0)
+        if entry_id == b"*":
+            ms = max(_now_ms(), last[0])
+            new_id = (ms, last[1] + 1 if ms == last[0] else 0)
+        else:
+            new_id = _parse_id(entry_id)
+            if new_id <= last:
+                raise _Error("ERR The ID specified in XADD is equal or smaller than the target stream top item")
+        entries.append((new_id, fields))
+        self._lock.notify_all()
+        return _format_id(new_id)
+
+    def _xlen(self, key):
+        return len(self.streams.get(key, ()))
+
+    def _xgroup_create(self, key, group, start, *options):
+        if key not in self.streams and b"MKSTREAM" not in (o.upper() for o in options):
+            raise _Error("ERR The XGROUP subcommand requires the key to exist")
+        if group in self.groups[key]:
+            raise _Error("BUSYGROUP Consumer Group name already exists")
+        entries = self.streams[key]
+        last = (entries[-1][0] if entries else (0, 0)) if start == b"$" else _parse_id(start)
+        self.groups[key][group] = _Group(last)
+        return "OK"
+
+    def _xreadgroup(self, *args):
+        options = {}
+        args = list(args)
+        while args:
+            word = args.pop(0).upper()
+            if word == b"GROUP":
+                options["group"], options["consumer"] = args.pop(0), args.pop(0)
+            elif word in (b"COUNT", b"BLOCK"):
+                options[word.decode().lower()] = int(args.pop(0))
+            elif word == b"STREAMS":
+                [key, start] = args
+                break
+        group = self._group(key, options["group"])
+        count = options.get("count")
+        # BLOCK 0 waits for ever, or here for an hour
+        deadline = time.monotonic() + (options["block"] or 3_600_000) / 1000 if "block" in options else None
+        while True:
+            if start == b">":
+                entries = [(i, fields) for i, fields in self.streams[key] if i > group.last][:count]
+                if entries:
+                    group.last = entries[-1][0]
+                for entry_id, _ in entries:
+                    group.pending[entry_id] = [options["consumer"], _now_ms(), 1]
+            else:
+                entries = [
+                    (i, fields) for i, fields in self.streams[key]
+                    if i in group.pending and group.pending[i][0] == options["consumer"]
+                ][:count]
+            if entries or deadline is None or start != b">":
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            self._lock.wait(remaining)
+        if not entries:
+            return None
+        return [[key, [[_format_id(i), fields] for i, fields in entries]]]
+
+    def _xack(self, key, group, *ids):
+        pending = self._group(key, group).pending
+        return sum(pending.pop(_parse_id(entry_id), None) is not None for entry_id in ids)
+
+    def _xautoclaim(self, key, group, consumer, min_idle, start, *options):
+        count = int(options[options.index(b"COUNT") + 1]) if b"COUNT" in options else 100
+        pending, now = self._group(key, group).pending, _now_ms()
+        entries = dict(self.streams[key])
+        claimed = []
+        for entry_id, delivery in list(pending.items()):
+            if entry_id < _parse_id(start) or now - delivery[1] < int(min_idle):
+                continue
+            if len(claimed) == count:
+                return [_format_id(entry_id), claimed, []]
+            pending[entry_id] = [consumer, now, delivery[2] + 1]
+            claimed.append([_format_id(entry_id), entries[entry_id]])
+        return [b"0-0", claimed, []]
+
+    def _xpending(self, key, group):
+        pending = self._group(key, group).pending
+        if not pending:
+            return [0, None, None, None]
+        consumers = defaultdict(int)
+        for consumer, _, _ in pending.values():
+            consumers[consumer] += 1
+        ids = list(pending)
+        return [
+            len(pending), _format_id(min(ids)), _format_id(max(ids)),
+            [[consumer, str(n).encode()] for consumer, n in consumers.items()],
+        ]
+
+    def _group(self, key, group) -> _Group:
+        if group not in self.groups.get(key, {}):
+            raise _Error(f"NOGROUP No such key '{key.decode()}' or consumer group '{group.decode()}'")
+        return self.groups[key][group]
+
+    @staticmethod
+    def _read_command(rfile) -> List[bytes] | None:
+        header = rfile.readline()
+        if not header:
+            return None
+        if not header.startswith(b"*"):
+            return header.split()
+        command = []
+        for _ in range(int(header[1:])):
+            size = int(rfile.readline()[1:])
+            command.append(rfile.read(size + 2)[:-2])
+        return command
+
+    @classmethod
+    def _encode(cls, reply) -> bytes:
+        if reply is None:
+            return b"$-1\r\n"
+        if isinstance(reply, _Error):
+            return b"-" + str(reply).encode() + b"\r\n"
+        if isinstance(reply, str):
+            return b"+" + reply.encode() + b"\r\n"
+        if isinstance(reply, int):
+            return b":%d\r\n" % reply
+        if isinstance(reply, bytes):
+            return b"$%d\r\n%s\r\n" % (len(reply), reply)
+        return b"*%d\r\n" % len(reply) + b"".join(cls._encode(item) for item in reply)
@@ -0,0 +1,74 @@
+import asyncio
+
+from sqlalchemy import text
+
+from allocation import views
+from allocation.domain import model
+from allocation.service_layer import unit_of_work
+
+
+async def insert_batch(session, ref, sku, qty, eta, product_version=1):
+    await session.execute(
+        text("INSERT INTO products (sku, version_number) VALUES (:sku, :version)"),
+        dict(sku=sku, version=product_version),
+    )
+    await session.execute(
+        text("INSERT INTO batches (reference, sku, _purchased_quantity, eta)"
+             " VALUES (:ref, :sku, :qty, :eta)"),
+        dict(ref=ref, sku=sku, qty=qty, eta=eta),
+    )
+
+
+def test_uow_can_retrieve_a_product_and_allocate_to_it(async_sqlite_session_factory):
+    async def scenario():
+        async with async_sqlite_session_factory() as session:
+            await insert_batch(session, 'batch1', 'HIPSTER-WORKBENCH', 100, None)
+            await session.commit()
+
+        uow = unit_of_work.AsyncSqlAlchemyUnitOfWork(async_sqlite_session_factory)
+        async with uow:
+            product = await uow.products.get('HIPSTER-WORKBENCH')
+            product.allocate(model.OrderLine('o1', 'HIPSTER-WORKBENCH', 10))
+            await uow.commit()
+
+        async with uow:
+            product = await uow.products.get_by_batchref('batch1')
+            assert product.batches[0].available_quantity == 90
+        return await views.allocations_async('o1', uow)
+
+    assert asyncio.run(scenario()) == [{'sku': 'HIPSTER-WORKBENCH', 'batchref': 'batch1'}]
+
+
+def test_rolls_back_uncommitted_work_by_default(async_sqlite_session_factory):
+    async def scenario():
+        uow = unit_of_work.AsyncSqlAlchemyUnitOfWork(async_sqlite_session_factory)
+        async with uow:
+            await insert_batch(uow.session, 'ref', 'sku_123123', 100, None)
+        async with async_sqlite_session_factory() as session:
+            return list(await session.execute(text('SELECT * FROM "batches"')))
+
+    assert asyncio.run(scenario()) == []
+
+
+def test_concurrent_tasks_get_their_own_session(async_sqlite_session_factory):
+    uow = unit_of_work.AsyncSqlAlchemyUnitOfWork(async_sqlite_session_factory)
+
+    async def open_session(entered, release):
+        async with uow:
+            session = uow.session
+            entered.set()
+            await release.wait()
+            assert uow.session is session
+            return session
+
+    async def scenario():
+        entered1, entered2, release = asyncio.Event(), asyncio.Event(), asyncio.Event()
+        task1 = asyncio.create_task(open_session(entered1, release))
+        task2 = asyncio.create_task(open_session(entered2, release))
+        await entered1.wait()
+        await entered2.wait()
+        release.set()
+        return await asyncio.gather(task1, task2)
+
+    session1, session2 = asyncio.run(scenario())
+    assert session1 is not session2
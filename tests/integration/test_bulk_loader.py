@@ -0,0 +1,103 @@
+import json
+
+import pytest
+
+import bootstrap
+from allocation.adapters import notifications
+from allocation.domain import commands
+from allocation.entrypoints import bulk_loader
+from allocation.service_layer import unit_of_work
+
+
+class NoNotifications(notifications.AbstractNotifications):
+    def send(self, destination, message):
+        pass
+
+
+@pytest.fixture
+def bus(sqlite_session_factory):
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=NoNotifications(),
+        publish=lambda *args: None,
+    )
+
+
+def loaded_batches(bus):
+    with bus.uow:
+        rows = bus.uow.session.execute(
+            "SELECT sku, reference, _purchased_quantity, eta FROM batches ORDER BY reference"
+        )
+        return [tuple(row) for row in rows]
+
+
+def write_csv(path, rows):
+    path.write_text("ref,sku,qty,eta\n" + "".join(f"{ref},{sku},{qty},{eta}\n" for ref, sku, qty, eta in rows))
+    return path
+
+
+def test_loads_a_csv_file_in_chunks(bus, tmp_path):
+    path = write_csv(tmp_path / "batches.csv", [
+        ("b1", "LAMP", 10, "2011-01-02"),
+        ("b2", "RUG", 20, ""),
+        ("b3", "LAMP", 30, ""),
+    ])
+
+    report = bulk_loader.load(path, bus, chunk_size=2)
+
+    assert report.rows == 3
+    assert loaded_batches(bus) == [
+        ("LAMP", "b1", 10, "2011-01-02"), ("RUG", "b2", 20, None), ("LAMP", "b3", 30, None),
+    ]
+    with bus.uow:
+        assert [b.reference for b in bus.uow.products.get("LAMP").batches] == ["b1", "b3"]
+
+
+def test_loads_json_lines_and_skips_known_references(bus, tmp_path):
+    bus.handle(commands.CreateBatch("b1", "LAMP", 10, None))
+    path = tmp_path / "batches.jsonl"
+    path.write_text("\n".join(json.dumps(row) for row in [
+        dict(ref="b1", sku="LAMP", qty=99),
+        dict(ref="b2", sku="LAMP", qty=20, eta=None),
+    ]))
+
+    bulk_loader.load(path, bus)
+
+    assert loaded_batches(bus) == [("LAMP", "b1", 10, None), ("LAMP", "b2", 20, None)]
+    with bus.uow:
+        # existing products get a new version, so no stale copy of them wins
+        assert bus.uow.products.get("LAMP").version_number == 2
+
+
+def test_resumes_after_the_last_committed_chunk(bus, tmp_path):
+    path = write_csv(tmp_path / "batches.csv", [(f"b{n}", "LAMP", 1, "") for n in range(5)])
+    checkpoint = tmp_path / "batches.checkpoint"
+    sent = []
+
+    class FailingBus:
+        uow = bus.uow
+
+        def handle(self, command):
+            if len(sent) == 1:
+                raise ConnectionError("database went away")
+            sent.append(command)
+            bus.handle(command)
+
+    with pytest.raises(ConnectionError):
+        bulk_loader.load(path, FailingBus(), chunk_size=2, checkpoint=checkpoint)
+    assert json.loads(checkpoint.read_text())["rows"] == 2
+
+    report = bulk_loader.load(path, bus, chunk_size=2, checkpoint=checkpoint)
+
+    assert (report.resumed_from, report.rows) == (2, 3)
+    assert [ref for _, ref, _, _ in loaded_batches(bus)] == [f"b{n}" for n in range(5)]
+    assert not checkpoint.exists()
+
+
+def test_refuses_a_checkpoint_for_another_file(bus, tmp_path):
+    checkpoint = tmp_path / "batches.checkpoint"
+    bulk_loader.write_checkpoint(checkpoint, tmp_path / "other.csv", 10)
+
+    with pytest.raises(ValueError):
+        bulk_loader.load(write_csv(tmp_path / "batches.csv", []), bus, checkpoint=checkpoint)
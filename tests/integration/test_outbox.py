@@ -0,0 +1,88 @@
+import json
+from datetime import datetime, timedelta
+from unittest import mock
+
+import pytest
+import redis
+
+import bootstrap
+from allocation.adapters import outbox
+from allocation.domain import commands, model
+from allocation.service_layer import unit_of_work
+
+
+@pytest.fixture
+def published():
+    return []
+
+
+@pytest.fixture
+def bus(sqlite_file_session_factory, published):
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_file_session_factory, outbox=True),
+        notifications=mock.Mock(),
+        publish=lambda channel, event: published.append((channel, event)),
+    )
+
+
+def outbox_rows(session_factory):
+    session = session_factory()
+    return [tuple(row) for row in session.execute("SELECT channel, payload FROM outbox ORDER BY id")]
+
+
+def allocate(bus, *orderids):
+    bus.handle(commands.CreateBatch("batch1", "LAMP", 100, None))
+    for orderid in orderids:
+        bus.handle(commands.Allocate(orderid, "LAMP", 1))
+
+
+def test_allocated_events_go_to_the_outbox_instead_of_redis(bus, sqlite_file_session_factory, published):
+    allocate(bus, "o1")
+
+    assert published == []
+    [(channel, payload)] = outbox_rows(sqlite_file_session_factory)
+    assert channel == "line_allocated"
+    assert json.loads(payload) == dict(orderid="o1", sku="LAMP", qty=1, batchref="batch1")
+
+
+def test_nothing_reaches_the_outbox_from_a_rolled_back_unit_of_work(bus, sqlite_file_session_factory):
+    allocate(bus)
+    with bus.uow:
+        bus.uow.products.get("LAMP").allocate(model.OrderLine("o1", "LAMP", 1))
+
+    assert outbox_rows(sqlite_file_session_factory) == []
+
+
+def test_relay_publishes_in_batches_and_empties_the_outbox(bus, sqlite_file_session_factory, fake_redis):
+    allocate(bus, "o1", "o2", "o3")
+    now = datetime.utcnow()
+    relay = outbox.OutboxRelay(
+        sqlite_file_session_factory, redis.Redis(**fake_redis.connection_kwargs()), batch_size=2,
+        clock=lambda: now + timedelta(seconds=5),
+    )
+
+    assert relay.relay_once() == 2
+    assert relay.backlog() == 1
+    assert relay.relay_once() == 1
+    assert relay.relay_once() == 0
+
+    assert [json.loads(message)["orderid"] for _, message in fake_redis.published] == ["o1", "o2", "o3"]
+    assert {channel for channel, _ in fake_redis.published} == {"line_allocated"}
+    assert outbox_rows(sqlite_file_session_factory) == []
+    stats = relay.stats()
+    assert (stats["relayed"], stats["batches"]) == (3, 2)
+    assert 5 <= stats["max_lag"] < 10
+
+
+def test_events_stay_in_the_outbox_until_redis_takes_them(bus, sqlite_file_session_factory, fake_redis):
+    allocate(bus, "o1")
+    down = outbox.OutboxRelay(sqlite_file_session_factory, redis.Redis(port=1))
+
+    with pytest.raises(redis.ConnectionError):
+        down.relay_once()
+    assert len(outbox_rows(sqlite_file_session_factory)) == 1
+
+    outbox.OutboxRelay(sqlite_file_session_factory, redis.Redis(**fake_redis.connection_kwargs())).relay_once()
+    assert len(fake_redis.published) == 1
+    assert outbox_rows(sqlite_file_session_factory) == []
@@ -0,0 +1,160 @@
+import threading
+from unittest import mock
+
+import pytest
+
+import bootstrap
+from allocation.adapters import repository
+from allocation.adapters.instrumentation import ConflictMetrics
+from allocation.domain import commands, model
+from allocation.service_layer import messagebus, unit_of_work
+
+
+@pytest.fixture
+def cache():
+    return repository.ProductCache()
+
+
+def add_product(session_factory, sku, qty=100):
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+        uow.products.add(model.Product(sku, [model.Batch(f"{sku}-batch", sku, qty, None)]))
+        uow.commit()
+
+
+def allocate(uow, orderid, sku, qty=1):
+    with uow:
+        product = uow.products.get(sku)
+        product.allocate(model.OrderLine(orderid, sku, qty))
+        uow.commit()
+        return product
+
+
+def allocated_orders(session_factory, sku):
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+        return {line.orderid for batch in uow.products.get(sku).batches for line in batch._allocations}
+
+
+def test_reuses_the_product_while_its_version_is_current(sqlite_session_factory, cache):
+    add_product(sqlite_session_factory, "LAMP")
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, product_cache=cache)
+
+    first = allocate(uow, "o1", "LAMP")
+    second = allocate(uow, "o2", "LAMP")
+
+    assert second is first
+    assert cache.stats() == dict(size=1, hits=1, misses=1, stale=0, evictions=0)
+    assert allocated_orders(sqlite_session_factory, "LAMP") == {"o1", "o2"}
+
+
+def test_reloads_a_product_another_writer_changed(sqlite_session_factory, cache):
+    add_product(sqlite_session_factory, "LAMP")
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, product_cache=cache)
+    cached = allocate(uow, "o1", "LAMP")
+
+    # another process: no cache, and a change that only touches a batch
+    with unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory) as other:
+        other.products.get("LAMP").deallocate(model.OrderLine("o1", "LAMP", 1))
+        other.commit()
+
+    reloaded = allocate(uow, "o2", "LAMP")
+    assert reloaded is not cached
+    assert cache.stale == 1
+    assert allocated_orders(sqlite_session_factory, "LAMP") == {"o2"}
+
+
+def test_a_write_racing_a_cached_product_fails_and_is_not_cached(sqlite_session_factory, cache):
+    add_product(sqlite_session_factory, "LAMP")
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, product_cache=cache)
+    allocate(uow, "o1", "LAMP")
+
+    with pytest.raises(unit_of_work.ConcurrencyConflict):
+        with uow:
+            product = uow.products.get("LAMP")
+            # another writer commits between the version check and our commit
+            allocate(unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory), "o2", "LAMP")
+            product.allocate(model.OrderLine("o3", "LAMP", 1))
+            uow.commit()
+
+    assert len(cache) == 0
+    assert allocated_orders(sqlite_session_factory, "LAMP") == {"o1", "o2"}
+    allocate(uow, "o4", "LAMP")
+    assert allocated_orders(sqlite_session_factory, "LAMP") == {"o1", "o2", "o4"}
+
+
+def test_evicts_the_least_recently_used_product(sqlite_session_factory):
+    cache = repository.ProductCache(maxsize=1)
+    add_product(sqlite_session_factory, "LAMP")
+    add_product(sqlite_session_factory, "RUG")
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, product_cache=cache)
+    allocate(uow, "o1", "LAMP")
+    allocate(uow, "o2", "RUG")
+
+    assert cache.evictions == 1
+    assert cache.check_out("RUG", 2) is not None
+
+
+def test_events_are_collected_before_the_product_goes_back(sqlite_session_factory, cache):
+    add_product(sqlite_session_factory, "LAMP")
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, product_cache=cache)
+    product = allocate(uow, "o1", "LAMP")
+
+    assert product.events == []
+    assert [event.orderid for event in uow.collect_new_events()] == ["o1"]
+    assert list(uow.collect_new_events()) == []
+
+
+def test_concurrent_writers_never_lose_an_update(sqlite_file_session_factory, cache):
+    threads, orders = 6, 15
+    add_product(sqlite_file_session_factory, "LAMP", qty=1000)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_file_session_factory, product_cache=cache)
+    committed, conflicts = [], []
+
+    def work(n):
+        for i in range(orders):
+            orderid = f"order-{n}-{i}"
+            try:
+                allocate(uow, orderid, "LAMP")
+                committed.append(orderid)
+            except unit_of_work.ConcurrencyConflict:
+                conflicts.append(orderid)
+
+    workers = [threading.Thread(target=work, args=(n,)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert len(committed) + len(conflicts) == threads * orders
+    assert allocated_orders(sqlite_file_session_factory, "LAMP") == set(committed)
+    with uow:
+        product = uow.products.get("LAMP")
+        assert product.batches[0].available_quantity == 1000 - len(committed)
+        product.check_consistency()
+
+
+def test_retried_writers_all_get_through(sqlite_file_session_factory, cache):
+    threads, orders = 4, 10
+    add_product(sqlite_file_session_factory, "LAMP", qty=1000)
+    metrics = ConflictMetrics()
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_file_session_factory, product_cache=cache),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+        command_retries={commands.Allocate: messagebus.RetryPolicy(attempts=50, initial_wait=0.001, max_wait=0.05)},
+        conflict_metrics=metrics,
+    )
+
+    def work(n):
+        for i in range(orders):
+            bus.handle(commands.Allocate(f"order-{n}-{i}", "LAMP", 1))
+
+    workers = [threading.Thread(target=work, args=(n,)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert metrics.commands["Allocate"] == threads * orders
+    assert metrics.gave_up["Allocate"] == 0
+    assert len(allocated_orders(sqlite_file_session_factory, "LAMP")) == threads * orders
@@ -0,0 +1,61 @@
+import re
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+import bootstrap
+from allocation import views
+from allocation.adapters import notifications, repository
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+
+FULL_SCAN = re.compile(r"^SCAN (?!CONSTANT ROW)")
+
+
+@contextmanager
+def recording_statements(engine):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not statement.lstrip().upper().startswith("INSERT"):
+            statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+
+
+def full_scans(engine, statement, parameters):
+    with engine.connect() as conn:
+        plan = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).all()
+    return [detail for *_, detail in plan if FULL_SCAN.match(detail)]
+
+
+@pytest.mark.parametrize("strategy", repository.LOADING_STRATEGIES)
+def test_hot_paths_do_not_scan_whole_tables(in_memory_db, sqlite_session_factory, strategy):
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, load=repository.LOADING_STRATEGIES[strategy]),
+        notifications=notifications.EmailNotifications(),
+        publish=lambda *args: None,
+    )
+    # enough rows that a scan would be a plausible plan for the planner
+    for n in range(20):
+        bus.handle(commands.CreateBatch(f"other-batch-{n}", f"OTHER-{n}", 100, None))
+        bus.handle(commands.Allocate(f"other-order-{n}", f"OTHER-{n}", 1))
+
+    with recording_statements(in_memory_db) as statements:
+        bus.handle(commands.CreateBatch("batch1", "LAMP", 100, None))
+        bus.handle(commands.CreateBatch("batch2", "LAMP", 100, None))
+        bus.handle(commands.Allocate("order1", "LAMP", 10))
+        bus.handle(commands.Allocate("order2", "LAMP", 80))
+        bus.handle(commands.ChangeBatchQuantity("batch1", 50))
+        bus.handle(commands.DeAllocate("order1", "LAMP", 10))
+        assert views.allocations("order2", bus.uow) == [{"sku": "LAMP", "batchref": "batch2"}]
+
+    assert statements
+    scans = {statement: full_scans(in_memory_db, statement, parameters) for statement, parameters in statements}
+    assert {statement: scan for statement, scan in scans.items() if scan} == {}
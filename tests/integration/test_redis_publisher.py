@@ -0,0 +1,80 @@
+import json
+from unittest import mock
+
+import pytest
+import redis
+
+import bootstrap
+from allocation.adapters import redis_eventpublisher
+from allocation.domain import commands, events
+from allocation.service_layer import unit_of_work
+
+
+@pytest.fixture
+def client(fake_redis):
+    return redis.Redis(**fake_redis.connection_kwargs())
+
+
+def allocated(n):
+    return events.Allocated(f"o{n}", "LAMP", 1, "batch1")
+
+
+def test_buffers_until_max_events(fake_redis, client):
+    publisher = redis_eventpublisher.BufferedPublisher(client, max_events=3, max_delay=60)
+
+    publisher("line_allocated", allocated(1))
+    publisher("line_allocated", allocated(2))
+    assert fake_redis.published == []
+
+    publisher("line_allocated", allocated(3))
+    assert [json.loads(message)["orderid"] for _, message in fake_redis.published] == ["o1", "o2", "o3"]
+    assert fake_redis.commands["PUBLISH"] == 3
+    assert (publisher.published, publisher.flushes) == (3, 1)
+
+
+def test_flushes_once_the_oldest_event_waited_max_delay(fake_redis, client):
+    now = [0.0]
+    publisher = redis_eventpublisher.BufferedPublisher(client, max_events=100, max_delay=0.05, clock=lambda: now[0])
+
+    publisher("line_allocated", allocated(1))
+    now[0] = 0.06
+    publisher("line_allocated", allocated(2))
+
+    assert len(fake_redis.published) == 2
+
+
+def test_keeps_the_events_of_a_failed_flush_for_the_next_one(fake_redis, client):
+    publisher = redis_eventpublisher.BufferedPublisher(redis.Redis(port=1), max_events=2, max_delay=60)
+
+    publisher("line_allocated", allocated(1))
+    publisher("line_allocated", allocated(2))
+    with pytest.raises(redis.ConnectionError):
+        publisher.flush()
+    publisher("line_allocated", allocated(3))
+    publisher.client = client
+    publisher.flush()
+
+    assert [json.loads(message)["orderid"] for _, message in fake_redis.published] == ["o1", "o2", "o3"]
+    assert (publisher.published, publisher.flushes) == (3, 1)
+
+
+def test_the_bus_flushes_at_the_end_of_every_handle(fake_redis, client, sqlite_session_factory):
+    publisher = redis_eventpublisher.BufferedPublisher(client, max_events=100, max_delay=60)
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=mock.Mock(),
+        publish=publisher,
+    )
+    bus.handle(commands.CreateBatch("batch1", "LAMP", 100, None))
+
+    bus.handle(commands.AllocateMany("LAMP", [commands.AllocationLine(f"o{n}", 1) for n in range(5)]))
+
+    assert [channel for channel, _ in fake_redis.published] == ["line_allocated"] * 5
+    assert publisher.flushes == 1
+
+
+def test_serializes_like_json_dumps():
+    assert json.loads(redis_eventpublisher.serialize(allocated(1))) == dict(
+        orderid="o1", sku="LAMP", qty=1, batchref="batch1",
+    )
@@ -1,7 +1,9 @@
 import pytest
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql
 
-from allocation.adapters import repository
-from allocation.domain import model
+from allocation.adapters import instrumentation, repository
+from allocation.domain import events, model
 
 
 def test_repository_can_save_a_batch(session):
@@ -62,3 +64,73 @@ def test_repository_can_retrieve_a_product_with_allocations(session):
     # assert retrieved_product == expected
 
     assert retrieved_product.batches[-1]._allocations == {model.OrderLine("order1", "GENERIC-SOFA", 12)}
+
+
+def add_product_with_allocations(session, sku, batches, lines_per_batch):
+    product = model.Product(sku, [])
+    for b in range(batches):
+        batch = model.Batch(f"{sku}-batch-{b}", sku, 1000, eta=None)
+        for n in range(lines_per_batch):
+            batch.allocate(model.OrderLine(f"order-{b}-{n}", sku, 1))
+        product.add_batch(batch)
+    session.add(product)
+    session.commit()
+    session.close()
+
+
+@pytest.mark.parametrize("strategy, queries", [
+    ("lazy", 2 + 3),
+    ("selectin", 3),
+    ("single_query", 1),
+])
+def test_loading_strategies_load_the_whole_aggregate(sqlite_session_factory, strategy, queries):
+    add_product_with_allocations(sqlite_session_factory(), "GENERIC-SOFA", 3, 4)
+    add_product_with_allocations(sqlite_session_factory(), "OTHER-SOFA", 2, 1)
+    counter = instrumentation.QueryCounter().attach()
+    try:
+        repo = repository.SqlProductRepository(sqlite_session_factory(), repository.LOADING_STRATEGIES[strategy])
+
+        def load(ref):
+            product = repo.get_by_batchref(ref)
+            return {b.reference: b.allocated_quantity for b in product.batches}
+
+        loaded = counter.counting("load", load)("GENERIC-SOFA-batch-1")
+    finally:
+        counter.detach()
+
+    assert loaded == {f"GENERIC-SOFA-batch-{b}": 4 for b in range(3)}
+    assert counter.queries["load"] == queries
+
+
+@pytest.mark.parametrize("cache", [None, repository.ProductCache()])
+@pytest.mark.parametrize("strategy", ["selectin", "single_query"])
+def test_pessimistic_repository_locks_the_product_row(sqlite_session_factory, strategy, cache):
+    add_product_with_allocations(sqlite_session_factory(), "GENERIC-SOFA", 2, 1)
+    session = sqlite_session_factory()
+    statements = []
+    event.listen(session, "do_orm_execute", lambda state: statements.append(
+        str(state.statement.compile(dialect=postgresql.dialect()))
+    ))
+    repo = repository.SqlProductRepository(session, repository.LOADING_STRATEGIES[strategy], cache, lock=True)
+
+    assert len(repo.get("GENERIC-SOFA").batches) == 2
+    assert "FOR UPDATE OF products" in statements[0]
+
+
+@pytest.mark.parametrize("strategy", repository.LOADING_STRATEGIES)
+def test_fifo_displacement_survives_a_reload(sqlite_session_factory, strategy):
+    session = sqlite_session_factory()
+    repository.SqlProductRepository(session).add(model.Product("LAMP", [model.Batch("batch1", "LAMP", 40, None)]))
+    session.commit()
+    # one allocation per transaction, as the message bus makes them
+    for n in range(40):
+        session = sqlite_session_factory()
+        repository.SqlProductRepository(session).get("LAMP").allocate(model.OrderLine(f"order-{n:02}", "LAMP", 1))
+        session.commit()
+
+    repo = repository.SqlProductRepository(sqlite_session_factory(), repository.LOADING_STRATEGIES[strategy])
+    product = repo.get("LAMP")
+    product.change_batch_quantity("batch1", 37, model.ReallocationPolicy(displace=model.displace_oldest_first))
+
+    displaced = [e.orderid for e in product.events if isinstance(e, events.Deallocated)]
+    assert displaced == ["order-00", "order-01", "order-02"]
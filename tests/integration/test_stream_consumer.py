@@ -0,0 +1,173 @@
+import json
+from unittest import mock
+
+import pytest
+import redis
+
+import bootstrap
+from allocation import views
+from allocation.domain import commands
+from allocation.entrypoints import redis_eventconsumer
+from allocation.service_layer import unit_of_work
+
+
+@pytest.fixture
+def client(fake_redis):
+    return redis.Redis(**fake_redis.connection_kwargs())
+
+
+@pytest.fixture
+def bus(sqlite_file_session_factory):
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_file_session_factory),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+    )
+    for ref in ("b1", "b2", "b3"):
+        bus.handle(commands.CreateBatch(ref, f"sku-{ref}", 100, None))
+    return bus
+
+
+@pytest.fixture
+def make_consumer(client, bus):
+    consumers = []
+
+    def make(bus=bus, **kwargs):
+        consumer = redis_eventconsumer.StreamConsumer(client, bus, block_ms=10, **kwargs)
+        consumer.create_group()
+        consumers.append(consumer)
+        return consumer
+
+    yield make
+    for consumer in consumers:
+        consumer.close()
+
+
+def send(client, batchref, qty):
+    client.xadd(redis_eventconsumer.STREAM, {"data": json.dumps(dict(batchref=batchref, qty=qty))})
+
+
+def quantities(bus):
+    with bus.uow:
+        return {
+            ref: bus.uow.products.get_by_batchref(ref).batches[0]._purchased_quantity
+            for ref in ("b1", "b2", "b3")
+        }
+
+
+def test_handles_a_batch_in_order_per_reference_and_acks_it(client, bus, make_consumer):
+    consumer = make_consumer(workers=2)
+    for qty in (90, 80, 70):
+        send(client, "b1", qty)
+    send(client, "b2", 50)
+
+    assert consumer.process(consumer.read()) == 4
+
+    assert quantities(bus) == dict(b1=70, b2=50, b3=100)
+    assert consumer.pending() == 0
+    stats = consumer.stats()
+    assert (stats["consumed"], stats["acked"], stats["failed"]) == (4, 4, 0)
+    assert 0 <= stats["lag"] < 5
+
+
+def test_messages_sent_before_the_consumer_started_are_not_lost(client, bus, make_consumer):
+    send(client, "b3", 10)
+
+    consumer = make_consumer()
+
+    consumer.process(consumer.read())
+    assert quantities(bus)["b3"] == 10
+
+
+def test_a_failed_message_stays_pending_and_is_claimed_again(client, bus, make_consumer):
+    failing_bus = mock.Mock(uow=bus.uow, handle=mock.Mock(side_effect=ConnectionError("database went away")))
+    dying = make_consumer(bus=failing_bus, consumer="dying")
+    send(client, "b1", 60)
+    send(client, "b1", 40)
+
+    assert dying.process(dying.read()) == 0
+    assert failing_bus.handle.call_count == 1
+    assert dying.pending() == 2
+
+    survivor = make_consumer(consumer="survivor", claim_idle_ms=0)
+    assert survivor.read() == []
+    assert survivor.process(survivor.reclaim()) == 2
+    assert quantities(bus)["b1"] == 40
+    assert survivor.pending() == 0
+    assert survivor.stats()["reclaimed"] == 2
+
+
+def flaky(bus, failures):
+    failures = list(failures)
+
+    def handle(message):
+        if failures:
+            raise failures.pop(0)
+        bus.handle(message)
+
+    return mock.Mock(uow=bus.uow, handle=handle)
+
+
+@pytest.mark.parametrize("coalesce", [False, True])
+def test_a_reclaimed_change_does_not_overwrite_a_newer_one(client, bus, make_consumer, coalesce):
+    consumer = make_consumer(bus=flaky(bus, [ConnectionError("database went away")]), claim_idle_ms=0, coalesce=coalesce)
+    send(client, "b1", 10)
+    assert consumer.process(consumer.read()) == 0
+    send(client, "b1", 20)
+    assert consumer.process(consumer.read()) == 1
+
+    assert consumer.process(consumer.reclaim()) == 1
+
+    assert quantities(bus)["b1"] == 20
+    assert consumer.pending() == 0
+    assert consumer.stats()["superseded"] == 1
+
+
+def test_malformed_messages_are_dropped(client, bus, make_consumer):
+    consumer = make_consumer()
+    client.xadd(redis_eventconsumer.STREAM, {"data": json.dumps(dict(qty=1))})
+    send(client, "b2", 30)
+
+    assert consumer.process(consumer.read()) == 2
+    assert consumer.stats()["malformed"] == 1
+    assert quantities(bus)["b2"] == 30
+
+
+def test_coalesces_changes_to_the_same_batch_within_a_window(client, bus, make_consumer):
+    bus.handle(commands.CreateBatch("b1-later", "sku-b1", 100, None))
+    bus.handle(commands.Allocate("o1", "sku-b1", 10))
+    consumer = make_consumer(window_ms=20)
+    handled = []
+    handle = bus.handle
+    bus.handle = lambda message: handled.append(message) or handle(message)
+    # b1 is briefly emptied, which alone would move o1 to b1-later
+    for qty in (0, 5, 100):
+        send(client, "b1", qty)
+    send(client, "b1-later", 90)
+    send(client, "b2", 20)
+
+    assert consumer.process(consumer.read_window()) == 5
+
+    assert consumer.stats()["collapsed"] == 2
+    assert consumer.stats()["transactions_saved"] == 3
+    assert sorted(type(m).__name__ for m in handled) == ["ChangeBatchQuantities", "ChangeBatchQuantities"]
+    assert views.allocations("o1", bus.uow) == [dict(sku="sku-b1", batchref="b1")]
+    with bus.uow:
+        assert {b.reference: b._purchased_quantity for b in bus.uow.products.get("sku-b1").batches} == {
+            "b1": 100, "b1-later": 90,
+        }
+    assert consumer.pending() == 0
+
+
+def test_without_coalescing_every_change_is_applied(client, bus, make_consumer):
+    bus.handle(commands.CreateBatch("b1-later", "sku-b1", 100, None))
+    bus.handle(commands.Allocate("o1", "sku-b1", 10))
+    consumer = make_consumer(coalesce=False)
+    for qty in (0, 100):
+        send(client, "b1", qty)
+
+    assert consumer.process(consumer.read()) == 2
+
+    assert (consumer.stats()["collapsed"], consumer.stats()["transactions_saved"]) == (0, 0)
+    assert views.allocations("o1", bus.uow) == [dict(sku="sku-b1", batchref="b1-later")]
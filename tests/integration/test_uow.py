@@ -4,8 +4,12 @@ import traceback
 from typing import List
 
 import pytest
+from sqlalchemy import inspect
 
-from allocation.domain import model
+import bootstrap
+from allocation import views
+from allocation.adapters import notifications, repository
+from allocation.domain import commands, model
 from allocation.service_layer import unit_of_work
 from ..random_refs import random_sku, random_batchref, random_orderid
 
@@ -78,10 +82,10 @@ def test_uow_can_retrieve_a_batch_and_allocate_to_it(sqlite_session_factory):
 
 
 #########
-def try_to_allocate(orderid, sku, exceptions, ref, session_factory):
+def try_to_allocate(orderid, sku, exceptions, ref, session_factory, locking="optimistic"):
     line = model.OrderLine(orderid, sku, 10)
     try:
-        with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+        with unit_of_work.SqlAlchemyUnitOfWork(session_factory, locking=locking) as uow:
             product = uow.products.get(sku=sku)
             product.allocate(line)
             ref[0] = list(product.batches[0]._allocations)[0].orderid
@@ -128,3 +132,129 @@ def test_concurrent_updates_to_version_are_not_allowed(postgres_session_factory)
     assert orders.rowcount == 1
     with unit_of_work.SqlAlchemyUnitOfWork() as uow:
         uow.session.execute("select 1")
+
+
+def test_pessimistic_locking_makes_concurrent_updates_wait(postgres_session_factory):
+    sku, batch = random_sku(), random_batchref()
+    session = postgres_session_factory()
+    insert_batch(session, batch, sku, 100, eta=None, product_version=1)
+    session.commit()
+
+    exceptions = []  # type: List[Exception]
+    # the units of work use the session factory, and isolation level, of production
+    threads = [
+        threading.Thread(target=try_to_allocate, args=(
+            random_orderid(n), sku, exceptions, [None], None, "pessimistic",
+        ))
+        for n in (1, 2)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    [[version]] = session.execute(
+        "SELECT version_number FROM products WHERE sku=:sku",
+        dict(sku=sku),
+    )
+    assert version == 3
+    assert exceptions == []
+
+
+def test_pessimistic_sessions_read_committed_rows():
+    [optimistic, pessimistic] = (
+        unit_of_work.default_session_factory(locking).kw["bind"] for locking in repository.LOCKING_STRATEGIES
+    )
+    assert pessimistic.pool is optimistic.pool
+    assert optimistic.dialect.isolation_level == "REPEATABLE READ"
+    assert pessimistic.get_execution_options()["isolation_level"] == "READ COMMITTED"
+
+
+def test_rejects_an_unknown_locking_strategy(sqlite_session_factory):
+    with pytest.raises(ValueError, match="Unknown locking strategy"):
+        unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, locking="hopeful")
+
+
+def test_allocated_quantity_survives_a_reload(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, 'batch1', 'LUMPY-SOFA', 100, None)
+    session.commit()
+
+    with unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory) as uow:
+        product = uow.products.get('LUMPY-SOFA')
+        product.allocate(model.OrderLine('o1', 'LUMPY-SOFA', 10))
+        product.allocate(model.OrderLine('o2', 'LUMPY-SOFA', 15))
+        uow.commit()
+
+    with unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory) as uow:
+        product = uow.products.get('LUMPY-SOFA')
+        [batch] = product.batches
+        assert batch.available_quantity == 75
+        product.deallocate(model.OrderLine('o1', 'LUMPY-SOFA', 10))
+        assert batch.available_quantity == 85
+        product.check_consistency()
+
+
+def test_threads_sharing_one_bus_get_their_own_unit_of_work(sqlite_file_session_factory):
+    threads, orders = 8, 25
+    published = []
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_file_session_factory),
+        notifications=notifications.EmailNotifications(),
+        publish=lambda channel, event: published.append(event),
+    )
+    barrier = threading.Barrier(threads)
+    leaks = []
+    allocate = bus.command_handler[commands.Allocate]
+
+    def allocate_and_check(command):
+        allocate(command)
+        # the products are expired by now, their identity is still known
+        seen = {inspect(product).identity for product in bus.uow.products.seen}
+        if seen != {(command.sku,)}:
+            leaks.append((command.sku, seen))
+
+    bus.command_handler[commands.Allocate] = allocate_and_check
+
+    def work(n):
+        sku = f"sku-{n}"
+        bus.handle(commands.CreateBatch(f"batch-{n}", sku, 1000, None))
+        barrier.wait()
+        for i in range(orders):
+            bus.handle(commands.Allocate(f"{sku}-order-{i}", sku, 1))
+
+    workers = [threading.Thread(target=work, args=(n,)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert leaks == []
+    assert len(published) == threads * orders
+    assert all(event.orderid.startswith(f"{event.sku}-") for event in published)
+    for n in range(threads):
+        assert views.allocations(f"sku-{n}-order-0", bus.uow) == [{"sku": f"sku-{n}", "batchref": f"batch-{n}"}]
+        with bus.uow:
+            product = bus.uow.products.get(f"sku-{n}")
+            assert product.batches[0].available_quantity == 1000 - orders
+
+
+def test_sharded_bus_sends_batch_changes_to_the_shard_of_their_product(sqlite_file_session_factory):
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_file_session_factory),
+        notifications=notifications.EmailNotifications(),
+        publish=lambda *args: None,
+        shards=8,
+        uow_factory=lambda: unit_of_work.SqlAlchemyUnitOfWork(sqlite_file_session_factory),
+    )
+    try:
+        for n in range(8):
+            bus.handle(commands.CreateBatch(f"batch-{n}", f"sku-{n}", 100, None))
+        for n in range(8):
+            change = commands.ChangeBatchQuantity(f"batch-{n}", 50)
+            assert bus.shard_for(change) == bus.shard_for(commands.Allocate("o1", f"sku-{n}", 1))
+            bus.handle(change)
+    finally:
+        bus.close()
@@ -6,7 +6,9 @@ from sqlalchemy.orm import clear_mappers
 
 import bootstrap
 from allocation import views
-from allocation.domain import commands
+from allocation.adapters import orm
+from allocation.adapters.cache import LRUCache
+from allocation.domain import commands, model
 from allocation.service_layer import unit_of_work
 
 today = datetime.today()
@@ -15,12 +17,18 @@ next_week = datetime.today() + timedelta(days=7)
 
 
 @pytest.fixture
-def sqlite_bus(sqlite_session_factory):
+def allocations_cache():
+    return LRUCache()
+
+
+@pytest.fixture
+def sqlite_bus(sqlite_session_factory, allocations_cache):
     bus = bootstrap.bootstrap(
         start_orm=False,
         uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
         notifications=mock.Mock(),
         publish=lambda *args: None,
+        allocations_cache=allocations_cache,
     )
     yield bus
     clear_mappers()
@@ -39,3 +47,98 @@ def test_allocations_view(sqlite_bus):
         {'sku': 'sku1', 'batchref': 'sku1batch'},
         {'sku': 'sku2', 'batchref': 'sku2batch'},
     ]
+
+
+def test_reallocation_moves_the_allocation_in_the_view(sqlite_bus):
+    sqlite_bus.handle(commands.CreateBatch('b1', 'sku1', 50, None))
+    sqlite_bus.handle(commands.CreateBatch('b2', 'sku1', 50, today))
+    sqlite_bus.handle(commands.Allocate('o1', 'sku1', 40))
+    sqlite_bus.handle(commands.ChangeBatchQuantity('b1', 10))
+
+    assert views.allocations('o1', sqlite_bus.uow) == [
+        {'sku': 'sku1', 'batchref': 'b2'},
+    ]
+
+
+def test_deallocate_removes_the_allocation_from_the_view(sqlite_bus):
+    sqlite_bus.handle(commands.CreateBatch('b1', 'sku1', 50, None))
+    sqlite_bus.handle(commands.Allocate('o1', 'sku1', 10))
+    sqlite_bus.handle(commands.Allocate('o1', 'sku1', 20))
+    sqlite_bus.handle(commands.DeAllocate('o1', 'sku1', 10))
+
+    assert views.allocations('o1', sqlite_bus.uow) == [
+        {'sku': 'sku1', 'batchref': 'b1'},
+    ]
+
+
+def test_the_view_is_written_in_the_transaction_that_allocates(sqlite_bus):
+    sqlite_bus.handle(commands.CreateBatch('b1', 'sku1', 50, None))
+    uow = sqlite_bus.uow
+    with uow:
+        uow.products.get('sku1').allocate(model.OrderLine('o1', 'sku1', 10))
+    assert views.allocations('o1', uow) == []
+
+    with uow:
+        uow.products.get('sku1').allocate(model.OrderLine('o1', 'sku1', 10))
+        uow.commit()
+    assert views.allocations('o1', uow) == [{'sku': 'sku1', 'batchref': 'b1'}]
+
+
+def test_creating_the_view_in_an_existing_database_fills_it(sqlite_bus, in_memory_db):
+    sqlite_bus.handle(commands.CreateBatch('b1', 'sku1', 50, None))
+    sqlite_bus.handle(commands.Allocate('o1', 'sku1', 10))
+    orm.allocations_view.drop(in_memory_db)
+
+    orm.create_schema(in_memory_db)
+
+    assert views.allocations('o1', sqlite_bus.uow) == [{'sku': 'sku1', 'batchref': 'b1'}]
+
+
+def test_rebuilding_the_view_from_the_allocations(sqlite_bus):
+    sqlite_bus.handle(commands.CreateBatch('b1', 'sku1', 50, None))
+    sqlite_bus.handle(commands.CreateBatch('b2', 'sku2', 50, None))
+    sqlite_bus.handle(commands.Allocate('o1', 'sku1', 10))
+    sqlite_bus.handle(commands.Allocate('o1', 'sku2', 10))
+    with sqlite_bus.uow:
+        sqlite_bus.uow.session.execute("DELETE FROM allocations_view WHERE sku = 'sku2'")
+        sqlite_bus.uow.session.execute(
+            "INSERT INTO allocations_view (orderid, sku, qty, batchref) VALUES ('o1', 'sku3', 1, 'stale')"
+        )
+        sqlite_bus.uow.commit()
+
+    sqlite_bus.handle(commands.RebuildAllocationsView())
+
+    assert sorted(views.allocations('o1', sqlite_bus.uow), key=lambda row: row['sku']) == [
+        {'sku': 'sku1', 'batchref': 'b1'},
+        {'sku': 'sku2', 'batchref': 'b2'},
+    ]
+
+
+def test_cached_view_follows_allocations_deallocations_and_reallocations(sqlite_bus, allocations_cache):
+    def cached_view():
+        return views.allocations('o1', sqlite_bus.uow, allocations_cache)
+
+    sqlite_bus.handle(commands.CreateBatch('b1', 'sku1', 50, None))
+    sqlite_bus.handle(commands.CreateBatch('b2', 'sku1', 50, today))
+    assert cached_view() == []
+
+    sqlite_bus.handle(commands.Allocate('o1', 'sku1', 40))
+    assert cached_view() == [{'sku': 'sku1', 'batchref': 'b1'}]
+    assert cached_view() == [{'sku': 'sku1', 'batchref': 'b1'}]
+
+    sqlite_bus.handle(commands.ChangeBatchQuantity('b1', 10))
+    assert cached_view() == [{'sku': 'sku1', 'batchref': 'b2'}]
+
+    sqlite_bus.handle(commands.DeAllocate('o1', 'sku1', 40))
+    assert cached_view() == []
+    assert allocations_cache.hits == 1
+
+
+def test_rebuilding_the_view_clears_the_cache(sqlite_bus, allocations_cache):
+    sqlite_bus.handle(commands.CreateBatch('b1', 'sku1', 50, None))
+    sqlite_bus.handle(commands.Allocate('o1', 'sku1', 10))
+    views.allocations('o1', sqlite_bus.uow, allocations_cache)
+
+    sqlite_bus.handle(commands.RebuildAllocationsView())
+
+    assert len(allocations_cache) == 0
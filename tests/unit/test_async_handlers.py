@@ -0,0 +1,134 @@
+import asyncio
+from datetime import date
+
+import pytest
+
+import bootstrap
+from allocation.adapters.repository import AbstractAsyncRepository
+from allocation.domain import commands, events
+from allocation.service_layer import handlers
+from allocation.service_layer.unit_of_work import AsyncUnitOfWorkProtocol
+from test_handlers import FakeNotifications
+
+
+class FakeAsyncProductRepository(AbstractAsyncRepository):
+
+    def __init__(self, products) -> None:
+        super().__init__()
+        self._products = set(products)
+
+    def _add(self, product):
+        self._products.add(product)
+
+    async def _get(self, sku):
+        return next((p for p in self._products if p.sku == sku), None)
+
+    async def _get_by_batchref(self, batchref):
+        return next((
+            p for p in self._products for b in p.batches
+            if b.reference == batchref
+        ), None)
+
+
+class FakeAsyncUnitOfWork(AsyncUnitOfWorkProtocol):
+    def __init__(self):
+        self.products = FakeAsyncProductRepository([])
+        self.committed = False
+
+    async def _commit(self):
+        self.committed = True
+
+    async def rollback(self):
+        pass
+
+
+def bootstrap_async_test_app(publish=None, notifications=None):
+    async def no_publish(*args):
+        pass
+
+    return bootstrap.bootstrap_async(
+        start_orm=False,
+        uow=FakeAsyncUnitOfWork(),
+        notifications=notifications or FakeNotifications(),
+        publish=publish or no_publish,
+    )
+
+
+def test_allocates_through_the_async_bus():
+    published = []
+
+    async def publish(channel, event):
+        published.append((channel, event))
+
+    async def scenario():
+        bus = bootstrap_async_test_app(publish=publish)
+        await bus.handle(commands.CreateBatch("batch1", "CURVY-CHAIR", 10, None))
+        await bus.handle(commands.Allocate("order1", "CURVY-CHAIR", 4))
+        return bus
+
+    bus = asyncio.run(scenario())
+    assert bus.uow.committed
+    assert published == [
+        ("line_allocated", events.Allocated(orderid="order1", sku="CURVY-CHAIR", qty=4, batchref="batch1"))
+    ]
+
+
+def test_errors_for_invalid_sku():
+    async def scenario():
+        bus = bootstrap_async_test_app()
+        await bus.handle(commands.CreateBatch("batch1", "CURVY-CHAIR", 10, None))
+        await bus.handle(commands.Allocate("order1", "NONEXISTENT", 4))
+
+    with pytest.raises(handlers.InvalidSku, match="Invalid sku NONEXISTENT"):
+        asyncio.run(scenario())
+
+
+def test_reallocates_through_the_async_bus():
+    async def scenario():
+        bus = bootstrap_async_test_app()
+        for message in [
+            commands.CreateBatch("batch1", "INDIFFERENT-TABLE", 50, None),
+            commands.CreateBatch("batch2", "INDIFFERENT-TABLE", 50, date.today()),
+            commands.Allocate("order1", "INDIFFERENT-TABLE", 20),
+            commands.Allocate("order2", "INDIFFERENT-TABLE", 20),
+            commands.ChangeBatchQuantity("batch1", 25),
+        ]:
+            await bus.handle(message)
+        return await bus.uow.products.get("INDIFFERENT-TABLE")
+
+    [batch1, batch2] = asyncio.run(scenario()).batches
+    assert batch1.available_quantity == 5
+    assert batch2.available_quantity == 30
+
+
+def test_event_handlers_run_concurrently():
+    first_started = asyncio.Event()
+    second_started = asyncio.Event()
+
+    async def first(event):
+        first_started.set()
+        await asyncio.wait_for(second_started.wait(), timeout=1)
+
+    async def second(event):
+        second_started.set()
+        await asyncio.wait_for(first_started.wait(), timeout=1)
+
+    async def scenario():
+        bus = bootstrap_async_test_app()
+        bus.event_handlers[events.OutOfStock] = [first, second]
+        await bus.handle(events.OutOfStock("sku"))
+
+    asyncio.run(scenario())
+    assert first_started.is_set() and second_started.is_set()
+
+
+def test_sends_email_on_out_of_stock_error():
+    fake_notifs = FakeNotifications()
+
+    async def scenario():
+        bus = bootstrap_async_test_app(notifications=fake_notifs)
+        await bus.handle(commands.CreateBatch("b1", "POPULAR-CURTAINS", 9, None))
+        await bus.handle(commands.Allocate("o1", "POPULAR-CURTAINS", 10))
+
+    asyncio.run(scenario())
+    assert fake_notifs.sent['stock@made.com'] == ["Out of stock for POPULAR-CURTAINS"]
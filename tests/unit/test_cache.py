@@ -0,0 +1,83 @@
+import pytest
+
+from allocation.adapters.cache import LRUCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_loads_once_then_serves_from_the_cache():
+    cache = LRUCache()
+    loads = []
+    assert cache.get_or_load("o1", lambda: loads.append(1) or "rows") == "rows"
+    assert cache.get_or_load("o1", lambda: loads.append(1) or "other") == "rows"
+    assert loads == [1]
+    assert cache.stats() == dict(size=1, hits=1, misses=1, evictions=0, expirations=0, invalidations=0)
+
+
+def test_evicts_the_least_recently_used_entry():
+    cache = LRUCache(maxsize=2)
+    cache.get_or_load("o1", lambda: 1)
+    cache.get_or_load("o2", lambda: 2)
+    cache.get_or_load("o1", lambda: 1)
+    cache.get_or_load("o3", lambda: 3)
+
+    assert cache.get_or_load("o1", lambda: "reloaded") == 1
+    assert cache.get_or_load("o3", lambda: "reloaded") == 3
+    assert cache.get_or_load("o2", lambda: "reloaded") == "reloaded"
+    assert cache.evictions == 2
+    assert len(cache) == 2
+
+
+def test_entries_expire_after_the_ttl():
+    clock = FakeClock()
+    cache = LRUCache(ttl=10, clock=clock)
+    cache.get_or_load("o1", lambda: "old")
+    clock.now = 9.9
+    assert cache.get_or_load("o1", lambda: "new") == "old"
+    clock.now = 10
+    assert cache.get_or_load("o1", lambda: "new") == "new"
+    assert cache.expirations == 1
+
+
+def test_invalidate_drops_the_entry():
+    cache = LRUCache()
+    cache.get_or_load("o1", lambda: "old")
+    cache.invalidate("o1")
+    assert cache.get_or_load("o1", lambda: "new") == "new"
+
+
+def test_a_load_that_raced_an_invalidation_is_not_cached():
+    cache = LRUCache()
+
+    def stale_load():
+        # a write lands and invalidates the key while the old rows are read
+        cache.invalidate("o1")
+        return "stale"
+
+    assert cache.get_or_load("o1", stale_load) == "stale"
+    assert cache.get_or_load("o1", lambda: "fresh") == "fresh"
+    assert cache.get_or_load("o1", lambda: "newer") == "fresh"
+
+
+def test_a_failed_load_is_not_cached():
+    cache = LRUCache()
+
+    def failing_load():
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        cache.get_or_load("o1", failing_load)
+    assert cache.get_or_load("o1", lambda: "rows") == "rows"
+    assert cache._loads == {}
+
+
+def test_a_zero_size_cache_stores_nothing():
+    cache = LRUCache(maxsize=0)
+    cache.get_or_load("o1", lambda: 1)
+    assert cache.get_or_load("o1", lambda: 2) == 2
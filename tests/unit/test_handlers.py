@@ -6,10 +6,12 @@ import pytest
 
 import bootstrap
 from allocation.adapters import notifications
+from allocation.adapters.instrumentation import ConflictMetrics
 from allocation.adapters.repository import AbstractRepository
-from allocation.domain import commands
-from allocation.service_layer import handlers
-from allocation.service_layer.unit_of_work import UnitOfWorkProtocol
+from allocation.domain import commands, events, model
+from allocation.service_layer import handlers, messagebus
+from allocation.service_layer.messagebus import MessageBus, RetryPolicy
+from allocation.service_layer.unit_of_work import UnitOfWorkProtocol, ConcurrencyConflict
 
 
 class FakeProductRepository(AbstractRepository):
@@ -30,6 +32,18 @@ class FakeProductRepository(AbstractRepository):
             if b.reference == batchref
         ), None)
 
+    def add_batches(self, batches):
+        added = 0
+        for batch in batches:
+            if self._get_by_batchref(batch.ref) is None:
+                product = self._get(batch.sku)
+                if product is None:
+                    product = model.Product(batch.sku, batches=[])
+                    self._products.add(product)
+                product.add_batch(model.Batch(batch.ref, batch.sku, batch.qty, batch.eta))
+                added += 1
+        return added
+
 
 class FakeUnitOfWork(UnitOfWorkProtocol):
     def __init__(self):
@@ -79,6 +93,21 @@ def test_add_batch_for_existing_product():
     assert "b2" in [b.reference for b in messagebus.uow.products.get("GARISH-RUG").batches]
 
 
+def test_add_batches_in_bulk():
+    messagebus = bootstrap_test_app()
+    messagebus.handle(commands.CreateBatch("b1", "GARISH-RUG", 100, None))
+
+    messagebus.handle(commands.CreateBatches([
+        commands.CreateBatch("b1", "GARISH-RUG", 100, None),
+        commands.CreateBatch("b2", "GARISH-RUG", 50, None),
+        commands.CreateBatch("b3", "PLAIN-RUG", 10, None),
+    ]))
+
+    assert [b.reference for b in messagebus.uow.products.get("GARISH-RUG").batches] == ["b1", "b2"]
+    assert [b.reference for b in messagebus.uow.products.get("PLAIN-RUG").batches] == ["b3"]
+    assert messagebus.uow.committed
+
+
 def test_error_for_invalid_sku():
     messagebus = bootstrap_test_app()
 
@@ -97,6 +126,58 @@ def test_commits():
     assert messagebus.uow.committed is True
 
 
+def test_allocation_events_are_handled_without_a_database_session(monkeypatch):
+    # the read model is written by the unit of work, not by event handlers
+    monkeypatch.setattr(MessageBus, "_retry_event", lambda *args: pytest.fail("an event handler failed"))
+    messagebus = bootstrap_test_app()
+    messagebus.handle(commands.CreateBatch("b1", "sku", 20, None))
+    messagebus.handle(commands.Allocate("o1", "sku", 2))
+    messagebus.handle(commands.DeAllocate("o1", "sku", 2))
+
+    assert messagebus.uow.products.get("sku").batches[0].available_quantity == 20
+
+
+class TestAllocateMany:
+    def test_allocates_every_line(self):
+        published = []
+        messagebus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=FakeNotifications(),
+            publish=lambda channel, event: published.append(event),
+        )
+        messagebus.handle(commands.CreateBatch("batch1", "SHINY-LAMP", 10, None))
+        messagebus.handle(commands.AllocateMany("SHINY-LAMP", [
+            commands.AllocationLine("o1", 4),
+            commands.AllocationLine("o2", 4),
+            commands.AllocationLine("o3", 4),
+        ]))
+        [batch] = messagebus.uow.products.get("SHINY-LAMP").batches
+        assert batch.available_quantity == 2
+        assert [e.orderid for e in published] == ["o1", "o2"]
+        assert messagebus.uow.committed
+
+    def test_sends_email_for_lines_out_of_stock(self):
+        fake_notifs = FakeNotifications()
+        messagebus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=fake_notifs,
+            publish=lambda *args: None,
+        )
+        messagebus.handle(commands.CreateBatch("batch1", "SHINY-LAMP", 5, None))
+        messagebus.handle(commands.AllocateMany("SHINY-LAMP", [
+            commands.AllocationLine("o1", 4),
+            commands.AllocationLine("o2", 4),
+        ]))
+        assert fake_notifs.sent['stock@made.com'] == ["Out of stock for SHINY-LAMP"]
+
+    def test_errors_for_invalid_sku(self):
+        messagebus = bootstrap_test_app()
+        with pytest.raises(handlers.InvalidSku, match="Invalid sku NONEXISTENT"):
+            messagebus.handle(commands.AllocateMany("NONEXISTENT", [commands.AllocationLine("o1", 1)]))
+
+
 ######################
 class TestChangeBatchQuantity:
     def test_changes_available_quantity(self):
@@ -127,6 +208,78 @@ class TestChangeBatchQuantity:
         # and 20 will be reallocated to the next batch
         assert batch2.available_quantity == 30
 
+    def test_reallocates_in_the_same_unit_of_work(self):
+        messagebus = bootstrap_test_app()
+        for e in [
+            commands.CreateBatch("batch1", "INDIFFERENT-TABLE", 50, None),
+            commands.CreateBatch("batch2", "INDIFFERENT-TABLE", 50, date.today()),
+            commands.Allocate("order1", "INDIFFERENT-TABLE", 20),
+            commands.Allocate("order2", "INDIFFERENT-TABLE", 20),
+        ]:
+            messagebus.handle(e)
+        queued = []
+        messagebus.command_handler[commands.Allocate] = queued.append
+        commits = []
+        messagebus.uow._commit = lambda: commits.append(list(messagebus.uow.products.get("INDIFFERENT-TABLE").events))
+
+        messagebus.handle(commands.ChangeBatchQuantity("batch1", 25))
+
+        assert queued == []
+        # the first commit is the command's, the rest the read model's
+        raised = commits[0]
+        assert [type(e) for e in raised] == [events.Deallocated, events.Allocated]
+        assert raised[1].batchref == "batch2"
+
+    def test_leaves_commands_for_products_not_loaded_to_the_bus(self):
+        messagebus = bootstrap_test_app()
+        messagebus.handle(commands.CreateBatch("batch1", "INDIFFERENT-TABLE", 50, None))
+        product = messagebus.uow.products.get("INDIFFERENT-TABLE")
+        product.events = [commands.Allocate("order1", "OTHER-TABLE", 10)]
+
+        messagebus.apply_cascaded(messagebus.uow)
+
+        assert product.events == [commands.Allocate("order1", "OTHER-TABLE", 10)]
+
+    def test_changes_several_batches_in_one_commit(self):
+        messagebus = bootstrap_test_app()
+        messagebus.handle(commands.CreateBatch("batch1", "ADORABLE-SETTEE", 100, None))
+        messagebus.handle(commands.CreateBatch("batch2", "ADORABLE-SETTEE", 100, None))
+        messagebus.uow.committed = False
+
+        messagebus.handle(commands.ChangeBatchQuantities([
+            commands.ChangeBatchQuantity("batch1", 50),
+            commands.ChangeBatchQuantity("batch2", 70),
+        ]))
+
+        [batch1, batch2] = messagebus.uow.products.get(sku="ADORABLE-SETTEE").batches
+        assert (batch1.available_quantity, batch2.available_quantity) == (50, 70)
+        assert messagebus.uow.committed
+
+    def test_reallocates_displaced_lines_in_the_same_commit_with_a_policy(self):
+        published = []
+        messagebus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=FakeNotifications(),
+            publish=lambda channel, event: published.append(event),
+            reallocation=model.ReallocationPolicy(displace=model.displace_fewest_lines),
+        )
+        for e in [
+            commands.CreateBatch("batch1", "INDIFFERENT-TABLE", 50, None),
+            commands.CreateBatch("batch2", "INDIFFERENT-TABLE", 50, date.today()),
+            commands.Allocate("order1", "INDIFFERENT-TABLE", 10),
+            commands.Allocate("order2", "INDIFFERENT-TABLE", 30),
+        ]:
+            messagebus.handle(e)
+        published.clear()
+        messagebus.uow.committed = False
+        messagebus.handle(commands.ChangeBatchQuantity("batch1", 25))
+        assert messagebus.uow.committed
+        [batch1, batch2] = messagebus.uow.products.get(sku="INDIFFERENT-TABLE").batches
+        assert [(e.orderid, e.batchref) for e in published] == [("order2", "batch2")]
+        assert batch1.available_quantity == 15
+        assert batch2.available_quantity == 20
+
 
 def test_sends_email_on_out_of_stock_error():
     fake_notifs = FakeNotifications()
@@ -141,3 +294,119 @@ def test_sends_email_on_out_of_stock_error():
     assert fake_notifs.sent['stock@made.com'] == [
         f"Out of stock for POPULAR-CURTAINS",
     ]
+
+
+def test_collect_new_events_drains_every_event_once_in_order():
+    uow = FakeUnitOfWork()
+    product = model.Product("sku", batches=[model.Batch("b1", "sku", 10, None)])
+    uow.products.add(product)
+    product.allocate(model.OrderLine("o1", "sku", 1))
+    product.allocate(model.OrderLine("o2", "sku", 100))
+    assert [type(e) for e in uow.collect_new_events()] == [events.Allocated, events.OutOfStock]
+    assert list(uow.collect_new_events()) == []
+
+
+def conflicting(times):
+    calls = []
+
+    def handler(command):
+        calls.append(command)
+        if len(calls) <= times:
+            raise ConcurrencyConflict("version moved")
+
+    return handler, calls
+
+
+def test_retries_a_command_after_a_concurrency_conflict():
+    handler, calls = conflicting(times=2)
+    metrics = ConflictMetrics()
+    bus = MessageBus(
+        FakeUnitOfWork(), {}, {commands.Allocate: handler},
+        command_retries={commands.Allocate: RetryPolicy(attempts=3, initial_wait=0)},
+        conflict_metrics=metrics,
+    )
+
+    bus.handle(commands.Allocate("o1", "LAMP", 1))
+
+    assert len(calls) == 3
+    assert metrics.retries("Allocate") == 2
+    assert metrics.conflict_rate("Allocate") == pytest.approx(2 / 3)
+    assert metrics.gave_up["Allocate"] == 0
+
+
+def test_gives_up_after_the_last_attempt():
+    handler, calls = conflicting(times=5)
+    metrics = ConflictMetrics()
+    bus = MessageBus(
+        FakeUnitOfWork(), {}, {commands.Allocate: handler},
+        command_retries={commands.Allocate: RetryPolicy(attempts=3, initial_wait=0)},
+        conflict_metrics=metrics,
+    )
+
+    with pytest.raises(ConcurrencyConflict):
+        bus.handle(commands.Allocate("o1", "LAMP", 1))
+
+    assert len(calls) == 3
+    assert metrics.conflicts["Allocate"] == 3
+    assert metrics.gave_up["Allocate"] == 1
+
+
+def test_other_errors_are_not_retried():
+    calls = []
+
+    def handler(command):
+        calls.append(command)
+        raise handlers.InvalidSku("no such sku")
+
+    bus = MessageBus(FakeUnitOfWork(), {}, {commands.Allocate: handler})
+
+    with pytest.raises(handlers.InvalidSku):
+        bus.handle(commands.Allocate("o1", "LAMP", 1))
+    assert len(calls) == 1
+
+
+def test_subclassed_messages_go_to_the_handlers_of_their_base():
+    class UrgentAllocate(commands.Allocate):
+        pass
+
+    calls = []
+    bus = MessageBus(FakeUnitOfWork(), {}, {commands.Allocate: calls.append})
+
+    bus.handle(UrgentAllocate("o1", "LAMP", 1))
+    bus.handle(UrgentAllocate("o2", "LAMP", 1))
+
+    assert [c.orderid for c in calls] == ["o1", "o2"]
+
+
+def test_an_event_without_handlers_does_not_stop_the_queue():
+    calls = []
+
+    def allocate(command):
+        calls.append(command)
+        bus.uow.products.add(model.Product("LAMP", batches=[]))
+        bus.uow.products.get("LAMP").events = [events.OutOfStock("LAMP"), commands.Allocate("o2", "LAMP", 1)]
+
+    bus = MessageBus(FakeUnitOfWork(), {}, {commands.Allocate: allocate})
+
+    bus.handle(commands.Allocate("o1", "LAMP", 1))
+
+    assert [c.orderid for c in calls] == ["o1", "o2"]
+
+
+def test_retries_a_failing_event_handler(monkeypatch):
+    monkeypatch.setattr(messagebus, "EVENT_RETRY_WAIT", 0)
+    calls, failures = [], [ConnectionError("read model unavailable")] * (messagebus.EVENT_HANDLER_ATTEMPTS - 1)
+
+    def handler(event):
+        calls.append(event)
+        if failures:
+            raise failures.pop()
+
+    bus = MessageBus(FakeUnitOfWork(), {events.OutOfStock: [handler]}, {})
+
+    bus.handle(events.OutOfStock("LAMP"))
+    assert len(calls) == messagebus.EVENT_HANDLER_ATTEMPTS
+
+    calls.clear()
+    bus.handle(events.OutOfStock("LAMP"))
+    assert len(calls) == 1
@@ -1,5 +1,8 @@
+import random
 from datetime import datetime, timedelta
 
+import pytest
+
 from allocation.domain.model import *
 
 today = datetime.today()
@@ -56,3 +59,88 @@ def test_returns_allocated_batch_ref():
     product = Product("RETRO-CLOCK", [in_stock_batch, shipment_batch])
     batch_ref = product.allocate(line)
     assert batch_ref == "in-stock-batch"
+
+
+def test_deallocating_restores_the_available_quantity():
+    batch, line = make_batch_and_line("SMALL-TABLE", 20, 2)
+    batch.allocate(line)
+    batch.deallocate(line)
+    batch.deallocate(line)
+    assert batch.available_quantity == 20
+
+
+def test_deallocate_one_keeps_the_allocated_quantity_up_to_date():
+    batch = Batch("batch-001", "SMALL-TABLE", qty=20, eta=None)
+    batch.allocate(OrderLine("order1", "SMALL-TABLE", 2))
+    batch.allocate(OrderLine("order2", "SMALL-TABLE", 5))
+    line = batch.deallocate_one()
+    assert batch.allocated_quantity == 7 - line.qty
+    batch.check_allocated_quantity()
+
+
+def test_allocated_quantity_is_rebuilt_when_the_counter_is_reset():
+    batch, line = make_batch_and_line("SMALL-TABLE", 20, 2)
+    batch.allocate(line)
+    batch._allocated_quantity = None
+    assert batch.allocated_quantity == 2
+    assert batch.available_quantity == 18
+
+
+def test_consistency_check_detects_a_drifted_counter():
+    batch, line = make_batch_and_line("SMALL-TABLE", 20, 2)
+    product = Product("SMALL-TABLE", [batch])
+    product.allocate(line)
+    product.check_consistency()
+    batch._allocated_quantity = 5
+    with pytest.raises(InconsistentAllocation):
+        product.check_consistency()
+
+
+def test_order_line_strings_are_interned():
+    line1 = OrderLine("".join(["order", "-1"]), "SMALL-TABLE", 1)
+    line2 = OrderLine("".join(["order", "-1"]), "SMALL-TABLE", 2)
+    assert line1.orderid is line2.orderid
+
+
+def test_compact_batch_keeps_the_batch_api():
+    batch = Batch("batch-001", "SMALL-TABLE", qty=20, eta=None, compact=True)
+    line = OrderLine("order1", "SMALL-TABLE", 2)
+    batch.allocate(line)
+    batch.allocate(line)
+    assert batch.is_allocated_to(OrderLine("order1", "SMALL-TABLE", 2))
+    assert not batch.is_allocated_to(OrderLine("order1", "SMALL-TABLE", 3))
+    assert batch.available_quantity == 18
+    batch.deallocate(line)
+    assert not batch.is_allocated_to(line)
+    assert batch.available_quantity == 20
+
+
+def test_compact_allocations_behave_like_a_set():
+    rng = random.Random(99)
+    compact, plain = CompactAllocations("SKU"), set()
+    for _ in range(2_000):
+        line = OrderLine(f"order-{rng.randint(0, 30)}", "SKU", rng.randint(1, 3))
+        operation = rng.random()
+        if operation < 0.5:
+            compact.add(line)
+            plain.add(line)
+        elif operation < 0.8:
+            compact.discard(line)
+            plain.discard(line)
+        elif plain:
+            popped = compact.pop()
+            plain.remove(popped)
+        assert (line in compact) == (line in plain)
+        assert len(compact) == len(plain)
+    assert set(compact) == plain
+
+
+def test_deallocate_one_from_a_compact_batch():
+    batch = Batch("batch-001", "SMALL-TABLE", qty=20, eta=None, compact=True)
+    batch.allocate(OrderLine("order1", "SMALL-TABLE", 2))
+    batch.allocate(OrderLine("order1", "SMALL-TABLE", 3))
+    lines = {batch.deallocate_one(), batch.deallocate_one()}
+    assert lines == {OrderLine("order1", "SMALL-TABLE", 2), OrderLine("order1", "SMALL-TABLE", 3)}
+    assert batch.available_quantity == 20
+    with pytest.raises(KeyError):
+        batch.deallocate_one()
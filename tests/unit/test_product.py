@@ -1,7 +1,13 @@
-from datetime import datetime, timedelta
+import random
+from datetime import date, datetime, timedelta
+
+import pytest
 
 from allocation.domain import commands, events
-from allocation.domain.model import Batch, Product, OrderLine
+from allocation.domain.model import (
+    Batch, Product, OrderLine, NotAllocated, ReallocationPolicy,
+    displace_closest_fit, displace_fewest_lines, displace_oldest_first,
+)
 from test_handlers import bootstrap_test_app
 
 today = datetime.today()
@@ -49,3 +55,175 @@ def test_increments_version_number():
     messagebus.handle(commands.CreateBatch("batch_ref_1", "sku_1", 10, None))
     messagebus.handle(commands.Allocate("order_id_1", "sku_1", 1))
     assert messagebus.uow.products.get("sku_1").version_number == 1
+
+
+def test_deallocate_returns_the_batch_the_line_was_allocated_to():
+    product = Product("sku", batches=[
+        Batch("in-stock", "sku", 10, eta=None),
+        Batch("shipment", "sku", 10, eta=today),
+    ])
+    line = OrderLine("o1", "sku", 10)
+    product.allocate(line)
+    product.allocate(OrderLine("o2", "sku", 10))
+    assert product.is_allocated(line)
+    assert product.deallocate(line) == "in-stock"
+    assert not product.is_allocated(line)
+    assert product.batches[0].available_quantity == 10
+    assert product.events[-1] == events.Deallocated(orderid="o1", sku="sku", qty=10, batchref="in-stock")
+
+
+def test_deallocating_an_unallocated_line_raises():
+    product = Product("sku", batches=[Batch("b1", "sku", 10, eta=None)])
+    with pytest.raises(NotAllocated):
+        product.deallocate(OrderLine("o1", "sku", 1))
+
+
+def test_reallocated_lines_leave_the_index():
+    product = Product("sku", batches=[Batch("b1", "sku", 10, eta=None)])
+    line = OrderLine("o1", "sku", 10)
+    product.allocate(line)
+    product.change_batch_quantity("b1", 5)
+    assert not product.is_allocated(line)
+    product.check_consistency()
+
+
+def test_deallocate_command_frees_the_allocation():
+    messagebus = bootstrap_test_app()
+    messagebus.handle(commands.CreateBatch("batch1", "sku", 10, None))
+    messagebus.handle(commands.Allocate("o1", "sku", 10))
+    messagebus.handle(commands.DeAllocate("o1", "sku", 10))
+    product = messagebus.uow.products.get("sku")
+    assert product.batches[0].available_quantity == 10
+
+
+def test_batches_have_a_consistent_total_order():
+    in_stock = Batch("in-stock", "sku", 10, eta=None)
+    shipment = Batch("shipment", "sku", 10, eta=date(2011, 1, 1))
+    later = Batch("later", "sku", 10, eta=date(2011, 1, 2))
+    assert in_stock < shipment < later
+    assert in_stock <= shipment and not shipment <= in_stock
+    assert not later < later and later <= later
+
+
+def test_added_batches_keep_the_allocation_order():
+    product = Product("sku", batches=[])
+    product.allocate(OrderLine("o0", "sku", 1))
+    product.add_batch(Batch("later", "sku", 10, eta=date(2011, 1, 2)))
+    product.add_batch(Batch("in-stock", "sku", 10, eta=None))
+    product.add_batch(Batch("earlier", "sku", 10, eta=date(2011, 1, 1)))
+    assert [b.reference for b in product.ordered_batches] == ["in-stock", "earlier", "later"]
+    product.check_consistency()
+
+
+def test_changing_eta_reorders_the_batches():
+    product = Product("sku", batches=[
+        Batch("b1", "sku", 10, eta=date(2011, 1, 1)),
+        Batch("b2", "sku", 10, eta=date(2011, 1, 2)),
+    ])
+    product.change_batch_eta("b1", date(2011, 1, 3))
+    assert product.allocate(OrderLine("o1", "sku", 1)) == "b2"
+    product.check_consistency()
+
+
+def _legacy_choice(batches, line):
+    # the allocation order used before the batch index: a stable sort that
+    # puts in-stock batches first and shipments by ETA
+    ordered = sorted(batches, key=lambda b: (b.eta is not None, b.eta or date.min))
+    return next((b.reference for b in ordered if b.can_allocate(line)), None)
+
+
+def _random_batches(rng, n):
+    etas = [None] + [date(2011, 1, 1) + timedelta(days=d) for d in range(5)]
+    # references sort in creation order, so both paths break ties the same way
+    return [Batch(f"batch-{i:04}", "sku", rng.randint(0, 20), rng.choice(etas)) for i in range(n)]
+
+
+def test_batch_index_makes_the_same_choices_as_sorting():
+    rng = random.Random(1234)
+    for _ in range(200):
+        batches = _random_batches(rng, rng.randint(1, 30))
+        legacy_batches = [Batch(b.reference, "sku", b._purchased_quantity, b.eta) for b in batches]
+        product = Product("sku", batches=[])
+        for batch in batches:
+            product.add_batch(batch)
+        for i in range(rng.randint(1, 30)):
+            if rng.random() < 0.2:
+                legacy_batch = rng.choice(legacy_batches)
+                legacy_batch.eta = rng.choice([None, date(2011, 1, 1) + timedelta(days=rng.randint(0, 5))])
+                product.change_batch_eta(legacy_batch.reference, legacy_batch.eta)
+            line = OrderLine(f"order-{i}", "sku", rng.randint(1, 10))
+            expected = _legacy_choice(legacy_batches, line)
+            if expected is not None:
+                next(b for b in legacy_batches if b.reference == expected).allocate(line)
+            assert product.allocate(line) == expected
+        product.check_consistency()
+
+
+def test_allocate_many_makes_the_same_choices_as_allocating_one_by_one():
+    rng = random.Random(4321)
+    for _ in range(100):
+        batches = _random_batches(rng, rng.randint(1, 20))
+        one_by_one = Product("sku", batches=[Batch(b.reference, "sku", b._purchased_quantity, b.eta) for b in batches])
+        in_bulk = Product("sku", batches=batches)
+        lines = [OrderLine(f"order-{i}", "sku", rng.randint(1, 10)) for i in range(rng.randint(1, 40))]
+        expected = [one_by_one.allocate(line) for line in lines]
+        assert in_bulk.allocate_many(lines) == expected
+        assert in_bulk.events == one_by_one.events
+        in_bulk.check_consistency()
+
+
+def test_allocate_many_increments_version_number_once():
+    product = Product("sku", batches=[Batch("b1", "sku", 10, eta=None)])
+    product.allocate_many([OrderLine("o1", "sku", 1), OrderLine("o2", "sku", 1)])
+    assert product.version_number == 1
+
+
+def _product_with_lines(*qtys):
+    product = Product("sku", batches=[
+        Batch("batch1", "sku", sum(qtys), eta=None),
+        Batch("batch2", "sku", 100, eta=today),
+    ])
+    for i, qty in enumerate(qtys):
+        product.allocate(OrderLine(f"order{i}", "sku", qty))
+    product.events.clear()
+    return product
+
+
+def _displaced_orders(product):
+    return [e.orderid for e in product.events if isinstance(e, events.Deallocated)]
+
+
+def test_fewest_lines_displaces_the_largest_lines():
+    product = _product_with_lines(2, 2, 2, 7, 3)
+    product.change_batch_quantity("batch1", 10, ReallocationPolicy(displace=displace_fewest_lines))
+    assert _displaced_orders(product) == ["order3"]
+    assert product.batches[0].available_quantity == 1
+
+
+def test_closest_fit_displaces_the_smallest_line_that_covers_the_shortfall():
+    product = _product_with_lines(10, 3, 5, 4)
+    product.change_batch_quantity("batch1", 18, ReallocationPolicy(displace=displace_closest_fit))
+    assert _displaced_orders(product) == ["order3"]
+    assert product.batches[0].available_quantity == 0
+
+
+def test_closest_fit_combines_lines_when_none_is_big_enough():
+    product = _product_with_lines(3, 3, 1)
+    product.change_batch_quantity("batch1", 2, ReallocationPolicy(displace=displace_closest_fit))
+    assert sorted(_displaced_orders(product)) == ["order0", "order1"]
+
+
+def test_fifo_displaces_the_oldest_allocations():
+    product = _product_with_lines(2, 2, 2, 2)
+    product.change_batch_quantity("batch1", 5, ReallocationPolicy(displace=displace_oldest_first))
+    assert _displaced_orders(product) == ["order0", "order1"]
+
+
+def test_displaced_lines_are_raised_as_allocate_commands():
+    product = _product_with_lines(5, 5)
+    product.change_batch_quantity("batch1", 5, ReallocationPolicy(displace=displace_oldest_first))
+    assert product.events == [
+        events.Deallocated(orderid="order0", sku="sku", qty=5, batchref="batch1"),
+        commands.Allocate("order0", "sku", 5),
+    ]
+    product.check_consistency()
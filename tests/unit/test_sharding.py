@@ -0,0 +1,82 @@
+import threading
+
+import pytest
+
+import bootstrap
+from allocation.domain import commands
+from allocation.service_layer import handlers
+from allocation.service_layer.sharding import partition_key
+from test_handlers import FakeUnitOfWork, FakeNotifications
+
+
+@pytest.fixture
+def sharded_bus():
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=FakeUnitOfWork(),
+        notifications=FakeNotifications(),
+        publish=lambda *args: None,
+        shards=4,
+        uow_factory=FakeUnitOfWork,
+    )
+    yield bus
+    bus.close()
+
+
+def test_commands_for_a_sku_always_go_to_the_same_shard(sharded_bus):
+    shards = {
+        sharded_bus.shard_for(commands.Allocate(f"order{i}", "RED-CHAIR", 1))
+        for i in range(20)
+    }
+    assert len(shards) == 1
+
+
+def test_batch_changes_are_partitioned_by_the_sku_of_their_batch():
+    skus = {"batch1": "RED-CHAIR"}
+    assert partition_key(commands.Allocate("order1", "RED-CHAIR", 1), skus.get) == "RED-CHAIR"
+    assert partition_key(commands.ChangeBatchQuantity("batch1", 10), skus.get) == "RED-CHAIR"
+    assert partition_key(
+        commands.ChangeBatchQuantities([commands.ChangeBatchQuantity("batch1", 10)]), skus.get
+    ) == "RED-CHAIR"
+    assert partition_key(commands.ChangeBatchQuantity("no-such-batch", 10), skus.get) == "no-such-batch"
+
+
+def test_handles_commands_in_order_per_sku(sharded_bus):
+    skus = [f"sku{i}" for i in range(8)]
+    for sku in skus:
+        sharded_bus.handle(commands.CreateBatch(f"batch-{sku}", sku, 100, None))
+    futures = [
+        sharded_bus.submit(commands.Allocate(f"order{i}", sku, 1))
+        for i in range(10) for sku in skus
+    ]
+    for future in futures:
+        future.result()
+
+    for sku in skus:
+        bus = sharded_bus.buses[sharded_bus.shard_for(commands.Allocate("", sku, 1))]
+        product = bus.uow.products.get(sku)
+        assert product.batches[0].available_quantity == 90
+        assert list(product.allocated_lines) == [(f"order{i}", 1) for i in range(10)]
+
+
+def test_different_skus_are_handled_in_parallel(sharded_bus):
+    sku1 = "sku1"
+    sku2 = next(
+        f"sku{i}" for i in range(2, 100)
+        if sharded_bus.shard_for(commands.Allocate("", f"sku{i}", 1))
+        != sharded_bus.shard_for(commands.Allocate("", sku1, 1))
+    )
+    release = threading.Event()
+    bus1 = sharded_bus.buses[sharded_bus.shard_for(commands.Allocate("", sku1, 1))]
+    bus1.command_handler[commands.CreateBatch] = lambda c: release.wait(timeout=5)
+
+    blocked = sharded_bus.submit(commands.CreateBatch("batch1", sku1, 10, None))
+    sharded_bus.handle(commands.CreateBatch("batch2", sku2, 10, None))
+    assert not blocked.done()
+    release.set()
+    blocked.result(timeout=5)
+
+
+def test_errors_are_raised_to_the_caller(sharded_bus):
+    with pytest.raises(handlers.InvalidSku):
+        sharded_bus.handle(commands.Allocate("order1", "NONEXISTENT", 1))
@@ -0,0 +1,47 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+import bootstrap
+
+SRC = Path(bootstrap.__file__).resolve().parent
+
+# not needed to import an entrypoint, or only once it starts up; how long the
+# imports take is measured by benchmarks/bench_startup.py instead
+DEFERRED = ["flask", "uvicorn", "sqlalchemy.ext.asyncio", "redis.asyncio", "psycopg2", "asyncpg"]
+ENTRYPOINTS = {
+    # fastapi.responses imports orjson itself
+    "allocation.entrypoints.api": DEFERRED,
+    "allocation.entrypoints.redis_eventconsumer": DEFERRED + ["orjson"],
+    "allocation.entrypoints.outbox_relay": DEFERRED + ["orjson"],
+    "allocation.entrypoints.bulk_loader": DEFERRED + ["orjson"],
+}
+PROBE = """
+import importlib, json, sys
+importlib.import_module(sys.argv[1])
+from allocation.adapters import redis_eventpublisher
+from allocation.service_layer import unit_of_work
+print(json.dumps(dict(
+    modules=[name for name in sys.argv[2:] if name in sys.modules],
+    engines=unit_of_work.default_session_factory.cache_info().currsize,
+    clients=redis_eventpublisher.default_client.cache_info().currsize,
+)))
+"""
+
+
+def import_in_a_fresh_interpreter(module, deferred):
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE, module, *deferred],
+        env=dict(os.environ, PYTHONPATH=str(SRC)), capture_output=True, text=True, check=True,
+    )
+    return json.loads(result.stdout)
+
+
+@pytest.mark.parametrize("module", ENTRYPOINTS)
+def test_importing_an_entrypoint_defers_slow_imports_and_connections(module):
+    loaded = import_in_a_fresh_interpreter(module, ENTRYPOINTS[module])
+    assert loaded == dict(modules=[], engines=0, clients=0)